@@ -0,0 +1,22 @@
+"""
+ASGI config for MessengerAPI project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Both HTTP requests and WebSocket connections are routed by
+``MessengerAPI.routing``: the hot chat endpoints are served by async
+consumers and everything else by Django. Run it with daphne, e.g.
+``daphne MessengerAPI.asgi:application``.
+
+For more information on this file, see
+https://channels.readthedocs.io/en/2.x/deploying.html
+"""
+
+import os
+
+import django
+from channels.routing import get_default_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'MessengerAPI.settings')
+django.setup()
+
+application = get_default_application()
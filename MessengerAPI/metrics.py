@@ -0,0 +1,201 @@
+"""
+Per-request latency and SQL metrics.
+
+RequestMetricsMiddleware times every request, the SQL it runs and the
+rendering of its response to JSON. Views time building the response
+data from models, i.e. serialization, in `measure_serialization`
+blocks. Results are aggregated per view into histograms served in the
+Prometheus text format by `metrics_view` to staff and the networks of
+METRICS_ALLOWED_NETWORKS, and with DEBUG on are also sent back in
+Server-Timing and X-SQL-Queries response headers.
+
+Histograms are kept per process, so every worker has to be scraped.
+"""
+import ipaddress
+import threading
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Histogram:
+    """
+    Prometheus histogram with `view` and `method` labels.
+    """
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        with self._lock:
+            series = [(labels, list(counts), total, count)
+                      for labels, (counts, total, count) in self._series.items()]
+
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation),
+                 '# TYPE {0} histogram'.format(self.name)]
+        for (view, method), counts, total, count in sorted(series):
+            labels = 'view="{0}",method="{1}"'.format(escape_label(view), escape_label(method))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(self.name, labels, bound, cumulative))
+            lines.append('{0}_sum{{{1}}} {2!r}'.format(self.name, labels, total))
+            lines.append('{0}_count{{{1}}} {2}'.format(self.name, labels, count))
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds',
+                             'Time from receiving a request to returning its response.', TIME_BUCKETS)
+SQL_DURATION = Histogram('http_request_sql_duration_seconds',
+                         'Time spent executing SQL per request.', TIME_BUCKETS)
+SQL_QUERIES = Histogram('http_request_sql_queries',
+                        'Number of SQL queries per request.', QUERY_BUCKETS)
+SERIALIZE_DURATION = Histogram('http_request_serialize_duration_seconds',
+                               'Time spent serializing the response data per request.', TIME_BUCKETS)
+RENDER_DURATION = Histogram('http_request_render_duration_seconds',
+                            'Time spent rendering the response body per request.', TIME_BUCKETS)
+
+HISTOGRAMS = (REQUEST_DURATION, SQL_DURATION, SQL_QUERIES, SERIALIZE_DURATION, RENDER_DURATION)
+
+
+class RequestMetrics:
+    """
+    Counters of one request. Installed as a database execute wrapper,
+    it only adds a timer call around every query.
+    """
+    __slots__ = ('queries', 'sql_time', 'serialize_time', 'render_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.serialize_time = 0.0
+        self.render_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += perf_counter() - start
+            self.queries += 1
+
+
+@contextmanager
+def record_queries(metrics):
+    """
+    Count the queries of this thread in `metrics` while in the block.
+    """
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(metrics))
+        yield
+
+
+@contextmanager
+def measure_serialization(request):
+    """
+    Add the time spent in the block to the serialization time of the
+    request, including the queries run by the serializers.
+    """
+    metrics = getattr(request, 'metrics', None)
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics.serialize_time += perf_counter() - start
+
+
+def observe_request(view_name, method, duration, metrics):
+    labels = (view_name, method)
+    REQUEST_DURATION.observe(labels, duration)
+    SQL_DURATION.observe(labels, metrics.sql_time)
+    SQL_QUERIES.observe(labels, metrics.queries)
+    SERIALIZE_DURATION.observe(labels, metrics.serialize_time)
+    RENDER_DURATION.observe(labels, metrics.render_time)
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = request.metrics = RequestMetrics()
+        start = perf_counter()
+        with record_queries(metrics):
+            response = self.get_response(request)
+        duration = perf_counter() - start
+
+        match = request.resolver_match
+        observe_request(match.view_name if match is not None else 'unmatched',
+                        request.method, duration, metrics)
+
+        if settings.DEBUG:
+            response['Server-Timing'] = \
+                'sql;dur={0:.2f}, serialize;dur={1:.2f}, render;dur={2:.2f}, total;dur={3:.2f}'.format(
+                    metrics.sql_time * 1000, metrics.serialize_time * 1000, metrics.render_time * 1000,
+                    duration * 1000)
+            response['X-SQL-Queries'] = str(metrics.queries)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook returns
+        start = perf_counter()
+
+        def rendered(response):
+            request.metrics.render_time += perf_counter() - start
+
+        response.add_post_render_callback(rendered)
+        return response
+
+
+def metrics_allowed(request):
+    """
+    :return: whether the request comes from a staff session or from one
+    of the METRICS_ALLOWED_NETWORKS
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network) for network in settings.METRICS_ALLOWED_NETWORKS)
+
+
+def metrics_view(request):
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.collect())
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
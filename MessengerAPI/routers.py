@@ -0,0 +1,114 @@
+"""
+Read-replica routing.
+
+Views list the actions that may read from a replica in `replica_actions`.
+ReplicaRoutingMiddleware flags safe requests to those actions, and while
+a request is flagged ReplicaRouter sends its reads to a random alias of
+DATABASE_REPLICAS. Everything else, and all writes, use `default`.
+
+After a write the client is pinned to the primary for
+DATABASE_REPLICA_PIN_SECONDS, so it reads its own writes while the
+replicas catch up. Clients are told apart by their Authorization header.
+"""
+import hashlib
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_state = threading.local()
+
+
+def replica_allowed():
+    return getattr(_state, 'replica', False)
+
+
+def pin_cache_key(request):
+    """
+    :return: cache key of the client's pin or None for anonymous requests
+    """
+    authorization = request.META.get('HTTP_AUTHORIZATION')
+    if not authorization:
+        return None
+    digest = hashlib.sha1(authorization.encode('utf-8')).hexdigest()
+    return 'db-primary-pin-{0}'.format(digest)
+
+
+def is_replica_action(view_func, method):
+    view_class = getattr(view_func, 'cls', None)
+    actions = getattr(view_func, 'actions', None)
+    if view_class is None:
+        return False
+    action = actions.get(method.lower()) if actions else method.lower()
+    return action in getattr(view_class, 'replica_actions', ())
+
+
+def is_pinned(request):
+    key = pin_cache_key(request)
+    return key is not None and bool(cache.get(key))
+
+
+def pin_to_primary(request):
+    """
+    Send reads of the client to the primary for a while after it wrote.
+    """
+    key = pin_cache_key(request)
+    if key is not None and settings.DATABASE_REPLICAS:
+        cache.set(key, True, settings.DATABASE_REPLICA_PIN_SECONDS)
+
+
+@contextmanager
+def replica_reads(request):
+    """
+    Let reads of the block, on this thread, go to a replica
+    unless the client is pinned to the primary.
+    """
+    _state.replica = bool(settings.DATABASE_REPLICAS) and not is_pinned(request)
+    try:
+        yield
+    finally:
+        _state.replica = False
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if replica_allowed() and settings.DATABASE_REPLICAS:
+            return random.choice(settings.DATABASE_REPLICAS)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # objects read from a replica are saved to the primary
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class ReplicaRoutingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.replica = False
+
+        if request.method not in SAFE_METHODS:
+            pin_to_primary(request)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (settings.DATABASE_REPLICAS and request.method in SAFE_METHODS
+                and is_replica_action(view_func, request.method)):
+            _state.replica = not is_pinned(request)
+        return None
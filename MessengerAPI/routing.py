@@ -0,0 +1,16 @@
+from channels.routing import ProtocolTypeRouter, URLRouter
+from django.urls import re_path
+
+import chat.routing
+from chat.middleware import JSONWebTokenAuthMiddleware
+
+application = ProtocolTypeRouter({
+    # chat list, history, poll and message send are served by async
+    # consumers, every other request by Django
+    'http': URLRouter(chat.routing.http_urlpatterns + [
+        re_path(r'', chat.routing.ThreadPoolAsgiHandler),
+    ]),
+    'websocket': JSONWebTokenAuthMiddleware(
+        URLRouter(chat.routing.websocket_urlpatterns)
+    ),
+})
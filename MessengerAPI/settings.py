@@ -36,11 +36,14 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'rest_framework',
+    'channels',
     'profiles',
     'chat'
 ]
 
 MIDDLEWARE = [
+    'MessengerAPI.metrics.RequestMetricsMiddleware',
+    'MessengerAPI.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -71,13 +74,96 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'MessengerAPI.wsgi.application'
 
+ASGI_APPLICATION = 'MessengerAPI.routing.application'
+
+# Pub/sub used to fan out realtime chat updates. The in-memory layer only
+# delivers within one process; use channels_redis.core.RedisChannelLayer
+# when running more than one node.
+# https://channels.readthedocs.io/en/2.x/topics/channel_layers.html
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+    }
+}
+
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
+# Read-only endpoints (see `replica_actions` on views) read from the
+# aliases in DATABASE_REPLICAS, everything else uses `default`. A replica
+# is configured like the primary plus 'TEST': {'MIRROR': 'default'}.
+# CONN_MAX_AGE keeps connections open between requests of a worker.
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'CONN_MAX_AGE': 60,
+    }
+}
+
+DATABASE_ROUTERS = ['MessengerAPI.routers.ReplicaRouter']
+
+DATABASE_REPLICAS = []
+
+# Clients read from the primary for this long after a write,
+# so they see their own changes despite replication lag
+
+DATABASE_REPLICA_PIN_SECONDS = 5
+
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+# Chat membership is cached here and invalidated on change, so processes
+# must share one backend (memcached, redis) when running more than one.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+CHAT_MEMBERSHIP_CACHE_TIMEOUT = 300
+
+# Verified JWTs are remembered per process to skip the user query,
+# see profiles.authentication.CachedJSONWebTokenAuthentication
+
+JWT_AUTH_CACHE_SIZE = 10000
+
+JWT_AUTH_CACHE_TTL = 60
+
+# /metrics is served to staff sessions and to requests from these
+# networks, e.g. the one of the Prometheus scrapers
+
+METRICS_ALLOWED_NETWORKS = ['127.0.0.1/32', '::1/128']
+
+# Messages older than this are moved to the archive tier by the
+# archive_messages command
+
+MESSAGE_ARCHIVE_AFTER_DAYS = 180
+
+# Side effects of sends are queued in the outbox and run by the
+# process_outbox command. A failed event is retried after OUTBOX_RETRY_DELAY
+# seconds, doubled on every attempt up to OUTBOX_MAX_RETRY_DELAY, and is
+# left in the table for inspection after OUTBOX_MAX_ATTEMPTS.
+
+OUTBOX_RETRY_DELAY = 5
+
+OUTBOX_MAX_RETRY_DELAY = 3600
+
+OUTBOX_MAX_ATTEMPTS = 10
+
+# Token-bucket rates of chat.throttling: a client may burst up to the
+# number of requests and is then held to their average rate. A batch
+# send costs one token per message, so message_send also caps the batch
+# size: larger batches are refused with 400 (as are batches over
+# MessageView.max_batch_size, 500).
+
+REST_FRAMEWORK = {
+    'DEFAULT_THROTTLE_RATES': {
+        'message_send': '120/min',
+        'chat_message_send': '600/min',
+        'chat_create': '20/min',
     }
 }
 
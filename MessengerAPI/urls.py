@@ -17,9 +17,12 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework_jwt.views import obtain_jwt_token
 
+from .metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/profiles/', include('profiles.urls')),
     path('api/chats/', include('chat.urls')),
-    path('api/token-auth/', obtain_jwt_token, name='obtain-token')
+    path('api/token-auth/', obtain_jwt_token, name='obtain-token'),
+    path('metrics', metrics_view, name='metrics')
 ]
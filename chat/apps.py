@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class ChatConfig(AppConfig):
     name = 'chat'
+
+    def ready(self):
+        from . import membership, realtime
+        membership.connect_signals()
+        realtime.connect_signals()
@@ -0,0 +1,56 @@
+"""
+ETags of chats and message history.
+
+Tags are built from Chat.version, which is bumped in the transaction of
+every message send, edit and participant change, so checking
+If-None-Match takes one query on chat_chat and a 304 skips reading the
+messages and serializing them.
+"""
+import hashlib
+
+from django.db.models import OuterRef, Subquery
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import Chat, ChatReadState
+
+
+def chat_etag(chat_id, user_id):
+    """
+    :return: ETag of the chat as seen by the user, whose unread count
+    is part of it, or None if the chat does not exist
+    """
+    read = ChatReadState.objects.filter(chat=OuterRef('pk'), user_id=user_id).values('last_read_seq')
+    row = Chat.objects.filter(id=chat_id).annotate(read=Subquery(read)) \
+        .values_list('version', 'read').first()
+    if row is None:
+        return None
+    return '"c{0}-{1}-{2}"'.format(chat_id, row[0], row[1] or 0)
+
+
+def history_etag(request, chat_id):
+    """
+    :return: ETag of a page of the chat's history, which depends on
+    the cursor and page size in the query string, or None if the chat
+    does not exist
+    """
+    version = Chat.objects.filter(id=chat_id).values_list('version', flat=True).first()
+    if version is None:
+        return None
+    # the browsable API renders the same page differently
+    query = '{0}|{1}'.format(request.META.get('QUERY_STRING', ''), request.META.get('HTTP_ACCEPT', ''))
+    return '"m{0}-{1}-{2}"'.format(chat_id, version, hashlib.md5(query.encode()).hexdigest()[:16])
+
+
+def not_modified(request, etag):
+    """
+    :return: 304 response if `etag` matches If-None-Match, None otherwise
+    """
+    if etag is None:
+        return None
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    # weak comparison, as for any GET
+    if '*' in etags or etag.lstrip('W/') in (tag.lstrip('W/') for tag in etags):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return None
@@ -0,0 +1,257 @@
+from io import BytesIO
+from time import perf_counter
+
+from channels.db import database_sync_to_async
+from channels.generic.http import AsyncHttpConsumer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.http import AsgiRequest
+from django.contrib.auth.models import AnonymousUser
+from rest_framework import exceptions, status
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import exception_handler
+
+from MessengerAPI.metrics import RequestMetrics, measure_serialization, observe_request, record_queries
+from MessengerAPI.routers import pin_to_primary, replica_reads
+from profiles.authentication import CachedJSONWebTokenAuthentication
+from .conditional import history_etag, not_modified
+from .listings import chat_rows, message_rows
+from .membership import get_membership, get_membership_or_404
+from .pagination import MessageCursorPagination, StandardPagination
+from .models import Chat
+from .realtime import chat_group_name, message_notifier, user_group_name
+from .renderers import FastJSONRenderer
+from .throttling import ChatMessageThrottle, MessageSendThrottle, check_throttles
+from .views import ChatView, MessageView
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Pushes new and edited messages of every chat the user participates in.
+    Each connection joins the groups of the user's chats, so a message is
+    sent to its chat once, and the group of its user, which tells it to
+    follow membership changes without reconnecting.
+    """
+
+    async def connect(self):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            await self.close()
+            return
+
+        # join the user's group first, so no membership change is missed
+        self.group_names = set()
+        await self.join([user_group_name(user.id)])
+        chat_ids = await database_sync_to_async(self.get_chat_ids, thread_sensitive=False)(user.id)
+        await self.join(chat_group_name(chat_id) for chat_id in chat_ids)
+        await self.accept()
+
+    async def disconnect(self, code):
+        for group_name in getattr(self, 'group_names', ()):
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+
+    @staticmethod
+    def get_chat_ids(user_id):
+        return list(Chat.participants.through.objects.filter(user_id=user_id).values_list('chat_id', flat=True))
+
+    async def join(self, group_names):
+        for group_name in group_names:
+            self.group_names.add(group_name)
+            await self.channel_layer.group_add(group_name, self.channel_name)
+
+    async def chat_joined(self, event):
+        await self.join(chat_group_name(chat_id) for chat_id in event['chat_ids'])
+
+    async def chat_left(self, event):
+        for chat_id in event['chat_ids']:
+            group_name = chat_group_name(chat_id)
+            self.group_names.discard(group_name)
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+
+    async def chat_messages(self, event):
+        for message in event['messages']:
+            await self.send_json({
+                'event': event['event'],
+                'message': message
+            })
+
+
+class APIConsumer(AsyncHttpConsumer):
+    """
+    Base of the async HTTP endpoints. The request body is received and
+    the response sent on the event loop, so a slow client costs a
+    coroutine rather than a worker thread. Only the database work runs
+    in the thread pool, through `run_sync`, and the thread is released
+    as soon as it is done. The calls are not thread sensitive, so they
+    don't queue for the single thread shared by all sync code. Authentication, permissions and responses
+    match the DRF views serving the same URLs over WSGI.
+    """
+    view_name = None
+    authentication = CachedJSONWebTokenAuthentication()
+    renderer = FastJSONRenderer()
+
+    async def handle(self, body):
+        http_request = AsgiRequest(self.scope, BytesIO(body))
+        # the whole body is here already, chunked requests carry no length
+        http_request.META.setdefault('CONTENT_LENGTH', str(len(body)))
+        request = Request(http_request, parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES])
+        self.metrics = http_request.metrics = RequestMetrics()
+        start = perf_counter()
+        try:
+            response = await self.get_response(request, **self.scope['url_route']['kwargs'])
+        except exceptions.APIException as exc:
+            response = self.handle_exception(exc, request)
+
+        render_start = perf_counter()
+        content = self.renderer.render(response.data)
+        self.metrics.render_time = perf_counter() - render_start
+        observe_request(self.view_name, request.method, perf_counter() - start, self.metrics)
+
+        headers = [(b'Content-Type', self.renderer.media_type.encode('ascii'))]
+        headers.extend((name.encode('latin1'), value.encode('latin1'))
+                       for name, value in response.items() if name.lower() != 'content-type')
+        await self.send_response(response.status_code, content, headers=headers)
+
+    async def get_response(self, request, **kwargs):
+        """
+        :return: DRF Response of the endpoint
+        """
+        raise NotImplementedError
+
+    async def run_sync(self, func, *args):
+        return await database_sync_to_async(self.call_measured, thread_sensitive=False)(func, *args)
+
+    def call_measured(self, func, *args):
+        with record_queries(self.metrics):
+            return func(*args)
+
+    async def authenticate(self, request):
+        """
+        :return: user of the request's JWT or AnonymousUser if it has none
+        """
+        user_auth = await self.run_sync(self.authentication.authenticate, request)
+        request.user = user_auth[0] if user_auth is not None else AnonymousUser()
+        return request.user
+
+    def handle_exception(self, exc, request):
+        if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+            exc.auth_header = self.authentication.authenticate_header(request)
+        return exception_handler(exc, {})
+
+
+class ChatListConsumer(APIConsumer):
+    """
+    Async ChatView.list
+    """
+    view_name = 'chats-view'
+
+    async def get_response(self, request, **kwargs):
+        user = await self.authenticate(request)
+        if not user.is_authenticated:
+            raise exceptions.NotAuthenticated()
+        return await self.run_sync(self.list_chats, request, user)
+
+    @staticmethod
+    def list_chats(request, user):
+        paginator = StandardPagination()
+        with replica_reads(request):
+            page = paginator.paginate_queryset(ChatView.get_list_queryset(), request)
+            return paginator.get_paginated_response(chat_rows(page, user.id))
+
+
+class MessageHistoryConsumer(APIConsumer):
+    """
+    Async MessageView.list
+    """
+    view_name = 'chat-messages-view'
+
+    async def get_response(self, request, pk):
+        user = await self.authenticate(request)
+        membership = await self.run_sync(get_membership_or_404, pk)
+
+        if user.id not in membership.participants:
+            return Response({'error': "you can't see messages in chat if you are not participants"},
+                            status.HTTP_403_FORBIDDEN)
+
+        return await self.run_sync(self.list_messages, request, membership.chat_id)
+
+    @staticmethod
+    def list_messages(request, chat_id):
+        paginator = MessageCursorPagination()
+        with replica_reads(request):
+            etag = history_etag(request, chat_id)
+            response = not_modified(request, etag)
+            if response is not None:
+                return response
+            page = paginator.paginate_tiers(MessageView.get_history_tiers(chat_id), request)
+        with measure_serialization(request):
+            data = message_rows(page)
+        response = paginator.get_paginated_response(data)
+        if etag is not None:
+            response['ETag'] = etag
+        return response
+
+
+class MessagePollConsumer(APIConsumer):
+    """
+    Async MessageView.poll. The request waits on the event loop, so idle
+    polls hold neither a thread nor a database connection, and is woken
+    through the channel layer by messages sent to any node.
+    """
+    view_name = 'chat-messages-poll-view'
+
+    async def get_response(self, request, pk):
+        user = await self.authenticate(request)
+        membership = await self.run_sync(get_membership_or_404, pk)
+
+        if user.id not in membership.participants:
+            return Response({'error': "you can't see messages in chat if you are not participants"},
+                            status.HTTP_403_FORBIDDEN)
+
+        timeout = MessageView.get_poll_timeout(request)
+        if timeout is None:
+            return Response({'error': 'timeout must be a number'}, status.HTTP_400_BAD_REQUEST)
+
+        paginator = MessageCursorPagination()
+        tiers = MessageView.get_history_tiers(membership.chat_id)
+        async with message_notifier.listen_async(membership.chat_id) as wait:
+            page = await self.run_sync(paginator.paginate_tiers, tiers, request)
+            if not page and await wait(timeout):
+                page = await self.run_sync(paginator.paginate_tiers, tiers, request)
+
+        with measure_serialization(request):
+            data = message_rows(page)
+        return paginator.get_paginated_response(data)
+
+
+class MessageSendConsumer(APIConsumer):
+    """
+    Async MessageView.create
+    """
+    view_name = 'create-message-view'
+
+    async def get_response(self, request, **kwargs):
+        user = await self.authenticate(request)
+        await self.run_sync(check_throttles, request, [MessageSendThrottle()])
+        text = request.data.get('text')
+        chat_id = request.data.get('chat_id')
+
+        if text is None or chat_id is None:
+            return Response({'error': 'chat_id and text are required'},
+                            status.HTTP_400_BAD_REQUEST)
+
+        membership = await self.run_sync(get_membership, chat_id)
+        if membership is None:
+            return Response({'error': 'chat with such id does not exist'},
+                            status.HTTP_400_BAD_REQUEST)
+
+        if user.id not in membership.participants:
+            return Response({'error': "You can't send messages to chats where are you not participate"},
+                            status.HTTP_403_FORBIDDEN)
+
+        await self.run_sync(check_throttles, request, [ChatMessageThrottle(membership.chat_id)])
+        await self.run_sync(MessageView.store_message, user, text, membership.chat_id)
+        pin_to_primary(request)
+
+        return Response({'status': 'messages has been sent'}, status.HTTP_201_CREATED)
@@ -0,0 +1,72 @@
+"""
+NDJSON export of chat history for compliance and backups.
+
+Messages are read with chunked iterators, which use server-side cursors
+on PostgreSQL, and encoded into buffers of about BUFFER_SIZE bytes, so
+memory stays flat however long the history is.
+"""
+import zlib
+from itertools import chain
+
+from .listings import MESSAGE_VALUES
+from .models import ArchivedMessage, Message
+from .renderers import FastJSONRenderer
+
+EXPORT_VALUES = MESSAGE_VALUES + ('seq',)
+
+# rows fetched from the database at once
+CHUNK_SIZE = 2000
+# bytes collected before a chunk is sent
+BUFFER_SIZE = 64 * 1024
+
+
+def history_rows(chat_id):
+    """
+    :return: iterator of `.values(*EXPORT_VALUES)` rows of the chat's
+    archived and hot messages, oldest first
+    """
+    hot = Message.objects.filter(chat_id=chat_id).order_by('time', 'id') \
+        .values(*EXPORT_VALUES).iterator(chunk_size=CHUNK_SIZE)
+    # open the hot cursor before the archive one: a message archived in
+    # between is then read from both, and skipped in the hot tier below
+    first = next(hot, None)
+    archived = ArchivedMessage.objects.filter(chat_id=chat_id).order_by('time', 'id') \
+        .values(*EXPORT_VALUES).iterator(chunk_size=CHUNK_SIZE)
+
+    last = None
+    for row in archived:
+        last = (row['time'], row['id'])
+        yield row
+    for row in chain([first] if first is not None else [], hot):
+        if last is None or (row['time'], row['id']) > last:
+            yield row
+
+
+def export_chunks(chat_ids, compress=False):
+    """
+    :param chat_ids: iterable of ids of the chats to export, in order
+    :param compress: gzip the output
+    :return: iterator of byte strings with one JSON message per line
+    """
+    render = FastJSONRenderer().render
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+    buffer = bytearray()
+
+    def encode(data):
+        return compressor.compress(data) if compressor is not None else data
+
+    for chat_id in chat_ids:
+        for row in history_rows(chat_id):
+            buffer += render(row)
+            buffer += b'\n'
+            if len(buffer) >= BUFFER_SIZE:
+                chunk = encode(bytes(buffer))
+                buffer.clear()
+                if chunk:
+                    yield chunk
+
+    chunk = encode(bytes(buffer))
+    if compressor is not None:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
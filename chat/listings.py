@@ -0,0 +1,55 @@
+"""
+Serializer-free builders for list responses. They read `.values()` rows
+and produce exactly what MessageSerializer and ChatSerializer would, without
+building a field tree per row.
+"""
+from django.contrib.auth.admin import User
+from rest_framework import serializers
+
+from .models import ChatReadState
+from .serializers import MessageSerializer
+
+MESSAGE_VALUES = ('id',) + MessageSerializer.Meta.fields
+
+_time_field = serializers.DateTimeField()
+
+
+def message_rows(messages):
+    """
+    :param messages: dicts from queryset.values(*MESSAGE_VALUES)
+    :return: list of MessageSerializer compatible dicts
+    """
+    to_representation = _time_field.to_representation
+    return [{
+        'sender': message['sender'],
+        'text': message['text'],
+        'chat': message['chat'],
+        'time': to_representation(message['time']),
+        'is_edited': message['is_edited']
+    } for message in messages]
+
+
+def chat_rows(chats, user_id):
+    """
+    Fetch participants and unread counts of all chats with two queries.
+    :param chats: (id, is_private, message_count) tuples
+    :param user_id: id of the user to count unread messages for
+    :return: list of ChatSerializer compatible dicts
+    """
+    participants = {chat_id: [] for chat_id, _, _ in chats}
+    member_of = {}
+    users = User.objects.filter(chat__id__in=participants) \
+        .values_list('chat__id', 'id', 'username', 'email')
+    for chat_id, participant_id, username, email in users:
+        participants[chat_id].append({'username': username, 'email': email})
+        if participant_id == user_id:
+            member_of[chat_id] = True
+
+    unread_counts = ChatReadState.unread_counts(user_id, {
+        chat_id: message_count for chat_id, _, message_count in chats if chat_id in member_of})
+
+    return [{
+        'participants': participants[chat_id],
+        'is_private': is_private,
+        'unread_count': unread_counts.get(chat_id)
+    } for chat_id, is_private, _ in chats]
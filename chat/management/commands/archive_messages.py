@@ -0,0 +1,59 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from chat.listings import MESSAGE_VALUES
+from chat.models import Chat, Message, ArchivedMessage
+
+
+class Command(BaseCommand):
+    help = 'Move messages older than the given age from the message table to the archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.MESSAGE_ARCHIVE_AFTER_DAYS,
+                            help='archive messages older than this many days')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='number of messages moved per transaction')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        batch_size = options['batch_size']
+        total = 0
+
+        for chat_id in Chat.objects.order_by('id').values_list('id', flat=True).iterator():
+            moved = self.archive_chat(chat_id, cutoff, batch_size)
+            if moved:
+                self.stdout.write('chat {0}: archived {1} messages'.format(chat_id, moved))
+            total += moved
+
+        self.stdout.write(self.style.SUCCESS('Archived {0} messages older than {1}'.format(
+            total, cutoff.isoformat())))
+
+    @staticmethod
+    def archive_chat(chat_id, cutoff, batch_size):
+        """
+        Move old messages of one chat, oldest first, one batch per transaction,
+        so the history endpoint always sees each message in exactly one tier.
+        """
+        moved = 0
+        while True:
+            with transaction.atomic():
+                batch = list(Message.objects.filter(chat_id=chat_id, time__lt=cutoff)
+                             .order_by('time', 'id').values(*MESSAGE_VALUES, 'seq')[:batch_size])
+                if not batch:
+                    return moved
+
+                ArchivedMessage.objects.bulk_create([ArchivedMessage(
+                    id=message['id'],
+                    sender_id=message['sender'],
+                    text=message['text'],
+                    chat_id=message['chat'],
+                    time=message['time'],
+                    is_edited=message['is_edited'],
+                    seq=message['seq']
+                ) for message in batch])
+                Message.objects.filter(id__in=[message['id'] for message in batch]).delete()
+            moved += len(batch)
@@ -0,0 +1,49 @@
+from django.contrib.auth.admin import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count, Max, OuterRef, Subquery
+
+from chat.models import Message, OutboxEvent, UserActivity
+from chat.outbox import MESSAGE_CREATED
+
+
+class Command(BaseCommand):
+    help = 'Rebuild per-user activity stats from the message table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='number of stats rows inserted per query')
+
+    def handle(self, *args, **options):
+        last_chat = Message.objects.filter(sender=OuterRef('pk')) \
+            .order_by('-time', '-id').values('chat_id')[:1]
+        users = User.objects.annotate(
+            message_count=Count('message'),
+            last_message_time=Max('message__time'),
+            last_chat_id=Subquery(last_chat)
+        ).filter(message_count__gt=0).values_list(
+            'id', 'message_count', 'last_message_time', 'last_chat_id')
+
+        stats = (UserActivity(user_id=user_id,
+                              message_count=message_count,
+                              last_message_time=last_message_time,
+                              last_chat_id=last_chat_id)
+                 for user_id, message_count, last_message_time, last_chat_id
+                 in users.iterator())
+
+        with transaction.atomic():
+            # Pending message.created events are for messages the stats
+            # below already count, so they are dropped in the same
+            # transaction. New events can't be enqueued until it commits:
+            # on SQLite the delete takes the database's write lock, on
+            # PostgreSQL the table lock does.
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('LOCK TABLE {0} IN SHARE ROW EXCLUSIVE MODE'.format(
+                        connection.ops.quote_name(OutboxEvent._meta.db_table)))
+            OutboxEvent.objects.filter(event=MESSAGE_CREATED).delete()
+            UserActivity.objects.all().delete()
+            created = UserActivity.objects.bulk_create(stats, batch_size=options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt activity stats for {0} users'.format(len(created))))
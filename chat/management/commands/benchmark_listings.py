@@ -0,0 +1,56 @@
+import timeit
+from datetime import datetime, timedelta
+
+import pytz
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from chat.listings import message_rows
+from chat.models import Message
+from chat.renderers import FastJSONRenderer
+from chat.serializers import MessageSerializer
+
+
+class Command(BaseCommand):
+    help = 'Compare serializer and serializer-free rendering of a message history page'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000,
+                            help='number of messages in the rendered list')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='number of timed renders per variant')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        repeat = options['repeat']
+        start = datetime(2019, 6, 1, tzinfo=pytz.utc)
+
+        values = [{
+            'id': i,
+            'sender': i % 50 + 1,
+            'text': 'message number {0} with some text in it'.format(i),
+            'chat': 1,
+            'time': start + timedelta(seconds=i, microseconds=i),
+            'is_edited': i % 7 == 0
+        } for i in range(rows)]
+        messages = [Message(id=value['id'], sender_id=value['sender'], text=value['text'],
+                            chat_id=value['chat'], time=value['time'], is_edited=value['is_edited'])
+                    for value in values]
+
+        def serializer_path():
+            return JSONRenderer().render(MessageSerializer(messages, many=True).data)
+
+        def fast_path():
+            return FastJSONRenderer().render(message_rows(values))
+
+        if serializer_path() != fast_path():
+            self.stderr.write(self.style.ERROR('Rendered outputs differ'))
+            return
+
+        serializer_time = min(timeit.repeat(serializer_path, number=1, repeat=repeat))
+        fast_time = min(timeit.repeat(fast_path, number=1, repeat=repeat))
+
+        self.stdout.write('{0} messages, best of {1}'.format(rows, repeat))
+        self.stdout.write('{0:<34}{1:8.2f} ms'.format('serializer + JSONRenderer', serializer_time * 1000))
+        self.stdout.write('{0:<34}{1:8.2f} ms'.format('message_rows + FastJSONRenderer', fast_time * 1000))
+        self.stdout.write(self.style.SUCCESS('speedup: {0:.1f}x'.format(serializer_time / fast_time)))
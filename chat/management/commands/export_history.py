@@ -0,0 +1,55 @@
+import sys
+
+from django.contrib.auth.admin import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.export import export_chunks
+from chat.models import Chat
+
+
+class Command(BaseCommand):
+    help = 'Write the message history of chats as NDJSON, one message per line'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chat', type=int, action='append', default=[],
+                            help='id of a chat to export, may be repeated')
+        parser.add_argument('--user',
+                            help='export all chats this username participates in')
+        parser.add_argument('--output', default='-',
+                            help="output file, '-' for stdout")
+        parser.add_argument('--gzip', action='store_true',
+                            help='compress the output, implied by an output file ending with .gz')
+
+    def handle(self, *args, **options):
+        chat_ids = list(options['chat'])
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError('user {0!r} does not exist'.format(options['user']))
+            chat_ids.extend(Chat.participants.through.objects.filter(user=user)
+                            .order_by('chat_id').values_list('chat_id', flat=True))
+        elif not chat_ids:
+            raise CommandError('--chat or --user is required')
+
+        missing = set(chat_ids) - set(Chat.objects.filter(id__in=chat_ids).values_list('id', flat=True))
+        if missing:
+            raise CommandError('chats {0} do not exist'.format(', '.join(map(str, sorted(missing)))))
+
+        path = options['output']
+        compress = options['gzip'] or path.endswith('.gz')
+        output = sys.stdout.buffer if path == '-' else open(path, 'wb')
+        try:
+            written = 0
+            for chunk in export_chunks(dict.fromkeys(chat_ids), compress):
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if path == '-':
+                output.flush()
+            else:
+                output.close()
+
+        if path != '-':
+            self.stdout.write(self.style.SUCCESS('Exported {0} chats to {1} ({2} bytes)'.format(
+                len(set(chat_ids)), path, written)))
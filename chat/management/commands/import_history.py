@@ -0,0 +1,254 @@
+import csv
+import json
+import os
+import sys
+from collections import OrderedDict
+
+from django.contrib.auth.admin import User
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from chat.models import ArchivedMessage, Chat, ImportCheckpoint, ImportedChat, Message
+
+TRUE_VALUES = ('1', 'true', 'yes')
+
+
+class Command(BaseCommand):
+    help = 'Load users, chats and messages from an NDJSON or CSV stream'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="input file, '-' for stdin")
+        parser.add_argument('--format', choices=('ndjson', 'csv'),
+                            help='input format, by default guessed from the file extension')
+        parser.add_argument('--source',
+                            help='name of the checkpoint to resume from, by default the absolute path')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='number of records loaded per transaction')
+
+    def handle(self, *args, **options):
+        """
+        Every record has a `type` of user, chat or message and may only
+        refer to records before it:
+        user: username, email, password hashed by any of PASSWORD_HASHERS,
+        none for an unusable password
+        chat: key unique in the source, is_private, participants as a list
+        of usernames (space separated in CSV), private chats of two users
+        that already have one are merged into it
+        message: chat key, sender username, text, ISO 8601 time, no older
+        than the messages before it in the chat, imported or not
+        Consecutive records of one type are loaded with bulk inserts, and
+        the position in the source is committed with every batch, so an
+        interrupted import continues after the last loaded batch.
+        """
+        path = options['path']
+        if path == '-' and not options['source']:
+            raise CommandError('--source is required to read from stdin')
+        source = options['source'] or os.path.abspath(path)
+        fmt = options['format'] or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+
+        checkpoint, _ = ImportCheckpoint.objects.get_or_create(source=source)
+        if checkpoint.position:
+            self.stdout.write('Resuming {0} after {1} records'.format(source, checkpoint.position))
+
+        self.user_ids = dict(User.objects.values_list('username', 'id').iterator())
+        self.chat_ids = dict(ImportedChat.objects.filter(source=source).values_list('key', 'chat_id'))
+        self.loaded = OrderedDict((kind, 0) for kind in ('user', 'chat', 'message'))
+        self.checkpoint = checkpoint
+
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            records = self.read_csv(stream) if fmt == 'csv' else self.read_ndjson(stream)
+            self.load(records, options['batch_size'], options['verbosity'])
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        self.stdout.write(self.style.SUCCESS('Imported {0}'.format(', '.join(
+            '{0} {1}s'.format(count, kind) for kind, count in self.loaded.items()))))
+        if self.loaded['message']:
+            self.stdout.write('Run backfill_user_activity to update activity stats of the senders')
+
+    @staticmethod
+    def read_ndjson(stream):
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as exc:
+                raise CommandError('line {0}: {1}'.format(number, exc))
+            if not isinstance(record, dict):
+                raise CommandError('line {0}: expected an object'.format(number))
+            yield record
+
+    @staticmethod
+    def read_csv(stream):
+        for row in csv.DictReader(stream):
+            record = {name: value for name, value in row.items() if name and value not in (None, '')}
+            if 'participants' in record:
+                record['participants'] = record['participants'].split()
+            if 'is_private' in record:
+                record['is_private'] = record['is_private'].lower() in TRUE_VALUES
+            yield record
+
+    def load(self, records, batch_size, verbosity):
+        loaders = {'user': self.load_users, 'chat': self.load_chats, 'message': self.load_messages}
+        kind, batch, position = None, [], 0
+        for position, record in enumerate(records, 1):
+            if position <= self.checkpoint.position:
+                continue
+            if record.get('type') not in loaders:
+                raise CommandError('record {0}: unknown type {1!r}'.format(position, record.get('type')))
+            if batch and (record['type'] != kind or len(batch) >= batch_size):
+                self.flush(loaders[kind], kind, batch, position - 1, verbosity)
+                batch = []
+            kind = record['type']
+            batch.append((position, record))
+        if batch:
+            self.flush(loaders[kind], kind, batch, position, verbosity)
+
+    def flush(self, loader, kind, batch, position, verbosity):
+        with transaction.atomic():
+            loader(batch)
+            self.checkpoint.position = position
+            self.checkpoint.save(update_fields=['position', 'updated'])
+        self.loaded[kind] += len(batch)
+        if verbosity > 1:
+            self.stdout.write('{0} records loaded'.format(position))
+
+    def load_users(self, batch):
+        users = []
+        for position, record in batch:
+            password = record.get('password')
+            if password is None:
+                password = make_password(None)
+            else:
+                try:
+                    identify_hasher(password)
+                except ValueError:
+                    raise CommandError('record {0}: password must be hashed'.format(position))
+            users.append(User(username=self.require(position, record, 'username'),
+                              email=record.get('email', ''),
+                              password=password,
+                              date_joined=self.parse_time(position, record.get('date_joined'))))
+
+        # users that already exist are kept as they are
+        User.objects.bulk_create(users, ignore_conflicts=True)
+        self.user_ids.update(User.objects.filter(username__in=[user.username for user in users])
+                             .values_list('username', 'id'))
+
+    def load_chats(self, batch):
+        keys, chats, participants = [], [], []
+        for position, record in batch:
+            key = str(self.require(position, record, 'key'))
+            if key in self.chat_ids or key in keys:
+                raise CommandError('record {0}: chat {1!r} was already imported'.format(position, key))
+            user_ids = sorted({self.user_id(position, username) for username in record.get('participants', [])})
+            is_private = bool(record.get('is_private', False))
+            pair_key = Chat.private_key(*user_ids) if is_private and len(user_ids) == 2 else None
+            keys.append(key)
+            chats.append(Chat(is_private=is_private, pair_key=pair_key))
+            participants.append(user_ids)
+
+        # private chats of a pair that already has one continue that chat
+        existing = Chat.objects.in_bulk([chat.pair_key for chat in chats if chat.pair_key], field_name='pair_key')
+        new_chats, new_participants = [], []
+        for index, (chat, user_ids) in enumerate(zip(chats, participants)):
+            if chat.pair_key in existing:
+                chats[index] = existing[chat.pair_key]
+                continue
+            if chat.pair_key is not None:
+                existing[chat.pair_key] = chat
+            new_chats.append(chat)
+            new_participants.append(user_ids)
+
+        if connection.features.can_return_ids_from_bulk_insert:
+            Chat.objects.bulk_create(new_chats)
+        else:
+            # e.g. SQLite, which doesn't report ids of bulk inserts
+            for chat in new_chats:
+                chat.save()
+
+        Chat.participants.through.objects.bulk_create([
+            Chat.participants.through(chat_id=chat.id, user_id=user_id)
+            for chat, user_ids in zip(new_chats, new_participants) for user_id in user_ids
+        ])
+        ImportedChat.objects.bulk_create([ImportedChat(source=self.checkpoint.source, key=key, chat=chat)
+                                          for key, chat in zip(keys, chats)])
+        self.chat_ids.update((key, chat.id) for key, chat in zip(keys, chats))
+
+    def load_messages(self, batch):
+        messages, keys = [], []
+        for position, record in batch:
+            key = str(self.require(position, record, 'chat'))
+            if key not in self.chat_ids:
+                raise CommandError('record {0}: unknown chat {1!r}'.format(position, key))
+            keys.append(key)
+            messages.append(Message(chat_id=self.chat_ids[key],
+                                    sender_id=self.user_id(position, self.require(position, record, 'sender')),
+                                    text=self.require(position, record, 'text'),
+                                    time=self.parse_time(position, record.get('time')),
+                                    is_edited=bool(record.get('is_edited', False))))
+
+        # Messages are only appended to the history: one older than the
+        # chat's newest message would get a seq out of order, and in the
+        # hot tier before archived messages, where history pages and the
+        # export don't expect it.
+        newest = self.newest_times({message.chat_id for message in messages})
+        for (position, _), key, message in zip(batch, keys, messages):
+            if message.chat_id in newest and message.time < newest[message.chat_id]:
+                raise CommandError('record {0}: message is older than the history of chat {1!r}'.format(
+                    position, key))
+            newest[message.chat_id] = message.time
+
+        # number the messages of every chat in the order of the source
+        by_chat = OrderedDict()
+        for message in messages:
+            by_chat.setdefault(message.chat_id, []).append(message)
+        for chat_id, chat_messages in by_chat.items():
+            first = Chat.allocate_seq(chat_id, len(chat_messages))
+            for seq, message in enumerate(chat_messages, first):
+                message.seq = seq
+
+        Message.objects.bulk_create(messages)
+
+    @staticmethod
+    def newest_times(chat_ids):
+        """
+        :return: dict of chat id to the time of its newest hot or archived
+        message, for the chats that have any
+        """
+        newest = {}
+        for model in (ArchivedMessage, Message):
+            rows = model.objects.filter(chat_id__in=chat_ids).values('chat_id') \
+                .annotate(newest=Max('time')).values_list('chat_id', 'newest')
+            for chat_id, time in rows:
+                newest[chat_id] = max(time, newest.get(chat_id, time))
+        return newest
+
+    @staticmethod
+    def require(position, record, field):
+        if record.get(field) in (None, ''):
+            raise CommandError('record {0}: {1} is required'.format(position, field))
+        return record[field]
+
+    def user_id(self, position, username):
+        if username not in self.user_ids:
+            raise CommandError('record {0}: unknown user {1!r}'.format(position, username))
+        return self.user_ids[username]
+
+    @staticmethod
+    def parse_time(position, value):
+        if value is None:
+            return timezone.now()
+        try:
+            time = parse_datetime(value) if isinstance(value, str) else None
+        except ValueError:
+            time = None
+        if time is None:
+            raise CommandError('record {0}: invalid time {1!r}'.format(position, value))
+        return timezone.make_aware(time, timezone.utc) if timezone.is_naive(time) else time
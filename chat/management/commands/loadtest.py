@@ -0,0 +1,290 @@
+import json
+import random
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_jwt.settings import api_settings
+
+from chat.models import Chat, Message, UserActivity
+
+PASSWORD = 'loadtest1234'
+
+ENDPOINTS = ('token', 'chat_list', 'chat_retrieve', 'message_history',
+             'message_send', 'participant_add', 'participant_remove')
+
+
+def percentile(values, percent):
+    """
+    :param values: sorted list of numbers
+    :return: nearest-rank percentile
+    """
+    if not values:
+        return None
+    rank = max(int(round(percent / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class Worker:
+    """
+    One simulated client: a member of its own group chat
+    with a pool of users it can add to and remove from it.
+    """
+    def __init__(self, user, chat_id, outsiders):
+        self.user = user
+        self.chat_id = chat_id
+        self.outsiders = outsiders
+        self.history_url = None
+        self.client = APIClient()
+        payload = api_settings.JWT_PAYLOAD_HANDLER(user)
+        token = api_settings.JWT_ENCODE_HANDLER(payload)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(token))
+
+    def token(self, i):
+        return APIClient().post(
+            reverse('obtain-token'), data={'username': self.user.username, 'password': PASSWORD})
+
+    def chat_list(self, i):
+        return self.client.get(reverse('chats-view'))
+
+    def chat_retrieve(self, i):
+        return self.client.get(reverse('get-chat-view', kwargs={'pk': self.chat_id}))
+
+    def message_history(self, i):
+        # walk deeper into the history on every request, restart at the end
+        url = self.history_url or reverse('chat-messages-view', kwargs={'pk': self.chat_id})
+        response = self.client.get(url)
+        self.history_url = response.data.get('next') if response.status_code == 200 else None
+        return response
+
+    def message_send(self, i):
+        return self.client.post(reverse('create-message-view'),
+                                data={'text': 'load test message {0}'.format(i), 'chat_id': self.chat_id})
+
+    def participant_add(self, i):
+        return self.client.post(reverse('chat-participants-view', kwargs={'pk': self.chat_id}),
+                                data={'user_id': self.outsiders[i]})
+
+    def participant_remove(self, i):
+        return self.client.delete(reverse('chat-participants-view', kwargs={'pk': self.chat_id}),
+                                  data={'user_id': self.outsiders[i]})
+
+    def run(self, endpoint, count):
+        """
+        :return: list of (seconds, queries, status code) tuples
+        """
+        action = getattr(self, endpoint)
+        samples = []
+        try:
+            for i in range(count):
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    try:
+                        status_code = action(i).status_code
+                    except Exception:
+                        # the test client re-raises exceptions of the view
+                        status_code = 500
+                    elapsed = time.perf_counter() - start
+                samples.append((elapsed, len(queries), status_code))
+        finally:
+            connection.close()
+        return samples
+
+
+class Command(BaseCommand):
+    help = 'Seed a benchmark dataset and measure latency of the main API endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--group-chats', type=int, default=100)
+        parser.add_argument('--group-size', type=int, default=20,
+                            help='participants of every group chat')
+        parser.add_argument('--private-chats', type=int, default=1000,
+                            help='private chats of random pairs, fewer if a pair is drawn twice')
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='messages generated and inserted at a time while seeding')
+        parser.add_argument('--prefix', default='loadtest',
+                            help='username prefix of the seeded users')
+        parser.add_argument('--no-seed', action='store_true',
+                            help='reuse a dataset seeded by a previous run')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='number of concurrent clients')
+        parser.add_argument('--requests', type=int, default=200,
+                            help='requests per endpoint, split between clients')
+        parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS)
+        parser.add_argument('--seed', type=int, default=0,
+                            help='random seed of the generated dataset')
+        parser.add_argument('--throttle', action='store_true',
+                            help='keep the configured throttle rates, by default throttles are off')
+        parser.add_argument('--json', dest='json_path',
+                            help="write results as JSON to this file, '-' for stdout")
+
+    def handle(self, *args, **options):
+        if options['group_size'] < 2:
+            raise CommandError('--group-size must be at least 2')
+
+        if not options['no_seed']:
+            if User.objects.filter(username__startswith=options['prefix'] + '-').exists():
+                raise CommandError('Users with prefix "{0}" already exist, pass --no-seed '
+                                   'to reuse them or a different --prefix'.format(options['prefix']))
+            started = time.perf_counter()
+            with transaction.atomic():
+                self.seed(options)
+            self.stdout.write('seeded in {0:.1f} s'.format(time.perf_counter() - started))
+
+        workers = self.get_workers(options)
+        results = {}
+        # every client sends far more than the rates allow a user, which
+        # would measure the 429 responses instead of the endpoints
+        rest_framework = dict(getattr(settings, 'REST_FRAMEWORK', {}))
+        if not options['throttle']:
+            rest_framework['DEFAULT_THROTTLE_RATES'] = {}
+        # requests are made in-process with the test client host
+        with override_settings(ALLOWED_HOSTS=['testserver'], REST_FRAMEWORK=rest_framework):
+            for endpoint in options['endpoints']:
+                results[endpoint] = self.measure(workers, endpoint, options['requests'])
+
+        self.report(results)
+        if options['json_path']:
+            output = json.dumps({
+                'database': connection.vendor,
+                'concurrency': len(workers),
+                'dataset': {name: options[name] for name in
+                            ('users', 'group_chats', 'group_size', 'private_chats', 'messages', 'seed')},
+                'seeded': not options['no_seed'],
+                'throttled': options['throttle'],
+                'endpoints': results
+            }, indent=2)
+            if options['json_path'] == '-':
+                self.stdout.write(output)
+            else:
+                with open(options['json_path'], 'w') as f:
+                    f.write(output)
+
+    def seed(self, options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        prefix = options['prefix']
+
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([User(username='{0}-{1}'.format(prefix, i), password=password)
+                                  for i in range(options['users'])])
+        user_ids = list(User.objects.filter(username__startswith=prefix + '-')
+                        .order_by('id').values_list('id', flat=True))
+        if len(user_ids) < options['group_size']:
+            raise CommandError('--users must not be less than --group-size')
+
+        # bulk_create doesn't return primary keys on every backend,
+        # so new chats are told apart by their ids
+        last_chat_id = Chat.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        Chat.objects.bulk_create([Chat(is_private=False) for _ in range(options['group_chats'])])
+        group_chats = Chat.objects.filter(id__gt=last_chat_id).order_by('id').values_list('id', flat=True)
+        members = {chat_id: rng.sample(user_ids, options['group_size']) for chat_id in group_chats}
+
+        Participants = Chat.participants.through
+        Participants.objects.bulk_create([Participants(chat_id=chat_id, user_id=user_id)
+                                          for chat_id, users in members.items() for user_id in users])
+
+        # keyed like the ones of the API, a pair drawn twice shares its chat
+        for _ in range(options['private_chats']):
+            pair = rng.sample(user_ids, 2)
+            chat_id = Chat.get_or_create_private(*pair)[0]
+            members[chat_id] = pair
+
+        chat_ids = list(members)
+        seqs = dict.fromkeys(chat_ids, 0)
+        activity = {}
+        remaining = options['messages']
+        while remaining > 0:
+            batch = []
+            for _ in range(min(batch_size, remaining)):
+                chat_id = rng.choice(chat_ids)
+                sender_id = rng.choice(members[chat_id])
+                seqs[chat_id] += 1
+                count, _ = activity.get(sender_id, (0, None))
+                activity[sender_id] = (count + 1, chat_id)
+                batch.append(Message(text='seeded message {0}'.format(seqs[chat_id]),
+                                     sender_id=sender_id, chat_id=chat_id, seq=seqs[chat_id]))
+            Message.objects.bulk_create(batch)
+            remaining -= len(batch)
+            self.stdout.write('messages left: {0}'.format(remaining), ending='\r')
+        self.stdout.write('')
+
+        Chat.objects.bulk_update([Chat(id=chat_id, message_count=count) for chat_id, count in seqs.items()],
+                                 ['message_count'])
+        now = timezone.now()
+        UserActivity.objects.bulk_create([
+            UserActivity(user_id=user_id, message_count=count, last_chat_id=chat_id, last_message_time=now)
+            for user_id, (count, chat_id) in activity.items()
+        ])
+
+    def get_workers(self, options):
+        prefix = options['prefix'] + '-'
+        user_ids = set(User.objects.filter(username__startswith=prefix).values_list('id', flat=True))
+        chats = list(Chat.objects.filter(is_private=False, participants__username__startswith=prefix)
+                     .distinct().order_by('id').prefetch_related('participants')[:options['concurrency']])
+        if len(chats) < options['concurrency']:
+            raise CommandError('Every client needs its own group chat, found {0}'.format(len(chats)))
+
+        # the same request count goes to every client, so every client needs that
+        # many users to add; they are removed again by participant_remove
+        per_worker = -(-options['requests'] // len(chats))
+        workers = []
+        for chat in chats:
+            participants = sorted(chat.participants.all(), key=lambda user: user.id)
+            members = {user.id for user in participants}
+            outsiders = sorted(user_ids - members)[:per_worker]
+            if len(outsiders) < per_worker and {'participant_add', 'participant_remove'} & set(options['endpoints']):
+                raise CommandError('Not enough users outside of chat {0} to add to it'.format(chat.id))
+            workers.append(Worker(participants[0], chat.id, outsiders))
+        return workers
+
+    def measure(self, workers, endpoint, requests):
+        counts = [requests // len(workers) + (i < requests % len(workers)) for i in range(len(workers))]
+
+        started = time.perf_counter()
+        if len(workers) == 1:
+            # keep single client runs on this thread and its connection
+            samples = [workers[0].run(endpoint, counts[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+                samples = list(executor.map(lambda args: args[0].run(endpoint, args[1]), zip(workers, counts)))
+        wall = time.perf_counter() - started
+
+        samples = [sample for worker_samples in samples for sample in worker_samples]
+        latencies = sorted(elapsed * 1000 for elapsed, _, _ in samples)
+        queries = [count for _, count, _ in samples]
+        return {
+            'requests': len(samples),
+            'errors': sum(1 for _, _, code in samples if code >= 400),
+            'status_codes': dict(Counter(str(code) for _, _, code in samples)),
+            'throughput': len(samples) / wall if wall else None,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'max_ms': latencies[-1] if latencies else None,
+            'queries_mean': sum(queries) / len(queries) if queries else None,
+            'queries_max': max(queries) if queries else None
+        }
+
+    def report(self, results):
+        header = '{0:<20}{1:>9}{2:>8}{3:>10}{4:>10}{5:>10}{6:>10}{7:>9}'
+        row = '{0:<20}{1:>9}{2:>8}{3:>10.1f}{4:>10.2f}{5:>10.2f}{6:>10.2f}{7:>9.1f}'
+        self.stdout.write(header.format('endpoint', 'requests', 'errors', 'req/s',
+                                        'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+        for endpoint, stats in results.items():
+            if not stats['requests']:
+                continue
+            self.stdout.write(row.format(endpoint, stats['requests'], stats['errors'], stats['throughput'],
+                                         stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+                                         stats['queries_mean']))
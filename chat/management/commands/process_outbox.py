@@ -0,0 +1,66 @@
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chat.outbox import process_batch
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of workers delivering outbox events to their handlers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='number of worker threads, more processes may run next to this one')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='number of events claimed at once by a worker')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='seconds a worker sleeps when there is nothing to deliver')
+        parser.add_argument('--once', action='store_true',
+                            help='exit as soon as no events are due instead of polling')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            # drain on this thread, e.g. from cron or tests
+            processed = self.drain(options['batch_size'])
+            self.stdout.write('Processed {0} events'.format(processed))
+            return
+
+        stop = threading.Event()
+        workers = [threading.Thread(target=self.work, args=(stop, options), daemon=True)
+                   for _ in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        self.stdout.write('Started {0} outbox workers'.format(len(workers)))
+        try:
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(timeout=1)
+        except KeyboardInterrupt:
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+    @staticmethod
+    def drain(batch_size):
+        processed = 0
+        while True:
+            claimed = process_batch(batch_size)
+            if not claimed:
+                return processed
+            processed += claimed
+
+    def work(self, stop, options):
+        try:
+            while not stop.is_set():
+                try:
+                    claimed = process_batch(options['batch_size'])
+                except Exception as exc:
+                    # e.g. the database went away, try again after a pause
+                    self.stderr.write('Outbox worker error: {0!r}'.format(exc))
+                    connection.close()
+                    claimed = 0
+                if not claimed:
+                    stop.wait(options['poll_interval'])
+        finally:
+            connection.close()
@@ -0,0 +1,110 @@
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from rest_framework.exceptions import NotFound
+
+from .models import Chat
+
+ChatMembership = namedtuple('ChatMembership', ('chat_id', 'is_private', 'participants'))
+
+
+def membership_cache_key(chat_id):
+    return 'chat-membership-{0}'.format(int(chat_id))
+
+
+def generation_cache_key(chat_id):
+    return 'chat-membership-generation-{0}'.format(int(chat_id))
+
+
+def get_membership(chat_id):
+    """
+    :param chat_id: chat id
+    :return: ChatMembership with the chat's privacy flag and the frozenset
+    of participant ids, or None if the chat does not exist
+    """
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        return None
+    key, generation_key = membership_cache_key(chat_id), generation_cache_key(chat_id)
+    cached = cache.get_many([key, generation_key])
+    # entries are tagged with the generation they were read in, so one
+    # read before a change and cached after it is never used
+    generation = cached.get(generation_key)
+    if key in cached and cached[key][0] == generation:
+        return cached[key][1]
+
+    # read from the primary: a lagging replica would get cached for the whole timeout
+    db = router.db_for_write(Chat)
+    try:
+        chat_id, is_private = Chat.objects.using(db).values_list('id', 'is_private').get(id=chat_id)
+    except Chat.DoesNotExist:
+        return None
+    participants = Chat.participants.through.objects.using(db) \
+        .filter(chat_id=chat_id).values_list('user_id', flat=True)
+    membership = ChatMembership(chat_id, is_private, frozenset(participants))
+    cache.set(key, (generation, membership), settings.CHAT_MEMBERSHIP_CACHE_TIMEOUT)
+    return membership
+
+
+def get_membership_or_404(chat_id):
+    membership = get_membership(chat_id)
+    if membership is None:
+        raise NotFound('chat with such id does not exist')
+    return membership
+
+
+def is_participant(chat_id, user_id):
+    membership = get_membership(chat_id)
+    return membership is not None and user_id in membership.participants
+
+
+def invalidate_membership(chat_id):
+    """
+    Drop cached membership and start a new generation now and again
+    after commit, so a reader that loaded the old state while the
+    transaction was open can't keep it.
+    """
+    key, generation_key = membership_cache_key(chat_id), generation_cache_key(chat_id)
+
+    def invalidate():
+        cache.delete(key)
+        cache.set(generation_key, uuid.uuid4().hex, None)
+
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+def chat_saved_or_deleted(sender, instance, **kwargs):
+    invalidate_membership(instance.id)
+
+
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        chat_ids = [instance.id] if action.startswith('post_') else []
+    elif action in ('post_add', 'post_remove'):
+        chat_ids = list(pk_set)
+    elif action == 'pre_clear':
+        # post_clear doesn't report which chats the user has left
+        chat_ids = list(instance.chat_set.values_list('id', flat=True))
+    else:
+        chat_ids = []
+
+    for chat_id in chat_ids:
+        invalidate_membership(chat_id)
+    if chat_ids:
+        # participants are part of the chat's representation
+        Chat.bump_version(chat_ids)
+        if action in ('post_remove', 'post_clear', 'pre_clear'):
+            # a keyed chat has just its pair, so anyone leaving breaks it
+            Chat.release_pair_keys(chat_ids)
+
+
+def connect_signals():
+    post_save.connect(chat_saved_or_deleted, sender=Chat)
+    post_delete.connect(chat_saved_or_deleted, sender=Chat)
+    m2m_changed.connect(participants_changed, sender=Chat.participants.through)
@@ -0,0 +1,55 @@
+from urllib.parse import parse_qs
+
+import jwt
+from channels.auth import UserLazyObject
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from rest_framework import exceptions
+from rest_framework_jwt import authentication
+from rest_framework_jwt.settings import api_settings
+
+
+def get_scope_token(scope):
+    """
+    :param scope: websocket connection scope
+    :return: JWT from the `token` query parameter or the Authorization
+    header, None if the connection carries no token
+    """
+    query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+    if query.get('token'):
+        return query['token'][0]
+
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            auth = value.decode('latin1').split()
+            if len(auth) == 2 and auth[0].lower() == api_settings.JWT_AUTH_HEADER_PREFIX.lower():
+                return auth[1]
+    return None
+
+
+@database_sync_to_async
+def get_jwt_user(scope):
+    token = get_scope_token(scope)
+    if token is None:
+        return AnonymousUser()
+
+    try:
+        payload = authentication.jwt_decode_handler(token)
+        return authentication.JSONWebTokenAuthentication().authenticate_credentials(payload)
+    except (jwt.InvalidTokenError, exceptions.AuthenticationFailed):
+        return AnonymousUser()
+
+
+class JSONWebTokenAuthMiddleware(BaseMiddleware):
+    """
+    Populates scope["user"] from the same JWT that
+    JSONWebTokenAuthentication accepts for HTTP requests.
+    """
+
+    def populate_scope(self, scope):
+        if 'user' not in scope:
+            scope['user'] = UserLazyObject()
+
+    async def resolve_scope(self, scope):
+        scope['user']._wrapped = await get_jwt_user(scope)
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 02:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_auto_20190613_1537'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'time', 'id'], name='chat_msg_chat_time_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'time'], name='chat_msg_sender_time_idx'),
+        ),
+    ]
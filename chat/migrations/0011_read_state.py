@@ -0,0 +1,77 @@
+# Generated by Django 2.2.28 on 2026-10-18 03:16
+
+from importlib import import_module
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def recreate_search_triggers(apps, schema_editor):
+    # adding a column rebuilds chat_message on SQLite, which drops the
+    # full-text index triggers created by 0009
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    search_index = import_module('chat.migrations.0009_message_search_index')
+    for statement in search_index.SQLITE_TRIGGERS:
+        schema_editor.execute(statement.replace('CREATE TRIGGER', 'CREATE TRIGGER IF NOT EXISTS'))
+
+
+def backfill_seq(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    Message = apps.get_model('chat', 'Message')
+    ArchivedMessage = apps.get_model('chat', 'ArchivedMessage')
+
+    for chat_id in Chat.objects.values_list('id', flat=True).iterator():
+        seq = 0
+        # archived messages are older than all hot ones
+        for model in (ArchivedMessage, Message):
+            batch = []
+            ids = model.objects.filter(chat_id=chat_id).order_by('time', 'id') \
+                .values_list('id', flat=True)
+            for message_id in ids.iterator():
+                seq += 1
+                batch.append(model(id=message_id, seq=seq))
+            model.objects.bulk_update(batch, ['seq'], batch_size=1000)
+        Chat.objects.filter(id=chat_id).update(message_count=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0010_archivedmessage'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, recreate_search_triggers),
+        migrations.AddField(
+            model_name='archivedmessage',
+            name='seq',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.CreateModel(
+            name='ChatReadState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_seq', models.PositiveIntegerField(default=0)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.Chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'chat')},
+            },
+        ),
+        migrations.RunPython(recreate_search_triggers, migrations.RunPython.noop),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+    ]
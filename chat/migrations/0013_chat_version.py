@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 03:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_outboxevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-18 03:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_chat_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255, unique=True)),
+                ('position', models.BigIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImportedChat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255)),
+                ('key', models.CharField(max_length=255)),
+                ('chat', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.Chat')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='importedchat',
+            constraint=models.UniqueConstraint(fields=('source', 'key'), name='chat_imported_chat_key'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 2.2.28 on 2026-10-18 03:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_pair_key(apps, schema_editor):
+    """
+    Key private chats of two users. Of duplicate chats of a pair only the
+    oldest gets the key, the others keep their history but are no longer
+    returned for the pair.
+    """
+    Chat = apps.get_model('chat', 'Chat')
+    rows = Chat.participants.through.objects.filter(chat__is_private=True) \
+        .order_by('chat_id', 'user_id').values_list('chat_id', 'user_id')
+
+    users = {}
+    for chat_id, user_id in rows.iterator():
+        users.setdefault(chat_id, []).append(user_id)
+
+    keyed, batch = set(), []
+    for chat_id in sorted(users):
+        if len(users[chat_id]) != 2:
+            continue
+        key = '{0}:{1}'.format(*users[chat_id])
+        if key not in keyed:
+            keyed.add(key)
+            batch.append(Chat(id=chat_id, pair_key=key))
+    Chat.objects.bulk_update(batch, ['pair_key'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_import_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='pair_key',
+            field=models.CharField(editable=False, max_length=41, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_pair_key, migrations.RunPython.noop),
+        # imported private chats may continue a chat that already exists
+        migrations.AlterField(
+            model_name='importedchat',
+            name='chat',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.Chat'),
+        ),
+    ]
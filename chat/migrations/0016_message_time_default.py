@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:01
+
+from importlib import import_module
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def recreate_search_triggers(apps, schema_editor):
+    # altering a column rebuilds chat_message on SQLite, which drops the
+    # full-text index triggers created by 0009
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    search_index = import_module('chat.migrations.0009_message_search_index')
+    for statement in search_index.SQLITE_TRIGGERS:
+        schema_editor.execute(statement.replace('CREATE TRIGGER', 'CREATE TRIGGER IF NOT EXISTS'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_chat_pair_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, recreate_search_triggers),
+        migrations.AlterField(
+            model_name='message',
+            name='time',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.RunPython(recreate_search_triggers, migrations.RunPython.noop),
+    ]
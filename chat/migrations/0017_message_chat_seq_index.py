@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0016_message_time_default'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'seq'], name='chat_msg_chat_seq_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+from importlib import import_module
+
+from django.db import migrations
+
+run_for_vendor = import_module('chat.migrations.0009_message_search_index').run_for_vendor
+
+# Same as the index of the hot tier in 0009, so archived messages stay
+# searchable. Recreate the triggers after any rebuild of ArchivedMessage.
+SQLITE_TRIGGERS = [
+    "CREATE TRIGGER chat_archivedmessage_fts_insert AFTER INSERT ON chat_archivedmessage BEGIN "
+    "INSERT INTO chat_archivedmessage_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER chat_archivedmessage_fts_delete AFTER DELETE ON chat_archivedmessage BEGIN "
+    "INSERT INTO chat_archivedmessage_fts(chat_archivedmessage_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER chat_archivedmessage_fts_update AFTER UPDATE OF text ON chat_archivedmessage BEGIN "
+    "INSERT INTO chat_archivedmessage_fts(chat_archivedmessage_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); "
+    "INSERT INTO chat_archivedmessage_fts(rowid, text) VALUES (new.id, new.text); END",
+]
+
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE chat_archivedmessage_fts USING fts5("
+    "text, content='chat_archivedmessage', content_rowid='id', tokenize='unicode61')",
+] + SQLITE_TRIGGERS + [
+    "INSERT INTO chat_archivedmessage_fts(chat_archivedmessage_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS chat_archivedmessage_fts_update",
+    "DROP TRIGGER IF EXISTS chat_archivedmessage_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_archivedmessage_fts_insert",
+    "DROP TABLE IF EXISTS chat_archivedmessage_fts",
+]
+
+POSTGRESQL_FORWARD = [
+    "CREATE INDEX chat_arch_text_search_idx ON chat_archivedmessage "
+    "USING GIN (to_tsvector('simple', text))",
+]
+
+POSTGRESQL_BACKWARD = [
+    "DROP INDEX IF EXISTS chat_arch_text_search_idx",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0017_message_chat_seq_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRESQL_FORWARD}),
+            run_for_vendor({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRESQL_BACKWARD}),
+        ),
+    ]
@@ -1,18 +1,248 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
 from django.contrib.auth.admin import User
 
 
 class Chat(models.Model):
     is_private = models.BooleanField()
     participants = models.ManyToManyField(User)
+    # sequence number of the last message sent to the chat
+    message_count = models.PositiveIntegerField(default=0)
+    # changes whenever messages or participants of the chat change, see chat.conditional
+    version = models.PositiveIntegerField(default=0)
+    # 'low id:high id' of the two users of a private chat, see get_or_create_private
+    pair_key = models.CharField(max_length=41, null=True, unique=True, editable=False)
+
+    @classmethod
+    def allocate_seq(cls, chat_id, count=1):
+        """
+        Reserve sequence numbers for new messages of a chat.
+        Must be called inside the transaction that saves the messages.
+        :return: the first reserved sequence number
+        """
+        cls.objects.filter(id=chat_id).update(message_count=F('message_count') + count,
+                                              version=F('version') + 1)
+        return cls.objects.values_list('message_count', flat=True).get(id=chat_id) - count + 1
+
+    @classmethod
+    def bump_version(cls, chat_ids):
+        cls.objects.filter(id__in=chat_ids).update(version=F('version') + 1)
+
+    @classmethod
+    def release_pair_keys(cls, chat_ids):
+        """
+        Clear the pair key of private chats a participant has left, so
+        get_or_create_private doesn't return them to the pair anymore.
+        """
+        cls.objects.filter(id__in=chat_ids, pair_key__isnull=False).update(pair_key=None)
+
+    @staticmethod
+    def private_key(user_id, other_id):
+        low, high = sorted((int(user_id), int(other_id)))
+        return '{0}:{1}'.format(low, high)
+
+    @classmethod
+    def get_or_create_private(cls, user_id, other_id):
+        """
+        Find the private chat of two users by its pair key or create it.
+        The unique key makes concurrent calls end up with the same chat.
+        :return: (chat id, whether it was created)
+        """
+        key = cls.private_key(user_id, other_id)
+        chat_id = cls.objects.filter(pair_key=key).values_list('id', flat=True).first()
+        if chat_id is not None:
+            return chat_id, False
+
+        try:
+            with transaction.atomic():
+                chat = cls.objects.create(is_private=True, pair_key=key)
+                chat.participants.add(user_id, other_id)
+        except IntegrityError:
+            # another request created it first
+            return cls.objects.filter(pair_key=key).values_list('id', flat=True).get(), False
+        return chat.id, True
 
 
 class Message(models.Model):
     text = models.TextField()
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
-    time = models.DateTimeField(auto_now_add=True)
+    # not auto_now_add, so imports can keep the original times
+    time = models.DateTimeField(default=timezone.now, editable=False)
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages')
     is_edited = models.BooleanField(default=False)
+    # position of the message in its chat, starting from 1
+    seq = models.PositiveIntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            # chat history, cursor pagination and last message of a chat
+            models.Index(fields=['chat', 'time', 'id'], name='chat_msg_chat_time_id_idx'),
+            # last message sent by a user
+            models.Index(fields=['sender', 'time'], name='chat_msg_sender_time_idx'),
+            # ids of bulk inserted messages on backends that don't return them
+            models.Index(fields=['chat', 'seq'], name='chat_msg_chat_seq_idx'),
+        ]
+
+
+class ArchivedMessage(models.Model):
+    """
+    Cold tier of chat history. Messages keep their ids when they are
+    moved here by the archive_messages command.
+    """
+    id = models.IntegerField(primary_key=True)
+    text = models.TextField()
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    time = models.DateTimeField()
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='archived_messages')
+    is_edited = models.BooleanField(default=False)
+    seq = models.PositiveIntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'time', 'id'], name='chat_arch_chat_time_id_idx'),
+        ]
+
+
+class ChatReadState(models.Model):
+    """
+    Read watermark of a participant: everything up to `last_read_seq`
+    has been read, so the unread count is chat.message_count - last_read_seq.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='read_states')
+    last_read_seq = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'chat')
+
+    @classmethod
+    def unread_counts(cls, user_id, message_counts):
+        """
+        :param user_id: reader id
+        :param message_counts: dict of chat id to chat.message_count
+        :return: dict of chat id to number of unread messages
+        """
+        read = dict(cls.objects.filter(user_id=user_id, chat_id__in=message_counts)
+                    .values_list('chat_id', 'last_read_seq'))
+        return {chat_id: max(message_count - read.get(chat_id, 0), 0)
+                for chat_id, message_count in message_counts.items()}
+
+    @classmethod
+    def advance(cls, user_id, chat_id, seq):
+        """
+        Move the watermark forward to `seq`, never backward.
+        """
+        if cls.objects.filter(user_id=user_id, chat_id=chat_id, last_read_seq__lt=seq) \
+                .update(last_read_seq=seq):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.get_or_create(user_id=user_id, chat_id=chat_id,
+                                          defaults={'last_read_seq': seq})
+        except IntegrityError:
+            # created by a concurrent request, retry the conditional update
+            cls.objects.filter(user_id=user_id, chat_id=chat_id, last_read_seq__lt=seq) \
+                .update(last_read_seq=seq)
+
+
+class UserActivityManager(models.Manager):
+    def record_message(self, message):
+        """
+        Account a stored message in its sender's stats.
+        :param message: saved message object
+        """
+        self.record_messages(message.sender_id, [message])
+
+    def record_messages(self, sender_id, messages):
+        """
+        Account stored messages of one sender in their stats. Runs in the
+        outbox worker, so every message must be accounted exactly once.
+        :param sender_id: id of the user who sent the messages
+        :param messages: saved message objects in the order they were sent
+        """
+        if not messages:
+            return
+        last_message = max(messages, key=lambda message: message.time)
+        # events may be delivered out of order, keep the newest message
+        newer = Q(last_message_time__isnull=True) | Q(last_message_time__lt=last_message.time)
+        time = Value(last_message.time, output_field=models.DateTimeField())
+        values = {
+            'last_message_time': Case(When(newer, then=time), default=F('last_message_time')),
+            'message_count': F('message_count') + len(messages),
+            'last_chat_id': Case(When(newer, then=Value(last_message.chat_id)), default=F('last_chat_id'))
+        }
+        if self.filter(user_id=sender_id).update(**values):
+            return
+
+        try:
+            with transaction.atomic():
+                self.create(user_id=sender_id,
+                            last_message_time=last_message.time,
+                            message_count=len(messages),
+                            last_chat_id=last_message.chat_id)
+        except IntegrityError:
+            # stats row was created by a concurrent send
+            self.filter(user_id=sender_id).update(**values)
+
+
+class UserActivity(models.Model):
+    """
+    Denormalized per-user messaging stats, maintained from the outbox
+    after every send, see chat.outbox.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE,
+                                primary_key=True, related_name='activity')
+    last_message_time = models.DateTimeField(null=True)
+    message_count = models.PositiveIntegerField(default=0)
+    last_chat = models.ForeignKey(Chat, on_delete=models.SET_NULL,
+                                  null=True, related_name='+')
+
+    objects = UserActivityManager()
+
+
+class OutboxEvent(models.Model):
+    """
+    Side effect of a change, written in the same transaction as the change
+    and carried out later by the process_outbox workers.
+    """
+    event = models.CharField(max_length=64)
+    payload = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    # next delivery attempt, None once all attempts have failed
+    available_at = models.DateTimeField(null=True, default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['available_at', 'id'], name='chat_outbox_available_idx'),
+        ]
+
+
+class ImportCheckpoint(models.Model):
+    """
+    Progress of import_history through a source, committed with every batch.
+    """
+    source = models.CharField(max_length=255, unique=True)
+    # number of records of the source already loaded
+    position = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class ImportedChat(models.Model):
+    """
+    Chat of a chat key of an import_history source, so messages of a
+    resumed import find the chats of earlier runs.
+    """
+    source = models.CharField(max_length=255)
+    key = models.CharField(max_length=255)
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'key'], name='chat_imported_chat_key'),
+        ]
 
 
 def get_last_message(self):
@@ -20,10 +250,10 @@ def get_last_message(self):
     :param self: user object
     :return: time of last message sent by user or None if no messages
     """
-    last_message = self.message_set.order_by('time').last()
-    if last_message is None:
+    try:
+        return self.activity.last_message_time
+    except UserActivity.DoesNotExist:
         return None
-    return last_message.time
 
 
 User.add_to_class('last_message_time', get_last_message)
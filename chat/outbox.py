@@ -0,0 +1,125 @@
+"""
+Transactional outbox for the side effects of sending messages.
+
+Requests only `enqueue` events, in the transaction that stores the
+change, and the process_outbox workers hand them to the handlers
+registered with `handler`. Delivery is at least once: a batch is claimed
+with row locks and its events are deleted in the transaction that ran
+the handlers, so database side effects happen exactly once, while
+external ones (pushes, webhooks) may repeat after a crash and have to
+be idempotent.
+
+Concurrent workers rely on select_for_update(skip_locked=True), which
+SQLite ignores. There they read the same batch and only the first to
+write commits, the others fail with "database is locked" and roll back,
+so run a single worker on SQLite.
+"""
+import json
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Message, OutboxEvent, UserActivity
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_CREATED = 'message.created'
+
+_handlers = {}
+
+
+def handler(event):
+    """
+    Register a function that takes a list of payloads of `event`.
+    Handlers of one event run together and are retried together.
+    """
+    def register(func):
+        _handlers.setdefault(event, []).append(func)
+        return func
+    return register
+
+
+def enqueue(event, payloads):
+    """
+    Store events with one insert. Should be called inside
+    the transaction that made the change they describe.
+    :param payloads: JSON serializable payloads, one per event
+    """
+    OutboxEvent.objects.bulk_create([OutboxEvent(event=event, payload=json.dumps(payload))
+                                     for payload in payloads])
+
+
+def message_payload(message):
+    return {
+        'id': message.id,
+        'chat_id': message.chat_id,
+        'sender_id': message.sender_id,
+        'time': message.time.isoformat()
+    }
+
+
+def retry_delay(attempts):
+    """
+    :return: exponential backoff before the next attempt
+    """
+    delay = settings.OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, settings.OUTBOX_MAX_RETRY_DELAY))
+
+
+def process_batch(batch_size):
+    """
+    Claim due events, run their handlers and delete the delivered ones.
+    Concurrent workers skip each other's locked rows.
+    :return: number of claimed events
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(OutboxEvent.objects.select_for_update(skip_locked=True)
+                      .filter(available_at__lte=now).order_by('available_at', 'id')[:batch_size])
+        if not events:
+            return 0
+
+        by_event = OrderedDict()
+        for event in events:
+            by_event.setdefault(event.event, []).append(event)
+
+        delivered, failed = [], []
+        for name, group in by_event.items():
+            try:
+                # a failing handler only rolls back its own group
+                with transaction.atomic():
+                    for func in _handlers.get(name, ()):
+                        func([json.loads(event.payload) for event in group])
+            except Exception as exc:
+                logger.exception('Outbox handler of %s failed', name)
+                for event in group:
+                    event.attempts += 1
+                    event.last_error = repr(exc)
+                    if event.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                        event.available_at = None
+                    else:
+                        event.available_at = now + retry_delay(event.attempts)
+                failed.extend(group)
+            else:
+                delivered.extend(group)
+
+        OutboxEvent.objects.filter(id__in=[event.id for event in delivered]).delete()
+        OutboxEvent.objects.bulk_update(failed, ['attempts', 'last_error', 'available_at'])
+    return len(events)
+
+
+@handler(MESSAGE_CREATED)
+def record_activity(payloads):
+    by_sender = OrderedDict()
+    for payload in payloads:
+        message = Message(id=payload['id'], chat_id=payload['chat_id'], sender_id=payload['sender_id'],
+                          time=parse_datetime(payload['time']))
+        by_sender.setdefault(message.sender_id, []).append(message)
+
+    for sender_id, messages in by_sender.items():
+        UserActivity.objects.record_messages(sender_id, messages)
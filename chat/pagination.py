@@ -1,6 +1,135 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
 from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 
 class StandardPagination(pagination.PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
+
+
+class MessageCursorPagination(pagination.BasePagination):
+    """
+    Keyset pagination over chat history ordered by (time, id).
+
+    Pages are always returned newest first. `before` walks to older
+    messages, `after` walks to newer ones, `limit` sets the page size.
+    Every page is a single index range scan, so its cost does not depend
+    on how deep into the history the client is.
+    """
+    before_query_param = 'before'
+    after_query_param = 'after'
+    limit_query_param = 'limit'
+    page_size = 50
+    max_page_size = 200
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.paginate_tiers([queryset], request)
+
+    def paginate_tiers(self, querysets, request):
+        """
+        Paginate over several querysets as if they were one, e.g. hot
+        messages and the archive. Every message of a tier must be newer
+        than all messages of the tiers that follow it.
+        :param querysets: tiers ordered from the newest to the oldest
+        """
+        self.request = request
+        self.limit = self.get_limit(request)
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(request.query_params.get(self.after_query_param))
+
+        page = []
+        if after is not None:
+            time, pk = after
+            for queryset in reversed(querysets):
+                # the redundant bound lets the (chat, time, id) index seek
+                # straight to the cursor instead of filtering from the end
+                queryset = queryset.filter(Q(time__gt=time) | Q(time=time, id__gt=pk),
+                                           time__gte=time)
+                page.extend(queryset.order_by('time', 'id')[:self.limit + 1 - len(page)])
+                if len(page) > self.limit:
+                    break
+            self.has_newer = len(page) > self.limit
+            self.has_older = True
+            page = page[:self.limit]
+            page.reverse()
+        else:
+            for queryset in querysets:
+                if before is not None:
+                    time, pk = before
+                    queryset = queryset.filter(Q(time__lt=time) | Q(time=time, id__lt=pk),
+                                               time__lte=time)
+                page.extend(queryset.order_by('-time', '-id')[:self.limit + 1 - len(page)])
+                if len(page) > self.limit:
+                    break
+            self.has_older = len(page) > self.limit
+            self.has_newer = before is not None
+            page = page[:self.limit]
+
+        self.page = page
+        return page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if limit <= 0:
+            return self.page_size
+        return min(limit, self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_older or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, self.before_query_param,
+                                   self.encode_cursor(self.page[-1]))
+
+    def get_previous_link(self):
+        if not self.has_newer or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        return replace_query_param(url, self.after_query_param,
+                                   self.encode_cursor(self.page[0]))
+
+    @staticmethod
+    def encode_cursor(message):
+        """
+        :param message: message object or a `.values()` row with time and id
+        """
+        if isinstance(message, dict):
+            time, pk = message['time'], message['id']
+        else:
+            time, pk = message.time, message.id
+        raw = '{0}|{1}'.format(time.isoformat(), pk)
+        return urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, encoded):
+        if encoded is None:
+            return None
+        try:
+            raw = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            time, pk = raw.rsplit('|', 1)
+            time = parse_datetime(time)
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if time is None:
+            raise NotFound(self.invalid_cursor_message)
+        return time, pk
@@ -0,0 +1,206 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import m2m_changed
+
+from .models import Chat
+from .serializers import MessageSerializer
+
+MESSAGE_CREATED = 'message.created'
+MESSAGE_EDITED = 'message.edited'
+
+
+class _ChatWaiters:
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock)
+        self.version = 0
+        self.count = 0
+        self.events = set()
+
+
+class MessageNotifier:
+    """
+    In-process broadcast of "chat has new messages" shared by all waiting
+    long-poll requests, so idle waiters do not query the database. Sync
+    waiters block their thread and are woken by messages created in this
+    process. Async ones block only their coroutine and also follow the
+    chat's group on the channel layer, so they are woken by any process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chats = {}
+
+    def _subscribe(self, chat_id):
+        with self._lock:
+            waiters = self._chats.get(chat_id)
+            if waiters is None:
+                waiters = self._chats[chat_id] = _ChatWaiters(self._lock)
+            waiters.count += 1
+            return waiters, waiters.version
+
+    def _unsubscribe(self, chat_id, waiters):
+        with self._lock:
+            waiters.count -= 1
+            if not waiters.count:
+                del self._chats[chat_id]
+
+    @contextmanager
+    def listen(self, chat_id):
+        """
+        Subscribe to new messages of a chat. Yields a function that blocks
+        until a message is created after subscribing or the timeout expires,
+        and returns whether a message was created.
+        :param chat_id: id of the chat to listen to
+        """
+        waiters, version = self._subscribe(chat_id)
+
+        def wait(timeout):
+            with self._lock:
+                return waiters.condition.wait_for(lambda: waiters.version != version, timeout)
+
+        try:
+            yield wait
+        finally:
+            self._unsubscribe(chat_id, waiters)
+
+    @asynccontextmanager
+    async def listen_async(self, chat_id):
+        """
+        listen for coroutines: yields a coroutine function that waits
+        without holding a thread.
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiters, version = self._subscribe(chat_id)
+        with self._lock:
+            if waiters.version != version:
+                event.set()
+            waiters.events.add((loop, event))
+
+        channel_layer = get_channel_layer()
+        feed = None
+        if channel_layer is not None:
+            channel = await channel_layer.new_channel()
+            await channel_layer.group_add(chat_group_name(chat_id), channel)
+            feed = asyncio.ensure_future(self._feed(channel_layer, channel, event))
+
+        async def wait(timeout):
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return event.is_set()
+
+        try:
+            yield wait
+        finally:
+            if feed is not None:
+                feed.cancel()
+                await channel_layer.group_discard(chat_group_name(chat_id), channel)
+            with self._lock:
+                waiters.events.discard((loop, event))
+            self._unsubscribe(chat_id, waiters)
+
+    @staticmethod
+    async def _feed(channel_layer, channel, event):
+        while True:
+            message = await channel_layer.receive(channel)
+            if message.get('event') == MESSAGE_CREATED:
+                event.set()
+                return
+
+    def notify(self, chat_id):
+        with self._lock:
+            waiters = self._chats.get(chat_id)
+            if waiters is not None:
+                waiters.version += 1
+                waiters.condition.notify_all()
+                for loop, event in waiters.events:
+                    loop.call_soon_threadsafe(event.set)
+
+
+message_notifier = MessageNotifier()
+
+
+def user_group_name(user_id):
+    return 'chat-user-{0}'.format(user_id)
+
+
+def chat_group_name(chat_id):
+    return 'chat-{0}'.format(chat_id)
+
+
+def publish_message(message, event):
+    """
+    Fan a message out to the websocket connections of all chat participants
+    through the chat's group on the configured channel layer and wake up
+    long-poll waiters once the current transaction commits.
+    :param message: saved message object
+    :param event: MESSAGE_CREATED or MESSAGE_EDITED
+    """
+    publish_messages([message], event)
+
+
+def publish_messages(messages, event):
+    """
+    publish_message for many saved messages with a single commit hook and
+    one group message per chat, however many participants it has.
+    """
+    payloads = {}
+    for message in messages:
+        payloads.setdefault(message.chat_id, []).append(dict(MessageSerializer(message).data, id=message.id))
+
+    def send():
+        if event == MESSAGE_CREATED:
+            for chat_id in payloads:
+                message_notifier.notify(chat_id)
+
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        for chat_id, chat_messages in payloads.items():
+            async_to_sync(channel_layer.group_send)(chat_group_name(chat_id), {
+                'type': 'chat.messages',
+                'event': event,
+                'messages': chat_messages
+            })
+
+    transaction.on_commit(send)
+
+
+def membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Tell the websocket connections of users who joined or left chats to
+    join or leave the groups of these chats.
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if action == 'pre_clear':
+        # post_clear doesn't report who has left
+        related = instance.chat_set if reverse else instance.participants
+        pk_set = set(related.values_list('id', flat=True))
+    if not pk_set:
+        return
+    user_ids, chat_ids = ([instance.id], sorted(pk_set)) if reverse else (sorted(pk_set), [instance.id])
+    payload = {
+        'type': 'chat.joined' if action == 'post_add' else 'chat.left',
+        'chat_ids': chat_ids
+    }
+
+    def send():
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        for user_id in user_ids:
+            async_to_sync(channel_layer.group_send)(user_group_name(user_id), payload)
+
+    transaction.on_commit(send)
+
+
+def connect_signals():
+    m2m_changed.connect(membership_changed, sender=Chat.participants.through)
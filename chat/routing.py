@@ -0,0 +1,40 @@
+from asgiref.sync import sync_to_async
+from channels.http import AsgiHandler
+from django.urls import path
+
+from . import consumers
+
+
+class ThreadPoolAsgiHandler(AsgiHandler):
+    """
+    AsgiHandler running each request in the thread pool. The stock one is
+    thread sensitive, so all Django requests of a process would queue for
+    a single thread behind any slow one.
+    """
+    handle = sync_to_async(AsgiHandler.__dict__['handle'].func, thread_sensitive=False)
+
+
+class MethodRouter:
+    """
+    Routes HTTP requests by method, e.g. to serve only the GET of a URL
+    with an async consumer and leave the rest to Django.
+    """
+
+    def __init__(self, default=ThreadPoolAsgiHandler, **methods):
+        self.default = default
+        self.methods = methods
+
+    def __call__(self, scope):
+        return self.methods.get(scope['method'], self.default)(scope)
+
+
+websocket_urlpatterns = [
+    path('ws/chats/', consumers.ChatConsumer, name='chat-updates-ws'),
+]
+
+http_urlpatterns = [
+    path('api/chats/', MethodRouter(GET=consumers.ChatListConsumer)),
+    path('api/chats/<int:pk>/messages/', MethodRouter(GET=consumers.MessageHistoryConsumer)),
+    path('api/chats/<int:pk>/messages/poll/', MethodRouter(GET=consumers.MessagePollConsumer)),
+    path('api/chats/messages/', MethodRouter(POST=consumers.MessageSendConsumer)),
+]
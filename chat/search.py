@@ -0,0 +1,107 @@
+"""
+Full-text search over message history, both the hot and the archived tier,
+backed by the FTS5 tables on SQLite and the GIN expression indexes on
+PostgreSQL (see migrations 0009 and 0018).
+"""
+import re
+
+from django.db import connection
+
+from .listings import MESSAGE_VALUES
+from .models import ArchivedMessage, Message
+
+# a message this many days old scores half of an equally relevant new one
+RECENCY_HALF_LIFE_DAYS = 30
+
+SEARCH_COLUMNS = 'm.id, m.sender_id, m.text, m.chat_id, m.time, m.is_edited'
+
+TIERS = ('chat_message', 'chat_archivedmessage')
+
+# lower bm25 scores are better
+SQLITE_TIER_SEARCH = '''
+    SELECT {columns}, bm25({table}_fts) / (1 + (julianday('now') - julianday(m.time)) / %s) AS score
+    FROM {table}_fts f
+    JOIN {table} m ON m.id = f.rowid
+    JOIN chat_chat_participants p ON p.chat_id = m.chat_id AND p.user_id = %s
+    WHERE {table}_fts MATCH %s {chat_filter}
+'''
+
+SQLITE_SEARCH = '''
+    SELECT * FROM ({tiers}) tiers
+    ORDER BY score, id DESC
+    LIMIT %s
+'''
+
+POSTGRESQL_TIER_SEARCH = '''
+    SELECT {columns}, ts_rank(to_tsvector('simple', m.text), plainto_tsquery('simple', %s))
+        / (1 + EXTRACT(EPOCH FROM now() - m.time) / 86400 / %s) AS score
+    FROM {table} m
+    JOIN chat_chat_participants p ON p.chat_id = m.chat_id AND p.user_id = %s
+    WHERE to_tsvector('simple', m.text) @@ plainto_tsquery('simple', %s) {chat_filter}
+'''
+
+POSTGRESQL_SEARCH = '''
+    SELECT * FROM ({tiers}) tiers
+    ORDER BY score DESC, id DESC
+    LIMIT %s
+'''
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query)
+
+
+def search_messages(user_id, query, limit, chat_id=None):
+    """
+    :param user_id: only chats this user participates in are searched
+    :param query: words that all have to appear in a message
+    :param limit: maximum number of results
+    :param chat_id: search in this chat only
+    :return: list of dicts with the same keys as `.values(*MESSAGE_VALUES)`,
+    best matches first
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+
+    chat_filter = 'AND m.chat_id = %s' if chat_id is not None else ''
+    chat_params = [chat_id] if chat_id is not None else []
+
+    if connection.vendor == 'sqlite':
+        match = ' '.join('"{0}"'.format(term) for term in terms)
+        tier_sql, sql = SQLITE_TIER_SEARCH, SQLITE_SEARCH
+        tier_params = [RECENCY_HALF_LIFE_DAYS, user_id, match]
+    elif connection.vendor == 'postgresql':
+        text = ' '.join(terms)
+        tier_sql, sql = POSTGRESQL_TIER_SEARCH, POSTGRESQL_SEARCH
+        tier_params = [text, RECENCY_HALF_LIFE_DAYS, user_id, text]
+    else:
+        return unindexed_search(user_id, terms, limit, chat_id)
+
+    # archived messages keep their ids, so the tiers never overlap
+    tiers = ' UNION ALL '.join(tier_sql.format(columns=SEARCH_COLUMNS, table=table, chat_filter=chat_filter)
+                               for table in TIERS)
+    sql = sql.format(tiers=tiers)
+    params = (tier_params + chat_params) * len(TIERS) + [limit]
+
+    messages = Message.objects.raw(sql, params)
+    return [{
+        'id': message.id,
+        'sender': message.sender_id,
+        'text': message.text,
+        'chat': message.chat_id,
+        'time': message.time,
+        'is_edited': message.is_edited
+    } for message in messages]
+
+
+def unindexed_search(user_id, terms, limit, chat_id=None):
+    tiers = []
+    for model in (Message, ArchivedMessage):
+        messages = model.objects.filter(chat__participants=user_id)
+        if chat_id is not None:
+            messages = messages.filter(chat_id=chat_id)
+        for term in terms:
+            messages = messages.filter(text__icontains=term)
+        tiers.append(messages.values(*MESSAGE_VALUES))
+    return list(tiers[0].union(tiers[1], all=True).order_by('-time', '-id')[:limit])
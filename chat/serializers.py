@@ -11,9 +11,40 @@ class MessageSerializer(serializers.ModelSerializer):
 
 
 class ChatSerializer(serializers.ModelSerializer):
+    """
+    Unread counts of the current user are passed as `unread_counts`
+    in the context, chats the user is not in have None.
+    """
     participants = UserSerializer(many=True)
+    unread_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Chat
-        fields = ('participants', 'is_private')
+        fields = ('participants', 'is_private', 'unread_count')
 
+    def get_unread_count(self, chat):
+        return self.context.get('unread_counts', {}).get(chat.id)
+
+
+class InboxChatSerializer(serializers.ModelSerializer):
+    """
+    Expects the chat to be annotated with `last_message_id`, the preview
+    messages to be passed as `last_messages` and unread counts as
+    `unread_counts` in the context.
+    """
+    participants = UserSerializer(many=True)
+    last_message = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Chat
+        fields = ('id', 'participants', 'is_private', 'last_message', 'unread_count')
+
+    def get_last_message(self, chat):
+        message = self.context['last_messages'].get(chat.last_message_id)
+        if message is None:
+            return None
+        return MessageSerializer(message).data
+
+    def get_unread_count(self, chat):
+        return self.context['unread_counts'].get(chat.id)
@@ -1,13 +1,52 @@
-from datetime import datetime
+import asyncio
+import csv
+import gzip
+import json
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from importlib import import_module
+from io import StringIO
+from unittest import mock, skipUnless
+from urllib.parse import urlencode
 
 import pytz
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.apps import apps
+from django.core.cache import cache
+from django.contrib.auth.hashers import make_password
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import Count
+from django.db.models.query import QuerySet
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth.admin import User
-from rest_framework.test import APITestCase
+from rest_framework.test import APITestCase, APITransactionTestCase
 from rest_framework import status
-
-from .models import Chat, Message
-from .serializers import MessageSerializer
+from rest_framework.renderers import JSONRenderer
+
+from MessengerAPI.metrics import HISTOGRAMS, SERIALIZE_DURATION
+from MessengerAPI.routers import ReplicaRouter, ReplicaRoutingMiddleware
+from MessengerAPI.routing import application
+from profiles.views import UserListView
+from . import outbox
+from .export import export_chunks, history_rows
+from .models import (Chat, Message, UserActivity, ArchivedMessage, OutboxEvent, ImportCheckpoint,
+                     ImportedChat)
+from .listings import MESSAGE_VALUES, message_rows, chat_rows
+from .membership import generation_cache_key, get_membership, membership_cache_key
+from .pagination import MessageCursorPagination
+from .realtime import MESSAGE_CREATED, MESSAGE_EDITED, MessageNotifier, chat_group_name
+from .renderers import FastJSONRenderer
+from .serializers import MessageSerializer, ChatSerializer
+from .throttling import TokenBucketThrottle, take
+from .views import ChatView, MessageView, ChatParticipantsView
 
 
 class GetChatTest(APITestCase):
@@ -38,7 +77,8 @@ class GetChatTest(APITestCase):
                 'username': user.username,
                 'email': user.email
             } for user in chat.participants.all()],
-            'is_private': chat.is_private
+            'is_private': chat.is_private,
+            'unread_count': 0
         } for chat in Chat.objects.all()]
 
         url = reverse('chats-view')
@@ -55,7 +95,8 @@ class GetChatTest(APITestCase):
                 'username': user.username,
                 'email': user.email
             } for user in chat.participants.all()],
-            'is_private': chat.is_private
+            'is_private': chat.is_private,
+            'unread_count': 0
         }
 
         url = reverse('get-chat-view', kwargs={'pk': chat.id})
@@ -249,6 +290,87 @@ class RemoveChatParticipantView(APITestCase):
         self.assertEquals(chat.participants.count(), 3)
 
 
+class BatchChatParticipantsTest(APITestCase):
+    def setUp(self):
+        User.objects.create_user(username='User1', password='testpass1234')
+        User.objects.bulk_create([User(username='User{0}'.format(i)) for i in range(2, 61)])
+
+        self.chat = Chat.objects.create(is_private=False)
+        self.chat.participants.add(1, 2)
+        self.url = reverse('chat-participants-view', kwargs={'pk': self.chat.id})
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(response.data['token']))
+
+    def participants(self):
+        return set(self.chat.participants.values_list('id', flat=True))
+
+    def test_add_many(self):
+        response = self.client.post(self.url, data={'user_ids': [3, 2, 4, 1000, 3]}, format='json')
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['results'], [
+            {'user_id': 3, 'result': 'user was added to this chat'},
+            {'user_id': 2, 'result': 'user is already in this chat'},
+            {'user_id': 4, 'result': 'user was added to this chat'},
+            {'user_id': 1000, 'result': 'user with such id does not exist'},
+        ])
+        self.assertEquals(self.participants(), {1, 2, 3, 4})
+        self.assertEquals(get_membership(self.chat.id).participants, {1, 2, 3, 4})
+
+    def test_remove_many(self):
+        self.chat.participants.add(3, 4)
+
+        response = self.client.delete(self.url, data={'user_ids': ['3', '4', '5']})
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([result['result'] for result in response.data['results']],
+                          ['user was deleted from this chat', 'user was deleted from this chat',
+                           'user is not in this chat'])
+        self.assertEquals(self.participants(), {1, 2})
+
+    def test_query_count_does_not_depend_on_batch_size(self):
+        # warm up the token and membership caches
+        self.client.post(self.url, data={'user_ids': [3]}, format='json')
+
+        counts = []
+        for user_ids in (list(range(4, 6)), list(range(6, 61))):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.post(self.url, data={'user_ids': user_ids}, format='json')
+            counts.append(len(queries.captured_queries))
+
+        self.assertEquals(counts[0], counts[1])
+        self.assertEquals(len(self.participants()), 60)
+
+    def test_changes_update_chat_version(self):
+        version = Chat.objects.get(id=self.chat.id).version
+
+        self.client.post(self.url, data={'user_ids': [3, 4]}, format='json')
+
+        self.assertEquals(Chat.objects.get(id=self.chat.id).version, version + 1)
+
+    def test_invalid_user_ids(self):
+        for user_ids in ([], ['a'], '3', [None]):
+            response = self.client.post(self.url, data={'user_ids': user_ids}, format='json')
+            self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with mock.patch.object(ChatParticipantsView, 'max_batch_size', 2):
+            response = self.client.post(self.url, data={'user_ids': [3, 4, 5]}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEquals(self.participants(), {1, 2})
+
+    def test_caller_must_participate(self):
+        self.chat.participants.remove(1)
+
+        for method in (self.client.post, self.client.delete):
+            response = method(self.url, data={'user_ids': [2, 3]}, format='json')
+            self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEquals(self.participants(), {2})
+
+
 class GetMessageTest(APITestCase):
     def setUp(self):
         user1 = User.objects.create_user(username='User1', password='testpass1234')
@@ -371,4 +493,1834 @@ class CreateMessageTest(APITestCase):
 
         self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
         self.assertEquals(response.data['error'],
-                          "You can't send messages to chats where are you not participate")
\ No newline at end of file
+                          "You can't send messages to chats where are you not participate")
+
+
+class GetChatMessagesTest(APITestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+
+        chat = Chat.objects.create(is_private=True)
+        chat.participants.add(user1, user2)
+
+        for i in range(5):
+            Message.objects.create(text='message {0}'.format(i), sender=user1, chat=chat)
+        # two messages share a timestamp so paging has to break the tie on id
+        Message.objects.filter(id__in=(2, 3)).update(time=datetime(2019, 6, 1, tzinfo=pytz.utc))
+        Message.objects.filter(id=1).update(time=datetime(2019, 5, 1, tzinfo=pytz.utc))
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        jwt_token = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(jwt_token))
+
+    def test_get_latest_page_successful(self):
+        url = reverse('chat-messages-view', kwargs={'pk': 1})
+        response = self.client.get(url, {'limit': 2})
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([msg['text'] for msg in response.data['results']],
+                          ['message 4', 'message 3'])
+        self.assertIsNone(response.data['previous'])
+        self.assertIsNotNone(response.data['next'])
+
+    def test_walk_history_backward_and_forward_successful(self):
+        url = reverse('chat-messages-view', kwargs={'pk': 1})
+        texts = []
+        response = self.client.get(url, {'limit': 2})
+        while True:
+            texts.extend(msg['text'] for msg in response.data['results'])
+            if response.data['next'] is None:
+                break
+            response = self.client.get(response.data['next'])
+
+        self.assertEquals(texts, ['message 4', 'message 3', 'message 2',
+                                  'message 1', 'message 0'])
+
+        response = self.client.get(response.data['previous'])
+        self.assertEquals([msg['text'] for msg in response.data['results']],
+                          ['message 2', 'message 1'])
+
+    def test_get_messages_invalid_cursor_fail(self):
+        url = reverse('chat-messages-view', kwargs={'pk': 1})
+        response = self.client.get(url, {'before': 'garbage'})
+
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_messages_you_are_not_participant_fail(self):
+        Chat.objects.get(id=1).participants.remove(User.objects.get(username='User1'))
+        url = reverse('chat-messages-view', kwargs={'pk': 1})
+        response = self.client.get(url)
+
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'query plans are checked against SQLite output')
+class MessageQueryPlanTest(APITestCase):
+    """
+    Explains the SQL the views and commands actually run.
+    """
+    def setUp(self):
+        user = User.objects.create_user(username='User1', password='testpass1234')
+        chat = Chat.objects.create(is_private=False)
+        chat.participants.add(user)
+        self.messages = [Message.objects.create(text='message {0}'.format(i), sender=user, chat=chat)
+                         for i in range(3)]
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(response.data['token']))
+
+    def history_query(self, table, **params):
+        """
+        :return: SQL of the history page query on `table`
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('chat-messages-view', kwargs={'pk': 1}), params)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        found = [query['sql'] for query in queries if 'FROM "{0}"'.format(table) in query['sql']]
+        self.assertEquals(len(found), 1)
+        return found[0]
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return '\n'.join(row[-1] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, sql, index_name):
+        plan = self.explain(sql)
+        self.assertIn('USING INDEX {0}'.format(index_name), plan)
+        self.assertNotIn('SCAN', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+        return plan
+
+    def test_chat_history_uses_chat_time_index(self):
+        sql = self.history_query('chat_message', limit=2)
+
+        self.assertUsesIndex(sql, 'chat_msg_chat_time_id_idx')
+
+    def test_chat_history_before_cursor_uses_chat_time_index(self):
+        cursor = MessageCursorPagination.encode_cursor(self.messages[2])
+        sql = self.history_query('chat_message', limit=1, before=cursor)
+
+        plan = self.assertUsesIndex(sql, 'chat_msg_chat_time_id_idx')
+        self.assertIn('time<?', plan)
+
+    def test_chat_history_after_cursor_uses_chat_time_index(self):
+        cursor = MessageCursorPagination.encode_cursor(self.messages[0])
+        sql = self.history_query('chat_message', limit=1, after=cursor)
+
+        plan = self.assertUsesIndex(sql, 'chat_msg_chat_time_id_idx')
+        self.assertIn('time>?', plan)
+
+    def test_archived_history_uses_archive_index(self):
+        sql = self.history_query('chat_archivedmessage', limit=10)
+
+        self.assertUsesIndex(sql, 'chat_arch_chat_time_id_idx')
+
+    def test_activity_backfill_uses_sender_time_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            call_command('backfill_user_activity', stdout=StringIO())
+        sql = next(query['sql'] for query in queries if 'FROM "auth_user"' in query['sql'])
+        plan = self.explain(sql)
+
+        # every user is visited, but their messages are only looked up by sender
+        self.assertIn('USING COVERING INDEX chat_msg_sender_time_idx', plan)
+        self.assertNotIn('SCAN chat_message', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class UserActivityTest(APITestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+
+        chat = Chat.objects.create(is_private=True)
+        chat.participants.add(user1, user2)
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        jwt_token = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(jwt_token))
+
+    def test_send_message_updates_activity_successful(self):
+        url = reverse('create-message-view')
+        self.client.post(url, data={'text': 'first', 'chat_id': 1})
+        self.client.post(url, data={'text': 'second', 'chat_id': 1})
+        call_command('process_outbox', once=True, stdout=StringIO())
+
+        activity = UserActivity.objects.get(user__username='User1')
+        last_message = Message.objects.get(text='second')
+        self.assertEquals(activity.message_count, 2)
+        self.assertEquals(activity.last_message_time, last_message.time)
+        self.assertEquals(activity.last_chat_id, 1)
+
+    def test_out_of_order_messages_keep_latest(self):
+        user1 = User.objects.get(username='User1')
+        other_chat = Chat.objects.create(is_private=False)
+        newer = Message.objects.create(text='newer', sender=user1, chat_id=1)
+        older = Message.objects.create(text='older', sender=user1, chat=other_chat,
+                                       time=newer.time - timedelta(minutes=1))
+
+        UserActivity.objects.record_message(newer)
+        UserActivity.objects.record_message(older)
+
+        activity = UserActivity.objects.get(user=user1)
+        self.assertEquals(activity.message_count, 2)
+        self.assertEquals(activity.last_message_time, newer.time)
+        self.assertEquals(activity.last_chat_id, 1)
+
+    def test_last_message_time_without_messages(self):
+        self.assertIsNone(User.objects.get(username='User2').last_message_time())
+
+    def test_backfill_user_activity_successful(self):
+        user1 = User.objects.get(username='User1')
+        user2 = User.objects.get(username='User2')
+        other_chat = Chat.objects.create(is_private=False)
+        other_chat.participants.add(user1)
+        Message.objects.create(text='hello', sender=user1, chat_id=1)
+        last_message = Message.objects.create(text='hello', sender=user1, chat=other_chat)
+        UserActivity.objects.create(user=user2, message_count=10)
+
+        call_command('backfill_user_activity', stdout=StringIO())
+
+        self.assertEquals(UserActivity.objects.count(), 1)
+        self.assertEquals(user1.activity.message_count, 2)
+        self.assertEquals(user1.activity.last_chat_id, other_chat.id)
+        self.assertEquals(User.objects.get(id=user1.id).last_message_time(), last_message.time)
+
+    def test_backfill_drops_pending_events(self):
+        url = reverse('create-message-view')
+        for text in ('first', 'second', 'third'):
+            self.client.post(url, data={'text': text, 'chat_id': 1})
+
+        call_command('backfill_user_activity', stdout=StringIO())
+        call_command('process_outbox', once=True, stdout=StringIO())
+
+        self.assertEquals(UserActivity.objects.get(user__username='User1').message_count, 3)
+
+
+class ChatInboxTest(APITestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+        user3 = User.objects.create_user(username='User3', password='testpass1234')
+
+        quiet_chat = Chat.objects.create(is_private=False)
+        quiet_chat.participants.add(user1, user2, user3)
+        old_chat = Chat.objects.create(is_private=True)
+        old_chat.participants.add(user1, user2)
+        new_chat = Chat.objects.create(is_private=True)
+        new_chat.participants.add(user1, user3)
+        foreign_chat = Chat.objects.create(is_private=True)
+        foreign_chat.participants.add(user2, user3)
+
+        Message.objects.create(text='old', sender=user2, chat=old_chat)
+        Message.objects.create(text='new', sender=user3, chat=new_chat)
+        Message.objects.create(text='foreign', sender=user3, chat=foreign_chat)
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        jwt_token = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(jwt_token))
+
+    def test_get_inbox_successful(self):
+        url = reverse('chat-inbox-view')
+        response = self.client.get(url)
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['count'], 3)
+        results = response.data['results']
+        self.assertEquals([chat['id'] for chat in results], [3, 2, 1])
+        self.assertEquals(results[0]['last_message']['text'], 'new')
+        self.assertEquals(results[1]['last_message']['text'], 'old')
+        self.assertIsNone(results[2]['last_message'])
+        self.assertEquals([user['username'] for user in results[2]['participants']],
+                          ['User1', 'User2', 'User3'])
+
+    def test_get_inbox_query_count_does_not_grow(self):
+        user1 = User.objects.get(username='User1')
+        for i in range(5):
+            user = User.objects.create_user(username='Extra{0}'.format(i))
+            chat = Chat.objects.create(is_private=False)
+            chat.participants.add(user1, user)
+            Message.objects.create(text='extra', sender=user, chat=chat)
+
+        url = reverse('chat-inbox-view')
+        # user, count, chats, participants, last messages, read states
+        with self.assertNumQueries(6):
+            response = self.client.get(url)
+
+        self.assertEquals(response.data['count'], 8)
+
+
+class ChatUpdatesWebsocketTest(APITransactionTestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+        User.objects.create_user(username='User3', password='testpass1234')
+
+        self.chat = Chat.objects.create(is_private=True)
+        self.chat.participants.add(user1, user2)
+
+        self.tokens = {}
+        for username in ('User1', 'User2', 'User3'):
+            response = self.client.post(reverse('obtain-token'),
+                                        data={'username': username,
+                                              'password': 'testpass1234'},
+                                        headers={'Content-Type': 'application/json'})
+            self.tokens[username] = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(self.tokens['User1']))
+
+    def connect(self, username):
+        return WebsocketCommunicator(application,
+                                     '/ws/chats/?token={0}'.format(self.tokens[username]))
+
+    def test_participant_receives_new_and_edited_messages(self):
+        async def scenario():
+            communicator = self.connect('User2')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            await sync_to_async(self.client.post)(reverse('create-message-view'),
+                                                  data={'text': 'Hello', 'chat_id': self.chat.id})
+            created = await communicator.receive_json_from()
+
+            message_id = created['message']['id']
+            await sync_to_async(self.client.put)(reverse('messages-view', kwargs={'pk': message_id}),
+                                                 data={'text': 'Hello!'})
+            edited = await communicator.receive_json_from()
+
+            await communicator.disconnect()
+            return created, edited
+
+        created, edited = async_to_sync(scenario)()
+
+        self.assertEquals(created['event'], 'message.created')
+        self.assertEquals(created['message']['text'], 'Hello')
+        self.assertEquals(created['message']['chat'], self.chat.id)
+        self.assertEquals(edited['event'], 'message.edited')
+        self.assertEquals(edited['message']['text'], 'Hello!')
+        self.assertTrue(edited['message']['is_edited'])
+
+    def test_non_participant_receives_nothing(self):
+        async def scenario():
+            communicator = self.connect('User3')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            await sync_to_async(self.client.post)(reverse('create-message-view'),
+                                                  data={'text': 'Hello', 'chat_id': self.chat.id})
+            nothing = await communicator.receive_nothing()
+
+            await communicator.disconnect()
+            return nothing
+
+        self.assertTrue(async_to_sync(scenario)())
+
+    def test_connection_follows_membership_changes(self):
+        user3 = User.objects.get(username='User3')
+
+        async def post(text):
+            await sync_to_async(self.client.post)(reverse('create-message-view'),
+                                                  data={'text': text, 'chat_id': self.chat.id})
+
+        async def scenario():
+            communicator = self.connect('User3')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            await sync_to_async(self.chat.participants.add)(user3)
+            await post('joined')
+            joined = await communicator.receive_json_from()
+
+            await sync_to_async(self.chat.participants.remove)(user3)
+            await post('left')
+            nothing = await communicator.receive_nothing()
+
+            await communicator.disconnect()
+            return joined, nothing
+
+        joined, nothing = async_to_sync(scenario)()
+
+        self.assertEquals(joined['message']['text'], 'joined')
+        self.assertTrue(nothing)
+
+    def test_connect_without_token_fail(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(application, '/ws/chats/')
+            connected, _ = await communicator.connect()
+            return connected
+
+        self.assertFalse(async_to_sync(scenario)())
+
+
+class PollChatMessagesTest(APITestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+
+        chat = Chat.objects.create(is_private=True)
+        chat.participants.add(user1, user2)
+        self.first = Message.objects.create(text='first', sender=user1, chat=chat)
+        self.second = Message.objects.create(text='second', sender=user2, chat=chat)
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        jwt_token = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(jwt_token))
+
+    def test_poll_returns_newer_messages_immediately(self):
+        url = reverse('chat-messages-poll-view', kwargs={'pk': 1})
+        cursor = MessageCursorPagination.encode_cursor(self.first)
+        response = self.client.get(url, {'after': cursor, 'timeout': 10})
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([msg['text'] for msg in response.data['results']], ['second'])
+
+    def test_poll_times_out_with_empty_page(self):
+        url = reverse('chat-messages-poll-view', kwargs={'pk': 1})
+        cursor = MessageCursorPagination.encode_cursor(self.second)
+        response = self.client.get(url, {'after': cursor, 'timeout': 0.1})
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['results'], [])
+
+    def test_poll_non_finite_timeout_fail(self):
+        url = reverse('chat-messages-poll-view', kwargs={'pk': 1})
+        for timeout in ('nan', 'inf', '-inf', 'abc'):
+            response = self.client.get(url, {'timeout': timeout})
+
+            self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_poll_you_are_not_participant_fail(self):
+        Chat.objects.get(id=1).participants.remove(User.objects.get(username='User1'))
+        url = reverse('chat-messages-poll-view', kwargs={'pk': 1})
+        response = self.client.get(url, {'timeout': 0})
+
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class MessageNotifierTest(TestCase):
+    def test_wait_wakes_up_on_notify(self):
+        notifier = MessageNotifier()
+        with notifier.listen(1) as wait:
+            threading.Timer(0.05, notifier.notify, args=(1,)).start()
+            self.assertTrue(wait(5))
+
+    def test_wait_ignores_other_chats(self):
+        notifier = MessageNotifier()
+        with notifier.listen(1) as wait:
+            notifier.notify(2)
+            self.assertFalse(wait(0.05))
+
+    def test_notify_before_wait_is_not_lost(self):
+        notifier = MessageNotifier()
+        with notifier.listen(1) as wait:
+            notifier.notify(1)
+            self.assertTrue(wait(0))
+        self.assertEquals(notifier._chats, {})
+
+    def test_async_wait_wakes_up_on_notify_from_thread(self):
+        notifier = MessageNotifier()
+
+        async def wait_for(chat_id, timeout):
+            async with notifier.listen_async(chat_id) as wait:
+                threading.Timer(0.05, notifier.notify, args=(1,)).start()
+                return await wait(timeout)
+
+        self.assertTrue(async_to_sync(wait_for)(1, 5))
+        self.assertFalse(async_to_sync(wait_for)(2, 0.1))
+        self.assertEquals(notifier._chats, {})
+
+    def test_async_wait_wakes_up_on_channel_layer_message(self):
+        notifier = MessageNotifier()
+        channel_layer = get_channel_layer()
+
+        async def wait_for(event):
+            async with notifier.listen_async(1) as wait:
+                # as published by another process
+                await channel_layer.group_send(chat_group_name(1), {
+                    'type': 'chat.messages', 'event': event, 'messages': []})
+                return await wait(0.5)
+
+        self.assertTrue(async_to_sync(wait_for)(MESSAGE_CREATED))
+        self.assertFalse(async_to_sync(wait_for)(MESSAGE_EDITED))
+        self.assertEquals(notifier._chats, {})
+
+
+class ChatMembershipCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+        User.objects.create_user(username='User3', password='testpass1234')
+
+        chat = Chat.objects.create(is_private=False)
+        chat.participants.add(user1, user2)
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        jwt_token = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(jwt_token))
+
+    def test_send_message_with_cached_membership(self):
+        membership = get_membership(1)
+        self.assertEquals(membership.participants, {1, 2})
+
+        url = reverse('create-message-view')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, data={'text': 'Hello', 'chat_id': 1})
+
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        for query in queries:
+            self.assertNotIn('chat_chat_participants', query['sql'])
+            self.assertNotIn('"chat_chat"."is_private"', query['sql'])
+
+    def test_add_participant_invalidates_membership(self):
+        get_membership(1)
+
+        url = reverse('chat-participants-view', kwargs={'pk': 1})
+        self.client.post(url, data={'user_id': 3})
+
+        self.assertIsNone(cache.get(membership_cache_key(1)))
+        self.assertEquals(get_membership(1).participants, {1, 2, 3})
+
+    def test_string_chat_id_shares_cache_entry(self):
+        get_membership('01')
+        Chat.objects.get(id=1).participants.add(3)
+
+        self.assertEquals(get_membership('01').participants, {1, 2, 3})
+
+    def test_read_before_change_is_not_used(self):
+        # a reader loads the membership while the change is not committed yet
+        generation = cache.get(generation_cache_key(1))
+        stale = get_membership(1)
+        Chat.objects.get(id=1).participants.add(3)
+        cache.set(membership_cache_key(1), (generation, stale))
+
+        self.assertEquals(get_membership(1).participants, {1, 2, 3})
+
+    def test_remove_participant_invalidates_membership(self):
+        get_membership(1)
+
+        url = reverse('chat-participants-view', kwargs={'pk': 1})
+        self.client.delete(url, data={'user_id': 2})
+
+        self.assertEquals(get_membership(1).participants, {1})
+
+    def test_removed_user_can_not_send(self):
+        get_membership(1)
+        User.objects.get(username='User1').chat_set.clear()
+
+        url = reverse('create-message-view')
+        response = self.client.post(url, data={'text': 'Hello', 'chat_id': 1})
+
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_get_messages_chat_does_not_exist_fail(self):
+        url = reverse('chat-messages-view', kwargs={'pk': 42})
+        response = self.client.get(url)
+
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class BatchCreateMessageTest(APITestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+
+        chat1 = Chat.objects.create(is_private=True)
+        chat1.participants.add(user1, user2)
+        chat2 = Chat.objects.create(is_private=False)
+        chat2.participants.add(user1, user2)
+        chat3 = Chat.objects.create(is_private=False)
+        chat3.participants.add(user2)
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        jwt_token = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(jwt_token))
+
+    def test_batch_send_messages_successful(self):
+        url = reverse('batch-create-message-view')
+        data = {'messages': [
+            {'text': 'first', 'chat_id': 1},
+            {'text': 'second', 'chat_id': 2},
+            {'text': 'third', 'chat_id': 1},
+        ]}
+        response = self.client.post(url, data=data, format='json')
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([item['status'] for item in response.data['results']], [201, 201, 201])
+        self.assertEquals(Chat.objects.get(id=1).messages.count(), 2)
+        self.assertEquals(Chat.objects.get(id=2).messages.count(), 1)
+        call_command('process_outbox', once=True, stdout=StringIO())
+        activity = UserActivity.objects.get(user__username='User1')
+        self.assertEquals(activity.message_count, 3)
+        self.assertEquals(activity.last_chat_id, 1)
+
+    def test_batch_send_reports_message_ids(self):
+        url = reverse('batch-create-message-view')
+        data = {'messages': [{'text': str(i), 'chat_id': 1 + i % 2} for i in range(4)]}
+        group_send = mock.AsyncMock()
+
+        with mock.patch('chat.realtime.transaction.on_commit') as on_commit:
+            self.client.post(url, data=data, format='json')
+        with mock.patch('chat.realtime.get_channel_layer', return_value=mock.Mock(group_send=group_send)):
+            for call in on_commit.call_args_list:
+                call[0][0]()
+
+        ids = {message.text: message.id for message in Message.objects.all()}
+        self.assertEquals(on_commit.call_count, 1)
+        self.assertEquals(sorted(json.loads(event.payload)['id'] for event in OutboxEvent.objects.all()),
+                          sorted(ids.values()))
+        published = {message['text']: message['id']
+                     for call in group_send.call_args_list for message in call[0][1]['messages']}
+        self.assertEquals(published, ids)
+        # one group message per chat, not per message and participant
+        self.assertEquals(sorted(call[0][0] for call in group_send.call_args_list), ['chat-1', 'chat-2'])
+
+    def test_batch_send_reports_per_item_errors(self):
+        url = reverse('batch-create-message-view')
+        data = {'messages': [
+            {'text': 'first', 'chat_id': 1},
+            {'text': 'not a member', 'chat_id': 3},
+            {'text': 'no such chat', 'chat_id': 42},
+            {'chat_id': 1},
+        ]}
+        response = self.client.post(url, data=data, format='json')
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([item['status'] for item in response.data['results']], [201, 403, 403, 400])
+        self.assertEquals(Message.objects.count(), 1)
+
+    def test_batch_send_query_count_does_not_grow(self):
+        url = reverse('batch-create-message-view')
+
+        def send(count):
+            data = {'messages': [{'text': str(i), 'chat_id': 1 + i % 2} for i in range(count)]}
+            with CaptureQueriesContext(connection) as queries:
+                self.client.post(url, data=data, format='json')
+            return len(queries)
+
+        send(2)
+        self.assertEquals(send(2), send(50))
+        self.assertEquals(Message.objects.count(), 54)
+
+    def test_batch_send_without_messages_fail(self):
+        url = reverse('batch-create-message-view')
+        response = self.client.post(url, data={'messages': []}, format='json')
+
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class FastListingTest(TestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', email='user1@example.com')
+        user2 = User.objects.create_user(username='Юзер2')
+
+        chat1 = Chat.objects.create(is_private=True)
+        chat1.participants.add(user1, user2)
+        chat2 = Chat.objects.create(is_private=False)
+        chat2.participants.add(user2)
+
+        Message.objects.create(text='hello', sender=user1, chat=chat1)
+        Message.objects.create(text='привет \u2028 "quoted"', sender=user2, chat=chat1)
+        Message.objects.create(text='edited', sender=user2, chat=chat2, is_edited=True)
+
+    def test_message_rows_render_same_bytes_as_serializer(self):
+        messages = Message.objects.order_by('-time', '-id')
+        expected = JSONRenderer().render(MessageSerializer(messages, many=True).data)
+        actual = FastJSONRenderer().render(message_rows(messages.values(*MESSAGE_VALUES)))
+
+        self.assertEqual(actual, expected)
+
+    def test_chat_rows_render_same_bytes_as_serializer(self):
+        Chat.objects.filter(id=1).update(message_count=2)
+        chats = Chat.objects.prefetch_related('participants').order_by('id')
+        unread_counts = {1: 2}
+        expected = JSONRenderer().render(
+            ChatSerializer(chats, many=True, context={'unread_counts': unread_counts}).data)
+        rows = list(chats.values_list('id', 'is_private', 'message_count'))
+        actual = FastJSONRenderer().render(chat_rows(rows, 1))
+
+        self.assertEqual(actual, expected)
+
+    def test_fast_renderer_falls_back_for_indented_output(self):
+        data = {'text': 'hello'}
+        expected = JSONRenderer().render(data, 'application/json; indent=4')
+
+        self.assertEqual(FastJSONRenderer().render(data, 'application/json; indent=4'), expected)
+
+
+class SearchMessagesTest(APITestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+
+        chat1 = Chat.objects.create(is_private=True)
+        chat1.participants.add(user1, user2)
+        chat2 = Chat.objects.create(is_private=False)
+        chat2.participants.add(user1, user2)
+        foreign_chat = Chat.objects.create(is_private=True)
+        foreign_chat.participants.add(user2)
+
+        old = Message.objects.create(text='release planning for the new release', sender=user2, chat=chat1)
+        Message.objects.filter(id=old.id).update(time=datetime(2019, 1, 1, tzinfo=pytz.utc))
+        Message.objects.create(text='release notes are ready', sender=user2, chat=chat2)
+        Message.objects.create(text='lunch?', sender=user1, chat=chat1)
+        Message.objects.create(text='secret release date', sender=user2, chat=foreign_chat)
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        jwt_token = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(jwt_token))
+
+    def test_search_only_in_own_chats(self):
+        url = reverse('search-messages-view')
+        response = self.client.get(url, {'q': 'release'})
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([msg['text'] for msg in response.data['results']],
+                          ['release notes are ready', 'release planning for the new release'])
+
+    def test_search_in_one_chat(self):
+        url = reverse('search-messages-view')
+        response = self.client.get(url, {'q': 'release', 'chat_id': 1})
+
+        self.assertEquals([msg['text'] for msg in response.data['results']],
+                          ['release planning for the new release'])
+
+    def test_search_sees_edited_text(self):
+        message = Message.objects.get(text='lunch?')
+        url = reverse('messages-view', kwargs={'pk': message.id})
+        self.client.put(url, data={'text': 'dinner?'})
+
+        url = reverse('search-messages-view')
+        self.assertEquals(self.client.get(url, {'q': 'lunch'}).data['results'], [])
+        self.assertEquals(len(self.client.get(url, {'q': 'dinner'}).data['results']), 1)
+
+    def test_search_result_cursor_opens_history(self):
+        url = reverse('search-messages-view')
+        result = self.client.get(url, {'q': 'planning'}).data['results'][0]
+
+        url = reverse('chat-messages-view', kwargs={'pk': result['chat']})
+        response = self.client.get(url, {'after': result['cursor']})
+
+        self.assertEquals([msg['text'] for msg in response.data['results']], ['lunch?'])
+
+    def test_search_ignores_query_syntax(self):
+        url = reverse('search-messages-view')
+        response = self.client.get(url, {'q': 'release" (notes*'})
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([msg['text'] for msg in response.data['results']],
+                          ['release notes are ready'])
+
+    def test_search_without_query_fail(self):
+        url = reverse('search-messages-view')
+        response = self.client.get(url)
+
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ArchiveMessagesTest(APITestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+
+        chat = Chat.objects.create(is_private=True)
+        chat.participants.add(user1, user2)
+        other_chat = Chat.objects.create(is_private=True)
+        other_chat.participants.add(user1, user2)
+
+        for i in range(6):
+            Message.objects.create(text='message {0}'.format(i), sender=user1, chat=chat)
+        Message.objects.filter(id__in=(1, 2, 3)).update(time=datetime(2018, 1, 1, tzinfo=pytz.utc))
+        old = Message.objects.create(text='other chat', sender=user2, chat=other_chat)
+        Message.objects.filter(id=old.id).update(time=datetime(2018, 1, 1, tzinfo=pytz.utc))
+
+        call_command('archive_messages', days=30, batch_size=2, stdout=StringIO())
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        jwt_token = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(jwt_token))
+
+    def test_old_messages_are_moved(self):
+        self.assertEquals(Message.objects.count(), 3)
+        self.assertEquals(sorted(ArchivedMessage.objects.values_list('id', flat=True)), [1, 2, 3, 7])
+
+    def test_history_reads_through_archive(self):
+        url = reverse('chat-messages-view', kwargs={'pk': 1})
+        texts = []
+        response = self.client.get(url, {'limit': 2})
+        while True:
+            texts.extend(msg['text'] for msg in response.data['results'])
+            if response.data['next'] is None:
+                break
+            response = self.client.get(response.data['next'])
+
+        self.assertEquals(texts, ['message 5', 'message 4', 'message 3',
+                                  'message 2', 'message 1', 'message 0'])
+
+        # and forward from the archive into the hot tier
+        response = self.client.get(response.data['previous'])
+        self.assertEquals([msg['text'] for msg in response.data['results']],
+                          ['message 3', 'message 2'])
+        response = self.client.get(response.data['previous'])
+        self.assertEquals([msg['text'] for msg in response.data['results']],
+                          ['message 5', 'message 4'])
+        self.assertIsNone(response.data['previous'])
+
+    def test_search_finds_archived_messages(self):
+        url = reverse('search-messages-view')
+        response = self.client.get(url, {'q': 'message'})
+
+        self.assertEquals([msg['text'] for msg in response.data['results']],
+                          ['message 5', 'message 4', 'message 3', 'message 2', 'message 1', 'message 0'])
+
+        response = self.client.get(url, {'q': 'other chat'})
+        self.assertEquals([msg['text'] for msg in response.data['results']], ['other chat'])
+
+    def test_inbox_previews_archived_message(self):
+        response = self.client.get(reverse('chat-inbox-view'))
+
+        results = response.data['results']
+        self.assertEquals([chat['id'] for chat in results], [1, 2])
+        self.assertEquals(results[0]['last_message']['text'], 'message 5')
+        self.assertEquals(results[1]['last_message']['text'], 'other chat')
+
+    def test_get_archived_message(self):
+        url = reverse('messages-view', kwargs={'pk': 1})
+        response = self.client.get(url)
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['text'], 'message 0')
+
+
+class ReadStateTest(APITestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+        User.objects.create_user(username='User3', password='testpass1234')
+
+        chat = Chat.objects.create(is_private=True)
+        chat.participants.add(user1, user2)
+
+        self.tokens = {}
+        for username in ('User1', 'User2'):
+            response = self.client.post(reverse('obtain-token'),
+                                        data={'username': username,
+                                              'password': 'testpass1234'},
+                                        headers={'Content-Type': 'application/json'})
+            self.tokens[username] = response.data['token']
+
+        self.login('User2')
+        for i in range(3):
+            self.client.post(reverse('create-message-view'), data={'text': str(i), 'chat_id': 1})
+        self.login('User1')
+
+    def login(self, username):
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(self.tokens[username]))
+
+    def unread_count(self):
+        response = self.client.get(reverse('get-chat-view', kwargs={'pk': 1}))
+        return response.data['unread_count']
+
+    def test_new_messages_are_unread(self):
+        self.assertEquals(self.unread_count(), 3)
+
+        response = self.client.get(reverse('chat-inbox-view'))
+        self.assertEquals(response.data['results'][0]['unread_count'], 3)
+
+        response = self.client.get(reverse('chats-view'))
+        self.assertEquals(response.data['results'][0]['unread_count'], 3)
+
+    def test_own_messages_are_read(self):
+        self.login('User2')
+        self.assertEquals(self.unread_count(), 0)
+
+    def test_mark_read_up_to_message(self):
+        url = reverse('chat-read-view', kwargs={'pk': 1})
+        response = self.client.post(url, data={'message_id': 2})
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(self.unread_count(), 1)
+
+        # watermark never moves back
+        self.client.post(url, data={'message_id': 1})
+        self.assertEquals(self.unread_count(), 1)
+
+    def test_mark_all_read_then_new_message(self):
+        self.client.post(reverse('chat-read-view', kwargs={'pk': 1}))
+        self.assertEquals(self.unread_count(), 0)
+
+        self.login('User2')
+        self.client.post(reverse('create-message-view'), data={'text': 'new', 'chat_id': 1})
+        self.login('User1')
+        self.assertEquals(self.unread_count(), 1)
+
+    def test_unread_count_does_not_count_messages(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.unread_count()
+
+        for query in queries:
+            self.assertNotIn('chat_message', query['sql'])
+
+    def test_mark_read_message_from_other_chat_fail(self):
+        other_chat = Chat.objects.create(is_private=False)
+        other_chat.participants.add(User.objects.get(username='User1'))
+        message = Message.objects.create(text='other', sender_id=1, chat=other_chat, seq=1)
+
+        url = reverse('chat-read-view', kwargs={'pk': 1})
+        response = self.client.post(url, data={'message_id': message.id})
+
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class LoadTestCommandTest(TestCase):
+    def test_seed_and_measure(self):
+        with tempfile.NamedTemporaryFile(mode='r', suffix='.json') as output:
+            call_command('loadtest', users=30, group_chats=2, group_size=5, private_chats=3,
+                         messages=120, batch_size=50, concurrency=1, requests=4,
+                         json_path=output.name, stdout=StringIO())
+            results = json.load(output)
+
+        self.assertEquals(User.objects.filter(username__startswith='loadtest-').count(), 30)
+        self.assertEquals(Message.objects.count(), 120 + 4)
+        self.assertEquals(sorted(Chat.objects.values_list('message_count', flat=True)),
+                          sorted(Message.objects.values('chat').annotate(Count('id'))
+                                 .values_list('id__count', flat=True)))
+        self.assertEquals(set(results['endpoints']), {'token', 'chat_list', 'chat_retrieve', 'message_history',
+                                                      'message_send', 'participant_add', 'participant_remove'})
+        for stats in results['endpoints'].values():
+            self.assertEquals(stats['requests'], 4)
+            self.assertEquals(stats['errors'], 0)
+            self.assertGreater(stats['queries_mean'], 0)
+
+        private_chats = Chat.objects.filter(is_private=True).prefetch_related('participants')
+        self.assertTrue(private_chats)
+        for chat in private_chats:
+            self.assertEquals(chat.pair_key, Chat.private_key(*[user.id for user in chat.participants.all()]))
+
+    @override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': {
+        'message_send': '2/min', 'chat_message_send': '2/min', 'chat_create': '1/min'}})
+    def test_throttles_are_off_unless_asked_for(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        def send_errors(**options):
+            with tempfile.NamedTemporaryFile(mode='r', suffix='.json') as output:
+                call_command('loadtest', users=10, group_chats=1, group_size=5, private_chats=0, messages=0,
+                             concurrency=1, requests=5, endpoints=['message_send'],
+                             json_path=output.name, stdout=StringIO(), **options)
+                return json.load(output)['endpoints']['message_send']['errors']
+
+        self.assertEquals(send_errors(), 0)
+        self.assertEquals(send_errors(no_seed=True, throttle=True), 3)
+
+
+class ImportHistoryCommandTest(TestCase):
+    def setUp(self):
+        User.objects.create_user(username='existing', password='testpass1234')
+        self.password = make_password('imported1234')
+        self.records = [
+            {'type': 'user', 'username': 'alice', 'email': 'alice@example.com', 'password': self.password},
+            {'type': 'user', 'username': 'bob'},
+            {'type': 'user', 'username': 'existing', 'email': 'changed@example.com'},
+            {'type': 'chat', 'key': 'general', 'is_private': False,
+             'participants': ['alice', 'bob', 'existing']},
+            {'type': 'chat', 'key': 'dm', 'is_private': True, 'participants': ['alice', 'bob']},
+        ] + [
+            {'type': 'message', 'chat': 'general' if i % 3 else 'dm', 'sender': 'alice' if i % 2 else 'bob',
+             'text': 'message {0}'.format(i), 'time': '2019-06-01T12:00:{0:02d}Z'.format(i)}
+            for i in range(10)
+        ]
+
+    def import_records(self, records, fmt='ndjson', **options):
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.' + fmt, newline='') as source:
+            if fmt == 'csv':
+                fields = ('type', 'username', 'email', 'password', 'key', 'is_private', 'participants',
+                          'chat', 'sender', 'text', 'time')
+                writer = csv.DictWriter(source, fields)
+                writer.writeheader()
+                for record in records:
+                    row = dict(record)
+                    if 'participants' in row:
+                        row['participants'] = ' '.join(row['participants'])
+                    writer.writerow(row)
+            else:
+                for record in records:
+                    source.write(json.dumps(record) + '\n')
+            source.flush()
+            options.setdefault('source', 'test')
+            call_command('import_history', source.name, stdout=StringIO(), **options)
+
+    def assertImported(self):
+        self.assertTrue(User.objects.get(username='alice').check_password('imported1234'))
+        self.assertFalse(User.objects.get(username='bob').has_usable_password())
+        self.assertEquals(User.objects.get(username='existing').email, '')
+
+        general = ImportedChat.objects.get(source='test', key='general').chat
+        dm = ImportedChat.objects.get(source='test', key='dm').chat
+        self.assertEquals(set(general.participants.values_list('username', flat=True)),
+                          {'alice', 'bob', 'existing'})
+        self.assertTrue(dm.is_private)
+
+        for chat, count in ((general, 6), (dm, 4)):
+            messages = list(Message.objects.filter(chat=chat).order_by('seq'))
+            self.assertEquals(chat.message_count, count)
+            self.assertEquals([message.seq for message in messages], list(range(1, count + 1)))
+            self.assertEquals(messages, sorted(messages, key=lambda message: message.time))
+        self.assertEquals(Message.objects.count(), 10)
+        self.assertEquals(Message.objects.get(text='message 1').sender.username, 'alice')
+        self.assertEquals({message.text: message.time for message in Message.objects.all()},
+                          {'message {0}'.format(i): datetime(2019, 6, 1, 12, 0, i, tzinfo=pytz.utc)
+                           for i in range(10)})
+
+    def test_import_ndjson(self):
+        self.import_records(self.records, batch_size=4)
+
+        self.assertImported()
+
+    def test_import_csv(self):
+        self.import_records(self.records, fmt='csv')
+
+        self.assertImported()
+
+    def test_resume_after_failure(self):
+        broken = list(self.records)
+        broken[8] = dict(broken[8], sender='nobody')
+        with self.assertRaisesMessage(CommandError, "record 9: unknown user 'nobody'"):
+            self.import_records(broken, batch_size=2)
+
+        # batches before the broken record stay loaded
+        self.assertEquals(ImportCheckpoint.objects.get(source='test').position, 7)
+        self.assertEquals(Message.objects.count(), 2)
+
+        self.import_records(self.records, batch_size=2)
+
+        self.assertImported()
+        self.assertEquals(ImportCheckpoint.objects.get(source='test').position, len(self.records))
+
+    def test_private_chat_continues_existing_one(self):
+        self.import_records(self.records)
+        dm = ImportedChat.objects.get(source='test', key='dm').chat
+
+        self.import_records([
+            {'type': 'chat', 'key': 'other-dm', 'is_private': True, 'participants': ['bob', 'alice']},
+            {'type': 'message', 'chat': 'other-dm', 'sender': 'bob', 'text': 'again'},
+        ], source='test-2')
+
+        self.assertEquals(Chat.objects.count(), 2)
+        self.assertEquals(Message.objects.get(text='again').chat_id, dm.id)
+        self.assertEquals(Message.objects.get(text='again').seq, 5)
+
+    def test_import_after_archiving(self):
+        self.import_records(self.records)
+        call_command('archive_messages', days=0, stdout=StringIO())
+        dm = ImportedChat.objects.get(source='test', key='dm').chat
+
+        records = [{'type': 'chat', 'key': 'dm', 'is_private': True, 'participants': ['alice', 'bob']},
+                   {'type': 'message', 'chat': 'dm', 'sender': 'bob', 'text': 'older',
+                    'time': '2019-06-01T11:00:00Z'}]
+        with self.assertRaisesMessage(CommandError, "record 2: message is older than the history of chat 'dm'"):
+            self.import_records(records, source='test-2')
+        self.assertFalse(Message.objects.filter(text='older').exists())
+
+        records[1] = dict(records[1], text='newer', time='2019-06-01T13:00:00Z')
+        self.import_records(records, source='test-2')
+
+        self.assertEquals(Message.objects.get(text='newer').seq, 5)
+        self.assertEquals([row['text'] for row in history_rows(dm.id)][-2:], ['message 9', 'newer'])
+
+    def test_messages_out_of_order_are_rejected(self):
+        records = list(self.records)
+        # messages 7 and 8, both in the general chat
+        records[-3], records[-2] = records[-2], records[-3]
+
+        with self.assertRaisesMessage(CommandError, "record {0}: message is older than the history of chat "
+                                                    "'general'".format(len(records) - 1)):
+            self.import_records(records)
+
+    def test_plain_password_is_rejected(self):
+        with self.assertRaisesMessage(CommandError, 'record 1: password must be hashed'):
+            self.import_records([{'type': 'user', 'username': 'carol', 'password': 'secret'}])
+
+        self.assertFalse(User.objects.filter(username='carol').exists())
+
+
+class PrivateChatTest(APITestCase):
+    def setUp(self):
+        User.objects.create_user(username='User1', password='testpass1234')
+        User.objects.create_user(username='User2', password='testpass1234')
+        User.objects.create_user(username='User3', password='testpass1234')
+
+        self.tokens = {}
+        for username in ('User1', 'User2'):
+            response = self.client.post(reverse('obtain-token'),
+                                        data={'username': username,
+                                              'password': 'testpass1234'},
+                                        headers={'Content-Type': 'application/json'})
+            self.tokens[username] = response.data['token']
+        self.login('User1')
+
+    def login(self, username):
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(self.tokens[username]))
+
+    def test_get_or_create(self):
+        url = reverse('private-chat-view')
+
+        response = self.client.post(url, data={'user_id': 2})
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        chat = Chat.objects.get(id=response.data['chat_id'])
+        self.assertTrue(chat.is_private)
+        self.assertEquals(chat.pair_key, '1:2')
+        self.assertEquals(set(chat.participants.values_list('id', flat=True)), {1, 2})
+
+        response = self.client.post(url, data={'user_id': 2})
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['chat_id'], chat.id)
+
+        self.login('User2')
+        response = self.client.post(url, data={'user_id': 1})
+        self.assertEquals(response.data['chat_id'], chat.id)
+        self.assertEquals(Chat.objects.count(), 1)
+
+    def test_existing_chat_is_one_lookup(self):
+        url = reverse('private-chat-view')
+        self.client.post(url, data={'user_id': 2})
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(url, data={'user_id': 2})
+
+        self.assertEquals(len(queries.captured_queries), 1)
+        self.assertIn('pair_key', queries.captured_queries[0]['sql'])
+
+    def test_leaving_releases_pair(self):
+        url = reverse('private-chat-view')
+        chat_id = self.client.post(url, data={'user_id': 2}).data['chat_id']
+
+        response = self.client.delete(reverse('chat-participants-view', kwargs={'pk': chat_id}),
+                                      data={'user_id': 2})
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(Chat.objects.get(id=chat_id).pair_key)
+
+        response = self.client.post(url, data={'user_id': 2})
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotEqual(response.data['chat_id'], chat_id)
+
+        # also when the user leaves all chats from the other side
+        User.objects.get(id=2).chat_set.clear()
+        self.assertFalse(Chat.objects.filter(pair_key__isnull=False).exists())
+
+    def test_create_private_chat_returns_existing(self):
+        chat_id, _ = Chat.get_or_create_private(1, 2)
+
+        response = self.client.post(reverse('chats-view'), data={'participants': ['User2'], 'is_private': True})
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['chat_id'], chat_id)
+        self.assertEquals(Chat.objects.count(), 1)
+
+    def test_concurrent_create(self):
+        chat = Chat.objects.create(is_private=True, pair_key='1:2')
+
+        # the other request inserts the chat between our lookup and insert
+        with mock.patch.object(QuerySet, 'first', return_value=None):
+            self.assertEquals(Chat.get_or_create_private(2, 1), (chat.id, False))
+        self.assertEquals(Chat.objects.count(), 1)
+
+    def test_invalid_user(self):
+        url = reverse('private-chat-view')
+
+        for data in ({}, {'user_id': 1}, {'user_id': 100}):
+            response = self.client.post(url, data=data)
+            self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEquals(Chat.objects.count(), 0)
+
+    def test_backfill_keeps_oldest_duplicate(self):
+        chats = [Chat.objects.create(is_private=True) for _ in range(3)]
+        for chat in chats[:2]:
+            chat.participants.add(2, 1)
+        chats[2].participants.add(1)
+        group = Chat.objects.create(is_private=False)
+        group.participants.add(1, 2)
+
+        import_module('chat.migrations.0015_chat_pair_key').backfill_pair_key(apps, None)
+
+        self.assertEquals([chat.pair_key for chat in Chat.objects.order_by('id')], ['1:2', None, None, None])
+
+
+class ChatExportTest(APITestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+        User.objects.create_user(username='User3', password='testpass1234')
+
+        chat = Chat.objects.create(is_private=True)
+        chat.participants.add(user1, user2)
+        other_chat = Chat.objects.create(is_private=False)
+        other_chat.participants.add(user1)
+
+        for i in range(6):
+            Message.objects.create(text='message {0}'.format(i), sender=user1, chat=chat, seq=i + 1)
+        Message.objects.filter(id__in=(1, 2, 3)).update(time=datetime(2018, 1, 1, tzinfo=pytz.utc))
+        Message.objects.create(text='other chat', sender=user1, chat=other_chat, seq=1)
+        call_command('archive_messages', days=30, stdout=StringIO())
+
+        self.tokens = {}
+        for username in ('User1', 'User3'):
+            response = self.client.post(reverse('obtain-token'),
+                                        data={'username': username,
+                                              'password': 'testpass1234'},
+                                        headers={'Content-Type': 'application/json'})
+            self.tokens[username] = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(self.tokens['User1']))
+
+    @staticmethod
+    def parse(content):
+        return [json.loads(line) for line in content.decode().splitlines()]
+
+    def export(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_export_chat(self):
+        response, content = self.export(reverse('chat-export-view', kwargs={'pk': 1}))
+        rows = self.parse(content)
+
+        self.assertEquals(response['Content-Type'], 'application/x-ndjson')
+        self.assertEquals([row['text'] for row in rows], ['message {0}'.format(i) for i in range(6)])
+        self.assertEquals([row['seq'] for row in rows], list(range(1, 7)))
+        self.assertEquals(rows[0], {
+            'id': 1, 'sender': 1, 'text': 'message 0', 'chat': 1,
+            'time': '2018-01-01T00:00:00Z', 'is_edited': False, 'seq': 1
+        })
+
+    def test_export_gzip(self):
+        url = reverse('chat-export-view', kwargs={'pk': 1})
+        response, content = self.export(url, {'compress': 'gzip'})
+
+        self.assertEquals(response['Content-Type'], 'application/gzip')
+        self.assertEquals(gzip.decompress(content), self.export(url)[1])
+
+    def test_export_all_chats_of_user(self):
+        _, content = self.export(reverse('chats-export-view'))
+
+        self.assertEquals([row['chat'] for row in self.parse(content)], [1] * 6 + [2])
+
+    def test_export_requires_participation(self):
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(self.tokens['User3']))
+
+        response = self.client.get(reverse('chat-export-view', kwargs={'pk': 1}))
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        _, content = self.export(reverse('chats-export-view'))
+        self.assertEquals(content, b'')
+
+    def test_message_archived_during_export_is_written_once(self):
+        message = Message.objects.get(id=4)
+        ArchivedMessage.objects.create(id=message.id, text=message.text, sender_id=message.sender_id,
+                                       chat_id=message.chat_id, time=message.time, seq=message.seq)
+
+        _, content = self.export(reverse('chat-export-view', kwargs={'pk': 1}))
+
+        self.assertEquals([row['id'] for row in self.parse(content)], [1, 2, 3, 4, 5, 6])
+
+    def test_output_is_streamed_in_chunks(self):
+        with mock.patch('chat.export.BUFFER_SIZE', 200):
+            chunks = list(export_chunks([1, 2]))
+
+        self.assertGreater(len(chunks), 2)
+        self.assertEquals(len(self.parse(b''.join(chunks))), 7)
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile(suffix='.ndjson.gz') as output:
+            call_command('export_history', user='User1', output=output.name, stdout=StringIO())
+            rows = self.parse(gzip.decompress(output.read()))
+
+        self.assertEquals(len(rows), 7)
+
+        with self.assertRaisesMessage(CommandError, 'chats 5 do not exist'):
+            call_command('export_history', chat=[1, 5], stdout=StringIO())
+
+
+class RequestMetricsTest(APITestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='User1', password='testpass1234')
+        chat = Chat.objects.create(is_private=False)
+        chat.participants.add(user)
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        jwt_token = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(jwt_token))
+
+        for histogram in HISTOGRAMS:
+            histogram.clear()
+
+    @override_settings(DEBUG=True)
+    def test_debug_headers(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('get-chat-view', kwargs={'pk': 1}))
+
+        self.assertEquals(response['X-SQL-Queries'], str(len(queries)))
+        self.assertRegex(response['Server-Timing'],
+                         r'^sql;dur=[\d.]+, serialize;dur=[\d.]+, render;dur=[\d.]+, total;dur=[\d.]+$')
+
+    def test_no_headers_without_debug(self):
+        response = self.client.get(reverse('get-chat-view', kwargs={'pk': 1}))
+
+        self.assertFalse(response.has_header('X-SQL-Queries'))
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('get-chat-view', kwargs={'pk': 1}))
+        self.client.get(reverse('get-chat-view', kwargs={'pk': 1}))
+        self.client.post(reverse('create-message-view'), data={'text': 'hello', 'chat_id': 1})
+
+        response = self.client.get(reverse('metrics'))
+        body = response.content.decode()
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertIn('http_request_duration_seconds_count{view="get-chat-view",method="GET"} 2', body)
+        self.assertIn('http_request_sql_queries_bucket{view="get-chat-view",method="GET",le="+Inf"} 2', body)
+        self.assertIn('http_request_render_duration_seconds_count{view="create-message-view",method="POST"} 1',
+                      body)
+        self.assertIn('http_request_serialize_duration_seconds_count{view="get-chat-view",method="GET"} 2', body)
+
+    def test_serialization_is_timed(self):
+        with mock.patch('chat.views.ChatSerializer.data', new_callable=mock.PropertyMock) as data:
+            data.side_effect = lambda: time.sleep(0.03) or {}
+            self.client.get(reverse('get-chat-view', kwargs={'pk': 1}))
+
+        _, total, _ = SERIALIZE_DURATION._series[('get-chat-view', 'GET')]
+        self.assertGreaterEqual(total, 0.03)
+
+    @override_settings(METRICS_ALLOWED_NETWORKS=['10.0.0.0/8'])
+    def test_metrics_endpoint_is_internal(self):
+        url = reverse('metrics')
+
+        self.assertEquals(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEquals(self.client.get(url, REMOTE_ADDR='10.1.2.3').status_code, status.HTTP_200_OK)
+
+        User.objects.create_user(username='Admin', password='testpass1234', is_staff=True)
+        self.client.login(username='Admin', password='testpass1234')
+        self.assertEquals(self.client.get(url).status_code, status.HTTP_200_OK)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.router = ReplicaRouter()
+
+    def route(self, method, view, **extra):
+        """
+        :return: database the view read from
+        """
+        used = []
+
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            used.append(self.router.db_for_read(Chat))
+            return HttpResponse()
+
+        middleware = ReplicaRoutingMiddleware(get_response)
+        middleware(getattr(self.factory, method)('/', **extra))
+        return used[0]
+
+    def test_read_actions_use_replica(self):
+        self.assertEquals(self.route('get', ChatView.as_view({'get': 'list'})), 'replica')
+        self.assertEquals(self.route('get', MessageView.as_view({'get': 'list'})), 'replica')
+        self.assertEquals(self.route('get', UserListView.as_view({'get': 'list'})), 'replica')
+
+    def test_other_actions_use_primary(self):
+        self.assertEquals(self.route('get', MessageView.as_view({'get': 'poll'})), 'default')
+        self.assertEquals(self.route('post', MessageView.as_view({'post': 'create'})), 'default')
+        self.assertEquals(self.route('get', ChatParticipantsView.as_view()), 'default')
+
+    def test_writes_go_to_primary(self):
+        self.assertEquals(self.router.db_for_write(Chat), 'default')
+
+    def test_replica_flag_is_reset_after_request(self):
+        self.route('get', ChatView.as_view({'get': 'list'}))
+        self.assertEquals(self.router.db_for_read(Chat), 'default')
+
+    def test_writer_is_pinned_to_primary(self):
+        history = MessageView.as_view({'get': 'list'})
+        self.route('post', MessageView.as_view({'post': 'create'}), HTTP_AUTHORIZATION='JWT writer')
+
+        self.assertEquals(self.route('get', history, HTTP_AUTHORIZATION='JWT writer'), 'default')
+        self.assertEquals(self.route('get', history, HTTP_AUTHORIZATION='JWT reader'), 'replica')
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas(self):
+        self.assertEquals(self.route('get', ChatView.as_view({'get': 'list'})), 'default')
+
+
+class AsyncChatEndpointsTest(APITransactionTestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+        User.objects.create_user(username='User3', password='testpass1234')
+
+        self.chat = Chat.objects.create(is_private=True, message_count=3)
+        self.chat.participants.add(user1, user2)
+        for i in range(3):
+            Message.objects.create(text=str(i), sender=user1, chat=self.chat, seq=i + 1)
+
+        self.tokens = {}
+        for username in ('User1', 'User3'):
+            response = self.client.post(reverse('obtain-token'),
+                                        data={'username': username,
+                                              'password': 'testpass1234'},
+                                        headers={'Content-Type': 'application/json'})
+            self.tokens[username] = response.data['token']
+
+    def communicator(self, method, path, username=None, data=None, headers=()):
+        headers = [(b'host', b'testserver')] + list(headers)
+        if username is not None:
+            headers.append((b'authorization', 'JWT {0}'.format(self.tokens[username]).encode()))
+        body = b''
+        if data is not None:
+            headers.append((b'content-type', b'application/json'))
+            body = json.dumps(data).encode()
+        return HttpCommunicator(application, method, path, body=body, headers=headers)
+
+    @staticmethod
+    def parse(response):
+        """
+        :return: status, parsed body and headers of the ASGI response
+        """
+        body = json.loads(response['body'].decode()) if response['body'] else None
+        return response['status'], body, dict(response['headers'])
+
+    def request(self, method, path, username=None, data=None, headers=()):
+        communicator = self.communicator(method, path, username, data, headers)
+        return self.parse(async_to_sync(communicator.get_response)(timeout=5))
+
+    def sync_request(self, method, path, username=None, data=None):
+        if username is not None:
+            self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(self.tokens[username]))
+        else:
+            self.client.credentials()
+        response = getattr(self.client, method.lower())(path, data=data, format='json')
+        return response.status_code, json.loads(response.content.decode())
+
+    def assertSameAsSync(self, method, path, username=None, data=None):
+        status_code, body, _ = self.request(method, path, username, data)
+        self.assertEquals((status_code, body), self.sync_request(method, path, username, data))
+
+    def test_chat_list(self):
+        self.assertSameAsSync('GET', '/api/chats/', 'User1')
+        self.assertSameAsSync('GET', '/api/chats/', 'User3')
+
+    def test_chat_list_requires_authentication(self):
+        status_code, body, headers = self.request('GET', '/api/chats/')
+
+        self.assertEquals(status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEquals(headers[b'WWW-Authenticate'], b'JWT realm="api"')
+        self.assertEquals((status_code, body), self.sync_request('GET', '/api/chats/'))
+
+    def test_history(self):
+        path = '/api/chats/{0}/messages/'.format(self.chat.id)
+        self.assertSameAsSync('GET', path, 'User1')
+        self.assertSameAsSync('GET', path + '?limit=2', 'User1')
+        self.assertSameAsSync('GET', path, 'User3')
+        self.assertSameAsSync('GET', '/api/chats/1000/messages/', 'User1')
+        self.assertSameAsSync('GET', path + '?before=garbage', 'User1')
+
+    def test_history_not_modified(self):
+        path = '/api/chats/{0}/messages/'.format(self.chat.id)
+        _, _, headers = self.request('GET', path, 'User1')
+        self.assertEquals(headers[b'ETag'].decode(), self.client.get(path, HTTP_AUTHORIZATION='JWT {0}'.format(
+            self.tokens['User1']))['ETag'])
+
+        status_code, body, _ = self.request('GET', path, 'User1', headers=[(b'if-none-match', headers[b'ETag'])])
+
+        self.assertEquals(status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertIsNone(body)
+
+    def test_send_message(self):
+        status_code, body, _ = self.request('POST', '/api/chats/messages/', 'User1',
+                                            {'text': 'async', 'chat_id': self.chat.id})
+
+        self.assertEquals(status_code, status.HTTP_201_CREATED)
+        self.assertEquals(body, {'status': 'messages has been sent'})
+        message = Message.objects.latest('id')
+        self.assertEquals((message.text, message.seq), ('async', 4))
+        self.assertEquals(Chat.objects.get(id=self.chat.id).message_count, 4)
+
+    def test_send_message_errors(self):
+        self.assertSameAsSync('POST', '/api/chats/messages/', 'User3', {'text': 'hi', 'chat_id': self.chat.id})
+        self.assertSameAsSync('POST', '/api/chats/messages/', 'User1', {'text': 'hi'})
+        self.assertSameAsSync('POST', '/api/chats/messages/', 'User1', {'text': 'hi', 'chat_id': 1000})
+        self.assertEquals(Message.objects.count(), 3)
+
+    @override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': {'message_send': '1/min'}})
+    def test_send_message_is_throttled(self):
+        cache.clear()
+        data = {'text': 'async', 'chat_id': self.chat.id}
+        self.request('POST', '/api/chats/messages/', 'User1', data)
+
+        status_code, _, headers = self.request('POST', '/api/chats/messages/', 'User1', data)
+
+        self.assertEquals(status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn(headers[b'Retry-After'], (b'59', b'60'))
+
+    def test_other_requests_are_served_by_django(self):
+        status_code, body, _ = self.request('GET', '/api/chats/{0}/'.format(self.chat.id), 'User1')
+
+        self.assertEquals(status_code, status.HTTP_200_OK)
+        self.assertEquals(body['is_private'], True)
+
+    def test_poll(self):
+        path = '/api/chats/{0}/messages/poll/'.format(self.chat.id)
+        first = Message.objects.earliest('id')
+        self.assertSameAsSync('GET', path + '?' + urlencode({
+            'after': MessageCursorPagination.encode_cursor(first), 'timeout': 0}), 'User1')
+        self.assertSameAsSync('GET', path + '?timeout=0', 'User3')
+        self.assertSameAsSync('GET', path + '?timeout=nan', 'User1')
+        self.assertSameAsSync('GET', '/api/chats/1000/messages/poll/', 'User1')
+
+    def test_requests_are_served_while_poll_waits(self):
+        latest = Message.objects.latest('id')
+        poll_path = '/api/chats/{0}/messages/poll/?{1}'.format(self.chat.id, urlencode({
+            'after': MessageCursorPagination.encode_cursor(latest), 'timeout': 10}))
+
+        async def scenario():
+            poll = asyncio.ensure_future(self.communicator('GET', poll_path, 'User1').get_response(timeout=15))
+            await asyncio.sleep(0.2)
+            # one at a time, SQLite's in-memory test database locks tables
+            responses = []
+            for communicator in (
+                    self.communicator('GET', '/api/chats/', 'User1'),
+                    self.communicator('GET', '/api/chats/{0}/'.format(self.chat.id), 'User1'),
+                    self.communicator('POST', '/api/chats/messages/', 'User1',
+                                      {'text': 'async', 'chat_id': self.chat.id})):
+                responses.append(await communicator.get_response(timeout=2))
+            return responses, await poll
+
+        responses, poll = async_to_sync(scenario)()
+
+        self.assertEquals([response['status'] for response in responses],
+                          [status.HTTP_200_OK, status.HTTP_200_OK, status.HTTP_201_CREATED])
+        status_code, body, _ = self.parse(poll)
+        self.assertEquals(status_code, status.HTTP_200_OK)
+        self.assertEquals([message['text'] for message in body['results']], ['async'])
+
+
+class OutboxTest(APITestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        chat = Chat.objects.create(is_private=False)
+        chat.participants.add(user1)
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        jwt_token = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(jwt_token))
+
+        self.calls = []
+
+        @outbox.handler('test.failing')
+        def failing(payloads):
+            self.calls.append(payloads)
+            raise ValueError('handler failed')
+
+    def tearDown(self):
+        outbox._handlers.pop('test.failing')
+
+    def test_send_message_queues_side_effects(self):
+        self.client.post(reverse('create-message-view'), data={'text': 'hello', 'chat_id': 1})
+
+        event = OutboxEvent.objects.get()
+        self.assertEquals(event.event, outbox.MESSAGE_CREATED)
+        self.assertEquals(json.loads(event.payload)['sender_id'], 1)
+        self.assertFalse(UserActivity.objects.exists())
+
+        self.assertEquals(outbox.process_batch(10), 1)
+
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEquals(UserActivity.objects.get().message_count, 1)
+
+    def test_events_are_batched_per_handler(self):
+        outbox.enqueue('test.failing', [{'n': 1}, {'n': 2}])
+        outbox.enqueue('test.failing', [{'n': 3}])
+
+        with self.assertLogs('chat.outbox', 'ERROR'):
+            outbox.process_batch(2)
+
+        self.assertEquals(self.calls, [[{'n': 1}, {'n': 2}]])
+
+    def test_failed_event_is_retried_with_backoff(self):
+        outbox.enqueue('test.failing', [{'n': 1}])
+
+        with self.assertLogs('chat.outbox', 'ERROR'):
+            outbox.process_batch(10)
+        event = OutboxEvent.objects.get()
+        first_retry = event.available_at
+        self.assertEquals(event.attempts, 1)
+        self.assertIn('handler failed', event.last_error)
+        self.assertGreater(first_retry, event.created)
+
+        # not due yet
+        self.assertEquals(outbox.process_batch(10), 0)
+
+        OutboxEvent.objects.update(available_at=event.created)
+        with self.assertLogs('chat.outbox', 'ERROR'):
+            outbox.process_batch(10)
+        event = OutboxEvent.objects.get()
+        self.assertEquals(event.attempts, 2)
+        self.assertGreater(event.available_at - event.created, first_retry - event.created)
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    def test_event_is_parked_after_max_attempts(self):
+        outbox.enqueue('test.failing', [{'n': 1}])
+        for _ in range(2):
+            OutboxEvent.objects.update(available_at=datetime(2019, 1, 1, tzinfo=pytz.utc))
+            with self.assertLogs('chat.outbox', 'ERROR'):
+                outbox.process_batch(10)
+
+        event = OutboxEvent.objects.get()
+        self.assertEquals(event.attempts, 2)
+        self.assertIsNone(event.available_at)
+        self.assertEquals(outbox.process_batch(10), 0)
+
+    def test_failure_does_not_affect_other_events(self):
+        outbox.enqueue('test.failing', [{'n': 1}])
+        self.client.post(reverse('create-message-view'), data={'text': 'hello', 'chat_id': 1})
+
+        with self.assertLogs('chat.outbox', 'ERROR'):
+            call_command('process_outbox', once=True, stdout=StringIO())
+
+        self.assertEquals(list(OutboxEvent.objects.values_list('event', flat=True)), ['test.failing'])
+        self.assertEquals(UserActivity.objects.get().message_count, 1)
+
+
+@override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': {
+    'message_send': '2/min', 'chat_message_send': '3/min', 'chat_create': '1/min'}})
+class ThrottleTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        TokenBucketThrottle.local_buckets._buckets.clear()
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        user2 = User.objects.create_user(username='User2', password='testpass1234')
+        User.objects.create_user(username='User3', password='testpass1234')
+        chat = Chat.objects.create(is_private=False)
+        chat.participants.add(user1, user2)
+
+        self.tokens = {}
+        for username in ('User1', 'User2', 'User3'):
+            response = self.client.post(reverse('obtain-token'),
+                                        data={'username': username,
+                                              'password': 'testpass1234'},
+                                        headers={'Content-Type': 'application/json'})
+            self.tokens[username] = response.data['token']
+        self.login('User1')
+
+    def tearDown(self):
+        # drained buckets would throttle the tests that run next
+        cache.clear()
+        TokenBucketThrottle.local_buckets._buckets.clear()
+
+    def login(self, username):
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(self.tokens[username]))
+
+    def send(self):
+        return self.client.post(reverse('create-message-view'), data={'text': 'hi', 'chat_id': 1})
+
+    def test_user_bucket(self):
+        self.assertEquals(self.send().status_code, status.HTTP_201_CREATED)
+        self.assertEquals(self.send().status_code, status.HTTP_201_CREATED)
+
+        response = self.send()
+        self.assertEquals(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn(int(response['Retry-After']), (29, 30))
+        self.assertEquals(Message.objects.count(), 2)
+
+        self.login('User2')
+        self.assertEquals(self.send().status_code, status.HTTP_201_CREATED)
+
+    def test_chat_bucket(self):
+        self.send()
+        self.send()
+        self.login('User2')
+        self.assertEquals(self.send().status_code, status.HTTP_201_CREATED)
+
+        self.assertEquals(self.send().status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_outsiders_dont_drain_chat_bucket(self):
+        self.login('User3')
+        self.assertEquals(self.send().status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEquals(self.send().status_code, status.HTTP_403_FORBIDDEN)
+
+        self.login('User1')
+        self.send()
+        self.send()
+        self.login('User2')
+        self.assertEquals(self.send().status_code, status.HTTP_201_CREATED)
+
+    def test_batch_costs_its_messages(self):
+        url = reverse('batch-create-message-view')
+        self.client.post(url, data={'messages': [{'text': 'hi', 'chat_id': 1}]}, format='json')
+
+        response = self.client.post(url, data={'messages': [{'text': 'hi', 'chat_id': 1}] * 2}, format='json')
+
+        self.assertEquals(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_batch_larger_than_bucket(self):
+        url = reverse('batch-create-message-view')
+
+        response = self.client.post(url, data={'messages': [{'text': 'hi', 'chat_id': 1}] * 3}, format='json')
+
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEquals(response.data['error'], 'you can send at most 2 messages at once')
+        self.assertEquals(Message.objects.count(), 0)
+        # the refused batch took no tokens
+        response = self.client.post(url, data={'messages': [{'text': 'hi', 'chat_id': 1}] * 2}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_batch_takes_from_chat_bucket(self):
+        url = reverse('batch-create-message-view')
+        self.client.post(url, data={'messages': [{'text': 'hi', 'chat_id': 1}] * 2}, format='json')
+        self.login('User2')
+
+        response = self.client.post(url, data={'messages': [{'text': 'hi', 'chat_id': 1}] * 2}, format='json')
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([result['status'] for result in response.data['results']],
+                          [status.HTTP_429_TOO_MANY_REQUESTS] * 2)
+        self.assertEquals(Message.objects.count(), 2)
+
+    def test_chat_create(self):
+        url = reverse('chats-view')
+        data = {'participants': ['User2'], 'is_private': True}
+
+        self.assertEquals(self.client.post(url, data=data).status_code, status.HTTP_201_CREATED)
+        self.assertEquals(self.client.post(url, data=data).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEquals(self.client.get(url).status_code, status.HTTP_200_OK)
+
+    def test_falls_back_to_local_buckets(self):
+        with mock.patch.object(TokenBucketThrottle, 'cache') as broken_cache:
+            broken_cache.get.side_effect = ConnectionError
+            self.send()
+            self.send()
+            response = self.send()
+
+        self.assertEquals(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_bucket_refills(self):
+        allowed, state, wait = take(None, 100, 2, 0.5, 2)
+        self.assertTrue(allowed)
+
+        allowed, state, wait = take(state, 101, 2, 0.5, 1)
+        self.assertFalse(allowed)
+        self.assertEquals(wait, 1)
+
+        allowed, state, wait = take(state, 102, 2, 0.5, 1)
+        self.assertTrue(allowed)
+        self.assertEquals(state, (0, 102))
+
+
+class ConditionalGetTest(APITestCase):
+    def setUp(self):
+        user1 = User.objects.create_user(username='User1', password='testpass1234')
+        User.objects.create_user(username='User2', password='testpass1234')
+        User.objects.create_user(username='User3', password='testpass1234')
+
+        chat = Chat.objects.create(is_private=False)
+        chat.participants.add(user1)
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(response.data['token']))
+        self.client.post(reverse('create-message-view'), data={'text': 'Hello', 'chat_id': 1})
+
+    def etags(self):
+        chat = self.client.get(reverse('get-chat-view', kwargs={'pk': 1}))
+        history = self.client.get(reverse('chat-messages-view', kwargs={'pk': 1}))
+        return chat['ETag'], history['ETag']
+
+    def test_not_modified(self):
+        for url in (reverse('get-chat-view', kwargs={'pk': 1}), reverse('chat-messages-view', kwargs={'pk': 1})):
+            etag = self.client.get(url)['ETag']
+
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+            self.assertEquals(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEquals(response['ETag'], etag)
+            self.assertEquals(response.content, b'')
+            self.assertFalse([query for query in queries.captured_queries
+                              if 'chat_message' in query['sql'] or 'chat_archivedmessage' in query['sql']])
+
+            response = self.client.get(url, HTTP_IF_NONE_MATCH='"stale"')
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_pages_have_own_etags(self):
+        url = reverse('chat-messages-view', kwargs={'pk': 1})
+        self.assertNotEquals(self.client.get(url)['ETag'], self.client.get(url, {'limit': 1})['ETag'])
+
+    def test_changes_update_etags(self):
+        etags = self.etags()
+
+        self.client.post(reverse('create-message-view'), data={'text': 'Hi', 'chat_id': 1})
+        self.assertTrue(all(old != new for old, new in zip(etags, self.etags())))
+        etags = self.etags()
+
+        self.client.put(reverse('messages-view', kwargs={'pk': 1}), data={'text': 'Hello!'})
+        self.assertTrue(all(old != new for old, new in zip(etags, self.etags())))
+        etags = self.etags()
+
+        self.client.post(reverse('chat-participants-view', kwargs={'pk': 1}), data={'user_id': 2})
+        self.assertTrue(all(old != new for old, new in zip(etags, self.etags())))
+        etags = self.etags()
+
+        User.objects.get(username='User2').chat_set.clear()
+        self.assertTrue(all(old != new for old, new in zip(etags, self.etags())))
+
+    def test_unread_count_updates_chat_etag(self):
+        chat = Chat.objects.get(id=1)
+        chat.participants.add(User.objects.get(username='User2'))
+        Message.objects.create(text='Hi', sender_id=2, chat=chat, seq=Chat.allocate_seq(1))
+        chat_etag, history_etag = self.etags()
+
+        self.client.post(reverse('chat-read-view', kwargs={'pk': 1}), data={'message_id': 2})
+
+        self.assertNotEquals(self.etags(), (chat_etag, history_etag))
+        self.assertEquals(self.etags()[1], history_etag)
@@ -0,0 +1,180 @@
+"""
+Token-bucket throttles for sending messages and creating chats.
+
+A bucket holds up to `num` tokens of a 'num/period' rate from
+DEFAULT_THROTTLE_RATES and refills continuously, so clients may burst up
+to `num` requests and are then held to the average rate. Buckets live in
+the default cache, shared by all processes, and in a per-process LRU
+when the cache backend fails. Reading and writing a bucket are not one
+atomic step, so concurrent requests may overdraw a bucket slightly.
+"""
+import threading
+import time
+from collections import OrderedDict
+from math import ceil
+
+from django.core.cache import cache
+from rest_framework.exceptions import Throttled
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def take(state, now, capacity, rate, cost):
+    """
+    :param state: (tokens, updated at) of the bucket or None for a full one
+    :param rate: tokens added per second
+    :return: whether the tokens were taken, the new state and the seconds
+    to wait until they can be taken
+    """
+    tokens, updated = state if state is not None else (capacity, now)
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    if tokens >= cost:
+        return True, (tokens - cost, now), None
+    return False, (tokens, now), (cost - tokens) / rate
+
+
+class LocalBuckets:
+    """
+    In-process bucket store used while the cache is unavailable.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, key, now, capacity, rate, cost):
+        with self._lock:
+            allowed, state, wait = take(self._buckets.get(key), now, capacity, rate, cost)
+            self._buckets[key] = state
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return allowed, wait
+
+
+class TokenBucketThrottle(BaseThrottle):
+    scope = None
+    cache = cache
+    local_buckets = LocalBuckets(10000)
+    timer = time.time
+
+    def __init__(self):
+        self.capacity, self.period = self.parse_rate(api_settings.DEFAULT_THROTTLE_RATES.get(self.scope))
+        self.wait_time = None
+
+    @staticmethod
+    def parse_rate(rate):
+        """
+        :param rate: 'num/period' with period s, m, h or d, None disables the throttle
+        :return: (num, seconds)
+        """
+        if rate is None:
+            return None, None
+        num, period = rate.split('/')
+        return int(num), PERIODS[period[0]]
+
+    def get_cache_key(self, request, view):
+        """
+        :return: key of the bucket to take from, None to skip throttling
+        """
+        raise NotImplementedError
+
+    def get_cost(self, request, view):
+        return 1
+
+    def allow_request(self, request, view):
+        if self.capacity is None:
+            return True
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+
+        cost = self.get_cost(request, view)
+        if cost > self.capacity:
+            # would never fit, and taking a full bucket instead would let it exceed the rate
+            self.wait_time = None
+            return False
+        rate = self.capacity / self.period
+        now = self.timer()
+        try:
+            allowed, state, self.wait_time = take(self.cache.get(key), now, self.capacity, rate, cost)
+            # an untouched bucket is full again after one period
+            self.cache.set(key, state, ceil(self.period))
+        except Exception:
+            allowed, self.wait_time = self.local_buckets.take(key, now, self.capacity, rate, cost)
+        return allowed
+
+    def wait(self):
+        return self.wait_time
+
+
+class UserRateThrottle(TokenBucketThrottle):
+    """
+    Bucket per user, or per client address for anonymous requests.
+    """
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            ident = request.user.id
+        else:
+            ident = self.get_ident(request)
+        return 'throttle-{0}-user-{1}'.format(self.scope, ident)
+
+
+class MessageSendThrottle(UserRateThrottle):
+    scope = 'message_send'
+
+    def get_cost(self, request, view):
+        # a batch costs as much as its messages
+        messages = request.data.get('messages') if isinstance(request.data, dict) else None
+        return len(messages) if isinstance(messages, list) and messages else 1
+
+
+class ChatMessageThrottle(TokenBucketThrottle):
+    """
+    Bucket per target chat, shared by all of its participants. Views
+    take from it only after checking that the sender is a participant,
+    so outsiders can't drain it.
+    """
+    scope = 'chat_message_send'
+
+    def __init__(self, chat_id, cost=1):
+        super().__init__()
+        self.chat_id = chat_id
+        self.cost = cost
+
+    def get_cache_key(self, request, view):
+        return 'throttle-{0}-chat-{1}'.format(self.scope, self.chat_id)
+
+    def get_cost(self, request, view):
+        return self.cost
+
+
+class ChatCreateThrottle(UserRateThrottle):
+    scope = 'chat_create'
+
+
+def check_throttles(request, throttles, view=None):
+    """
+    Raise Throttled at the first throttle that denies the request, so a
+    client held by its own bucket doesn't drain the shared ones after it.
+    """
+    for throttle in throttles:
+        if not throttle.allow_request(request, view):
+            wait = throttle.wait()
+            if wait is None:
+                raise Throttled(detail='Request is larger than the rate limit allows at once.')
+            raise Throttled(wait)
+
+
+class SequentialThrottlingMixin:
+    """
+    APIView mixin checking throttles in order with `check_throttles`
+    instead of taking from every bucket of a denied request.
+    """
+
+    def check_throttles(self, request):
+        check_throttles(request, self.get_throttles(), self)
@@ -7,12 +7,28 @@ urlpatterns = [
          name='get-chat-view'),
     path('', views.ChatView.as_view({'get': 'list', 'post': 'create'}),
          name='chats-view'),
+    path('private/', views.PrivateChatView.as_view(),
+         name='private-chat-view'),
+    path('export/', views.ChatExportView.as_view(),
+         name='chats-export-view'),
+    path('<int:pk>/export/', views.ChatExportView.as_view(),
+         name='chat-export-view'),
+    path('inbox/', views.ChatInboxView.as_view({'get': 'list'}),
+         name='chat-inbox-view'),
     path('<int:pk>/participants/', views.ChatParticipantsView.as_view(),
          name='chat-participants-view'),
+    path('<int:pk>/read/', views.ChatReadView.as_view(),
+         name='chat-read-view'),
     path('<int:pk>/messages/', views.MessageView.as_view({'get': 'list'}),
          name='chat-messages-view'),
+    path('<int:pk>/messages/poll/', views.MessageView.as_view({'get': 'poll'}),
+         name='chat-messages-poll-view'),
     path('messages/<int:pk>/', views.MessageView.as_view({'get': 'retrieve', 'put': 'update'}),
          name='messages-view'),
     path('messages/', views.MessageView.as_view({'post': 'create'}),
-         name='create-message-view')
+         name='create-message-view'),
+    path('messages/search/', views.MessageView.as_view({'get': 'search'}),
+         name='search-messages-view'),
+    path('messages/batch/', views.MessageView.as_view({'post': 'batch_create'}),
+         name='batch-create-message-view')
 ]
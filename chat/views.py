@@ -1,3 +1,5 @@
+import math
+from collections import Counter
 from datetime import datetime, timedelta
 import pytz
 
@@ -5,21 +7,72 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.viewsets import ModelViewSet
-from rest_framework_jwt import authentication
 from django.contrib.auth.admin import User
-
-from .models import Message, Chat
-from .serializers import MessageSerializer, ChatSerializer
-from .pagination import StandardPagination
-
-
-class ChatView(ModelViewSet):
-    authentication_classes = (authentication.JSONWebTokenAuthentication, )
+from django.db import transaction, connection
+from django.db.models import F, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.http import Http404, StreamingHttpResponse
+
+from MessengerAPI.metrics import measure_serialization
+from MessengerAPI.routers import replica_reads
+from profiles.authentication import CachedJSONWebTokenAuthentication
+from .listings import MESSAGE_VALUES, message_rows, chat_rows
+from .membership import get_membership, get_membership_or_404
+from . import outbox
+from .conditional import chat_etag, history_etag, not_modified
+from .export import export_chunks
+from .models import Message, Chat, ArchivedMessage, ChatReadState
+from .serializers import MessageSerializer, ChatSerializer, InboxChatSerializer
+from .pagination import StandardPagination, MessageCursorPagination
+from .realtime import publish_message, publish_messages, message_notifier, MESSAGE_CREATED, MESSAGE_EDITED
+from .renderers import FastJSONRenderer
+from .search import search_messages
+from .throttling import (ChatCreateThrottle, ChatMessageThrottle, MessageSendThrottle, check_throttles,
+                         SequentialThrottlingMixin)
+
+
+class ChatView(SequentialThrottlingMixin, ModelViewSet):
+    authentication_classes = (CachedJSONWebTokenAuthentication, )
     permission_classes = (IsAuthenticated,)
     serializer_class = ChatSerializer
     pagination_class = StandardPagination
-    queryset = Chat.objects.all()
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
+    queryset = Chat.objects.prefetch_related('participants').order_by('id')
+    replica_actions = ('list', 'retrieve')
+
+    @staticmethod
+    def get_list_queryset():
+        """
+        :return: all chats as (id, is_private, message_count) rows for chat_rows
+        """
+        return Chat.objects.order_by('id').values_list('id', 'is_private', 'message_count')
+
+    def get_throttles(self):
+        if self.action == 'create':
+            return super().get_throttles() + [ChatCreateThrottle()]
+        return super().get_throttles()
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.get_list_queryset())
+        with measure_serialization(request):
+            data = chat_rows(page, request.user.id)
+        return self.get_paginated_response(data)
+
+    def retrieve(self, request, *args, **kwargs):
+        etag = chat_etag(kwargs['pk'], request.user.id)
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        chat = self.get_object()
+        unread_counts = {}
+        if any(user.id == request.user.id for user in chat.participants.all()):
+            unread_counts = ChatReadState.unread_counts(request.user.id, {chat.id: chat.message_count})
+        with measure_serialization(request):
+            data = ChatSerializer(chat, context={'unread_counts': unread_counts}).data
+        return Response(data, headers={'ETag': etag} if etag else None)
 
     def create(self, request, *args, **kwargs):
         participants_name = request.data.getlist('participants')
@@ -48,30 +101,260 @@ class ChatView(ModelViewSet):
 
         participants = User.objects.filter(username__in=participants_name)
 
+        if is_private:
+            user_ids = [user.id for user in participants if user.id != request.user.id]
+            if not user_ids:
+                return Response({'error': 'user with such username does not exist'},
+                                status.HTTP_400_BAD_REQUEST)
+            return private_chat_response(*Chat.get_or_create_private(request.user.id, user_ids[0]))
+
         chat = Chat.objects.create(
             is_private=request.data.get('is_private')
         )
         chat.participants.set(participants)
         chat.save()
 
-        return Response({'result': 'chat successfully created'}, status.HTTP_201_CREATED)
+        return Response({'result': 'chat successfully created', 'chat_id': chat.id}, status.HTTP_201_CREATED)
+
+
+def private_chat_response(chat_id, created):
+    if created:
+        return Response({'result': 'chat successfully created', 'chat_id': chat_id}, status.HTTP_201_CREATED)
+    return Response({'result': 'private chat already exists', 'chat_id': chat_id}, status.HTTP_200_OK)
+
+
+class PrivateChatView(APIView):
+    """
+    Get or create the private chat of the current user with `user_id`.
+    """
+    authentication_classes = (CachedJSONWebTokenAuthentication, )
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            user_id = int(request.data.get('user_id'))
+        except (TypeError, ValueError):
+            return Response({'error': 'user_id is required'}, status.HTTP_400_BAD_REQUEST)
+
+        if user_id == request.user.id:
+            return Response({'error': "you cant't add yourself to the chat"},
+                            status.HTTP_400_BAD_REQUEST)
+
+        # an existing chat is found with a single lookup of the pair key
+        chat_id = Chat.objects.filter(pair_key=Chat.private_key(request.user.id, user_id)) \
+            .values_list('id', flat=True).first()
+        if chat_id is not None:
+            return private_chat_response(chat_id, False)
 
+        if not User.objects.filter(id=user_id).exists():
+            return Response({'error': 'user with such id does not exist'}, status.HTTP_400_BAD_REQUEST)
+        return private_chat_response(*Chat.get_or_create_private(request.user.id, user_id))
 
-class MessageView(ModelViewSet):
-    authentication_classes = (authentication.JSONWebTokenAuthentication, )
+
+class ChatInboxView(ModelViewSet):
+    """
+    Chats of the current user ordered by latest activity.
+    A page costs a fixed number of queries: count, chats,
+    participants, last messages and read states, and one more
+    when some of the last messages are archived.
+    """
+    authentication_classes = (CachedJSONWebTokenAuthentication, )
+    permission_classes = (IsAuthenticated,)
+    serializer_class = InboxChatSerializer
+    pagination_class = StandardPagination
+    replica_actions = ('list',)
+
+    def get_queryset(self):
+        last_message = Message.objects.filter(chat=OuterRef('pk')).order_by('-time', '-id')
+        # the archive only has the last message of chats without hot ones
+        last_archived = ArchivedMessage.objects.filter(chat=OuterRef('pk')).order_by('-time', '-id')
+        return Chat.objects.filter(participants=self.request.user).annotate(
+            last_message_id=Coalesce(Subquery(last_message.values('id')[:1]),
+                                     Subquery(last_archived.values('id')[:1]), output_field=IntegerField()),
+            last_message_time=Coalesce(Subquery(last_message.values('time')[:1]),
+                                       Subquery(last_archived.values('time')[:1]))
+        ).order_by(F('last_message_time').desc(nulls_last=True), '-id') \
+            .prefetch_related('participants')
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.get_queryset())
+        last_message_ids = [chat.last_message_id for chat in page if chat.last_message_id is not None]
+        last_messages = Message.objects.in_bulk(last_message_ids)
+        archived_ids = [message_id for message_id in last_message_ids if message_id not in last_messages]
+        if archived_ids:
+            last_messages.update(ArchivedMessage.objects.in_bulk(archived_ids))
+        unread_counts = ChatReadState.unread_counts(
+            request.user.id, {chat.id: chat.message_count for chat in page})
+        with measure_serialization(request):
+            data = InboxChatSerializer(page, many=True,
+                                       context={'last_messages': last_messages,
+                                                'unread_counts': unread_counts}).data
+        return self.get_paginated_response(data)
+
+
+class MessageView(SequentialThrottlingMixin, ModelViewSet):
+    authentication_classes = (CachedJSONWebTokenAuthentication, )
     queryset = Message.objects.all()
+    replica_actions = ('list', 'retrieve')
     serializer_class = MessageSerializer
+    pagination_class = MessageCursorPagination
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
+    poll_timeout = 25
+    max_poll_timeout = 60
+    search_limit = 20
+    max_search_limit = 100
+    max_batch_size = 500
+
+    def get_throttles(self):
+        if self.action == 'create':
+            # ChatMessageThrottle is checked by the action once membership is known
+            return super().get_throttles() + [MessageSendThrottle()]
+        if self.action == 'batch_create':
+            throttle = MessageSendThrottle()
+            if throttle.get_cost(self.request, self) > self.get_max_batch_size():
+                # refused by batch_create as invalid, not as over the rate
+                return super().get_throttles()
+            return super().get_throttles() + [throttle]
+        return super().get_throttles()
+
+    def get_max_batch_size(self):
+        """
+        :return: max_batch_size, lowered to the message_send rate, since
+        a larger batch could never be sent
+        """
+        capacity = MessageSendThrottle().capacity
+        return self.max_batch_size if capacity is None else min(self.max_batch_size, capacity)
+
+    @staticmethod
+    def get_history_tiers(chat_id):
+        """
+        :return: hot messages and the archive of a chat, newest tier first
+        """
+        return [Message.objects.filter(chat_id=chat_id).values(*MESSAGE_VALUES),
+                ArchivedMessage.objects.filter(chat_id=chat_id).values(*MESSAGE_VALUES)]
+
+    @staticmethod
+    def store_message(sender, text, chat_id):
+        """
+        Save a message the sender is allowed to send and notify the chat.
+        :return: created message
+        """
+        with transaction.atomic():
+            message = Message.objects.create(
+                text=text,
+                sender=sender,
+                chat_id=chat_id,
+                seq=Chat.allocate_seq(chat_id)
+            )
+            # own messages are never unread
+            ChatReadState.advance(sender.id, message.chat_id, message.seq)
+            outbox.enqueue(outbox.MESSAGE_CREATED, [outbox.message_payload(message)])
+            publish_message(message, MESSAGE_CREATED)
+        return message
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            message = self.get_object()
+        except Http404:
+            try:
+                message = ArchivedMessage.objects.get(id=kwargs['pk'])
+            except ArchivedMessage.DoesNotExist:
+                raise Http404
+        with measure_serialization(request):
+            data = self.get_serializer(message).data
+        return Response(data)
 
     def list(self, request, *args, **kwargs):
-        chat = Chat.objects.get(id=kwargs['pk'])
-        messages = chat.messages
+        membership = get_membership_or_404(kwargs['pk'])
 
-        if not chat.participants.filter(id=request.user.id).exists():
+        if request.user.id not in membership.participants:
             return Response({'error': "you can't see messages in chat if you are not participants"},
                             status.HTTP_403_FORBIDDEN)
 
-        serialized = MessageSerializer(messages, many=True)
-        return Response(serialized.data)
+        etag = history_etag(request, membership.chat_id)
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        tiers = self.get_history_tiers(membership.chat_id)
+        page = self.paginator.paginate_tiers(tiers, request)
+        with measure_serialization(request):
+            data = message_rows(page)
+        response = self.get_paginated_response(data)
+        if etag is not None:
+            response['ETag'] = etag
+        return response
+
+    @classmethod
+    def get_poll_timeout(cls, request):
+        """
+        :return: seconds a poll may wait, clamped to max_poll_timeout,
+        or None if the `timeout` parameter is not a finite number
+        """
+        try:
+            timeout = float(request.query_params.get('timeout', cls.poll_timeout))
+        except ValueError:
+            return None
+        if not math.isfinite(timeout):
+            return None
+        return min(max(timeout, 0), cls.max_poll_timeout)
+
+    def poll(self, request, *args, **kwargs):
+        """
+        Long-poll for messages newer than the `after` cursor. Responds as
+        soon as such messages exist or with an empty page after `timeout`
+        seconds. Waiting requests are woken by message creation in this
+        process and do not touch the database while idle. Under ASGI the
+        GET is served by chat.consumers.MessagePollConsumer instead.
+        """
+        membership = get_membership_or_404(kwargs['pk'])
+
+        if request.user.id not in membership.participants:
+            return Response({'error': "you can't see messages in chat if you are not participants"},
+                            status.HTTP_403_FORBIDDEN)
+
+        tiers = self.get_history_tiers(membership.chat_id)
+        timeout = self.get_poll_timeout(request)
+        if timeout is None:
+            return Response({'error': 'timeout must be a number'}, status.HTTP_400_BAD_REQUEST)
+
+        with message_notifier.listen(membership.chat_id) as wait:
+            page = self.paginator.paginate_tiers(tiers, request)
+            if not page:
+                # don't hold a database connection while idle
+                connection.close()
+                if wait(timeout):
+                    page = self.paginator.paginate_tiers(tiers, request)
+
+        with measure_serialization(request):
+            data = message_rows(page)
+        return self.get_paginated_response(data)
+
+    def search(self, request, *args, **kwargs):
+        """
+        Full-text search over the chats of the current user, best matching
+        and most recent messages first. Every result carries a history
+        cursor, so the client can load the messages around it.
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'error': 'q is required'}, status.HTTP_400_BAD_REQUEST)
+
+        chat_id = request.query_params.get('chat_id')
+        try:
+            limit = int(request.query_params.get('limit', self.search_limit))
+            chat_id = int(chat_id) if chat_id is not None else None
+        except ValueError:
+            return Response({'error': 'limit and chat_id must be integers'},
+                            status.HTTP_400_BAD_REQUEST)
+        limit = min(max(limit, 1), self.max_search_limit)
+
+        found = search_messages(request.user.id, query, limit, chat_id)
+        with measure_serialization(request):
+            results = message_rows(found)
+            for result, message in zip(results, found):
+                result['cursor'] = MessageCursorPagination.encode_cursor(message)
+        return Response({'results': results})
 
     def create(self, request, *args, **kwargs):
         text = request.data.get('text')
@@ -81,24 +364,111 @@ class MessageView(ModelViewSet):
             return Response({'error': 'chat_id and text are required'},
                             status.HTTP_400_BAD_REQUEST)
 
-        try:
-            chat = Chat.objects.get(id=chat_id)
-        except Chat.DoesNotExist:
+        membership = get_membership(chat_id)
+        if membership is None:
             return Response({'error': 'chat with such id does not exist'},
                             status.HTTP_400_BAD_REQUEST)
 
-        if not chat.participants.filter(id=request.user.id).exists():
+        if request.user.id not in membership.participants:
             return Response({'error': "You can't send messages to chats where are you not participate"},
                      status.HTTP_403_FORBIDDEN)
 
-        Message(
-            text=text,
-            sender=request.user,
-            chat_id=chat_id
-        ).save()
+        check_throttles(request, [ChatMessageThrottle(membership.chat_id)], self)
+        self.store_message(request.user, text, membership.chat_id)
 
         return Response({'status': 'messages has been sent'}, status.HTTP_201_CREATED)
 
+    def batch_create(self, request, *args, **kwargs):
+        """
+        Send many messages, possibly to different chats, in one request.
+        Membership in all target chats is checked with one query and the
+        accepted messages are stored with one bulk insert. Responds with
+        a status for every item in the order they were sent.
+        """
+        items = request.data.get('messages') if isinstance(request.data, dict) else None
+
+        if not isinstance(items, list) or len(items) == 0:
+            return Response({'error': 'messages must be a non-empty list'},
+                            status.HTTP_400_BAD_REQUEST)
+
+        max_batch_size = self.get_max_batch_size()
+        if len(items) > max_batch_size:
+            return Response({'error': 'you can send at most {0} messages at once'.format(max_batch_size)},
+                            status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                item = {}
+            text = item.get('text')
+            try:
+                chat_id = int(item.get('chat_id'))
+            except (TypeError, ValueError):
+                chat_id = None
+
+            if text is None or chat_id is None:
+                results[index] = {'status': status.HTTP_400_BAD_REQUEST,
+                                  'error': 'chat_id and text are required'}
+            else:
+                valid.append((index, chat_id, text))
+
+        member_chats = set(Chat.participants.through.objects.filter(
+            user_id=request.user.id,
+            chat_id__in={chat_id for _, chat_id, _ in valid}
+        ).values_list('chat_id', flat=True))
+
+        # take each chat's messages from its bucket at once
+        counts = Counter(chat_id for _, chat_id, _ in valid if chat_id in member_chats)
+        throttled = {chat_id for chat_id, count in counts.items()
+                     if not ChatMessageThrottle(chat_id, count).allow_request(request, self)}
+
+        messages = []
+        for index, chat_id, text in valid:
+            if chat_id in throttled:
+                results[index] = {'status': status.HTTP_429_TOO_MANY_REQUESTS,
+                                  'error': 'too many messages sent to this chat'}
+            elif chat_id in member_chats:
+                messages.append(Message(text=text, sender=request.user, chat_id=chat_id))
+                results[index] = {'status': status.HTTP_201_CREATED}
+            else:
+                results[index] = {'status': status.HTTP_403_FORBIDDEN,
+                                  'error': "You can't send messages to chats where are you not participate"}
+
+        with transaction.atomic():
+            by_chat = {}
+            for message in messages:
+                by_chat.setdefault(message.chat_id, []).append(message)
+            for chat_id, chat_messages in by_chat.items():
+                first_seq = Chat.allocate_seq(chat_id, len(chat_messages))
+                for offset, message in enumerate(chat_messages):
+                    message.seq = first_seq + offset
+                ChatReadState.advance(request.user.id, chat_id, chat_messages[-1].seq)
+
+            messages = Message.objects.bulk_create(messages)
+            if not connection.features.can_return_ids_from_bulk_insert:
+                # e.g. SQLite, read the ids back by their (chat, seq), unique per allocate_seq
+                self.fetch_ids(by_chat)
+            outbox.enqueue(outbox.MESSAGE_CREATED, [outbox.message_payload(message) for message in messages])
+            publish_messages(messages, MESSAGE_CREATED)
+
+        return Response({'results': results}, status.HTTP_200_OK)
+
+    @staticmethod
+    def fetch_ids(by_chat):
+        """
+        Set ids of bulk inserted messages with one query.
+        :param by_chat: dict of chat id to its new messages
+        """
+        condition = Q()
+        for chat_id, chat_messages in by_chat.items():
+            condition |= Q(chat_id=chat_id, seq__in=[message.seq for message in chat_messages])
+        ids = {(chat_id, seq): pk for pk, chat_id, seq
+               in Message.objects.filter(condition).values_list('id', 'chat_id', 'seq')}
+        for chat_id, chat_messages in by_chat.items():
+            for message in chat_messages:
+                message.id = ids[(chat_id, message.seq)]
+
     def update(self, request, *args, **kwargs):
         pk = kwargs['pk']
         message = Message.objects.get(id=pk)
@@ -124,63 +494,195 @@ class MessageView(ModelViewSet):
                                            data=request.data,
                                            partial=True)
         serializer.is_valid()
-        serializer.save()
+        with transaction.atomic():
+            serializer.save()
+            Chat.bump_version([message.chat_id])
+        publish_message(message, MESSAGE_EDITED)
 
         return Response(serializer.data, status.HTTP_202_ACCEPTED)
 
 
 class ChatParticipantsView(APIView):
-    authentication_classes = (authentication.JSONWebTokenAuthentication, )
+    """
+    Add or remove one `user_id`, or a list of `user_ids` at once.
+    """
+    authentication_classes = (CachedJSONWebTokenAuthentication, )
     permission_classes = (IsAuthenticated,)
+    max_batch_size = 1000
 
     def post(self, request, *args, **kwargs):
-        chat_id = kwargs['pk']
-        chat = Chat.objects.get(id=chat_id)
+        membership = get_membership_or_404(kwargs['pk'])
 
-        if chat.is_private:
+        if membership.is_private:
             return Response({'error': "This chat is private"},
                             status.HTTP_403_FORBIDDEN)
 
-        if not chat.participants.filter(id=request.user.id).exists():
+        if request.user.id not in membership.participants:
             return Response({'error': "You can't add user to chat if "
                                       "you are not in this chat"},
                             status.HTTP_403_FORBIDDEN)
 
+        if 'user_ids' in request.data:
+            return self.change_many(request, membership.chat_id, add=True)
+
         try:
             new_participant = User.objects.get(id=request.data.get('user_id'))
         except User.DoesNotExist:
             return Response({'error': 'user with such id does not exist'}, status.HTTP_400_BAD_REQUEST)
 
-        if chat.participants.filter(id=new_participant.id).exists():
+        if new_participant.id in membership.participants:
             return Response({'error': 'user is already in this chat'},
                             status.HTTP_400_BAD_REQUEST)
 
-        chat.participants.add(new_participant)
+        Chat(id=membership.chat_id).participants.add(new_participant.id)
 
         return Response({'result': 'user was added to this chat'}, status.HTTP_201_CREATED)
 
     def delete(self, request, *args, **kwargs):
-        chat_id = kwargs['pk']
-        chat = Chat.objects.get(id=chat_id)
+        membership = get_membership_or_404(kwargs['pk'])
+        batch = 'user_ids' in request.data
 
-        if request.data.get('user_id') is None:
+        if not batch and request.data.get('user_id') is None:
             return Response({'error': 'user_id is required'}, status.HTTP_400_BAD_REQUEST)
 
-        if not chat.participants.filter(id=request.user.id).exists():
+        if request.user.id not in membership.participants:
             return Response({'error': "You can't remove user from chat"
                                       " if you are not in this chat"},
                             status.HTTP_403_FORBIDDEN)
 
+        if batch:
+            return self.change_many(request, membership.chat_id, add=False)
+
         try:
             new_participant = User.objects.get(id=request.data.get('user_id'))
         except User.DoesNotExist:
             return Response({'error': 'user with such id does not exist'}, status.HTTP_400_BAD_REQUEST)
 
-        if not chat.participants.filter(id=request.data.get('user_id')).exists():
+        if new_participant.id not in membership.participants:
             return Response({'error': 'user is not in this chat'},
                             status.HTTP_400_BAD_REQUEST)
 
-        chat.participants.remove(new_participant)
+        Chat(id=membership.chat_id).participants.remove(new_participant.id)
 
         return Response({'result': 'user was deleted from this chat'}, status.HTTP_200_OK)
 
+    def change_many(self, request, chat_id, add):
+        """
+        Add or remove the users of `user_ids` with a constant number of queries.
+        :return: response with the result for every requested user
+        """
+        if hasattr(request.data, 'getlist'):
+            values = request.data.getlist('user_ids')
+        else:
+            values = request.data['user_ids']
+        try:
+            if not isinstance(values, list):
+                raise TypeError
+            user_ids = list(dict.fromkeys(int(value) for value in values))
+        except (TypeError, ValueError):
+            return Response({'error': 'user_ids must be a list of integers'}, status.HTTP_400_BAD_REQUEST)
+
+        if not user_ids:
+            return Response({'error': 'user_ids must not be empty'}, status.HTTP_400_BAD_REQUEST)
+        if len(user_ids) > self.max_batch_size:
+            return Response({'error': 'at most {0} users can be changed at once'.format(self.max_batch_size)},
+                            status.HTTP_400_BAD_REQUEST)
+
+        users = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+        with transaction.atomic():
+            participants = set(Chat.participants.through.objects.filter(chat_id=chat_id, user_id__in=user_ids)
+                               .values_list('user_id', flat=True))
+            if add:
+                changed = [user_id for user_id in user_ids if user_id in users and user_id not in participants]
+                if changed:
+                    Chat(id=chat_id).participants.add(*changed)
+            else:
+                changed = [user_id for user_id in user_ids if user_id in participants]
+                if changed:
+                    Chat(id=chat_id).participants.remove(*changed)
+
+        changed = set(changed)
+        results = []
+        for user_id in user_ids:
+            if user_id not in users:
+                result = 'user with such id does not exist'
+            elif user_id in changed:
+                result = 'user was added to this chat' if add else 'user was deleted from this chat'
+            else:
+                result = 'user is already in this chat' if add else 'user is not in this chat'
+            results.append({'user_id': user_id, 'result': result})
+
+        return Response({'results': results}, status.HTTP_200_OK)
+
+
+class ChatReadView(APIView):
+    authentication_classes = (CachedJSONWebTokenAuthentication, )
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Advance the read watermark of the current user to `message_id`,
+        or to the latest message of the chat if it is omitted.
+        """
+        membership = get_membership_or_404(kwargs['pk'])
+
+        if request.user.id not in membership.participants:
+            return Response({'error': "You can't read chats where are you not participate"},
+                            status.HTTP_403_FORBIDDEN)
+
+        message_id = request.data.get('message_id')
+        if message_id is None:
+            seq = Chat.objects.values_list('message_count', flat=True).get(id=membership.chat_id)
+        else:
+            seq = None
+            try:
+                message_id = int(message_id)
+            except (TypeError, ValueError):
+                return Response({'error': 'message_id must be an integer'},
+                                status.HTTP_400_BAD_REQUEST)
+            for model in (Message, ArchivedMessage):
+                seq = model.objects.filter(id=message_id, chat_id=membership.chat_id) \
+                    .values_list('seq', flat=True).first()
+                if seq is not None:
+                    break
+            if seq is None:
+                return Response({'error': 'message with such id does not exist in this chat'},
+                                status.HTTP_400_BAD_REQUEST)
+
+        ChatReadState.advance(request.user.id, membership.chat_id, seq)
+
+        return Response({'result': 'chat was marked as read'}, status.HTTP_200_OK)
+
+
+class ChatExportView(APIView):
+    """
+    Stream the whole history of a chat, or of all chats of the current
+    user, as NDJSON, gzipped with `compress=gzip`.
+    """
+    authentication_classes = (CachedJSONWebTokenAuthentication, )
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        if 'pk' in kwargs:
+            membership = get_membership_or_404(kwargs['pk'])
+            if request.user.id not in membership.participants:
+                return Response({'error': "you can't export chat if you are not participant"},
+                                status.HTTP_403_FORBIDDEN)
+            chat_ids = [membership.chat_id]
+            filename = 'chat-{0}.ndjson'.format(membership.chat_id)
+        else:
+            chat_ids = list(Chat.participants.through.objects.filter(user_id=request.user.id)
+                            .order_by('chat_id').values_list('chat_id', flat=True))
+            filename = 'chats-{0}.ndjson'.format(request.user.id)
+
+        compress = request.query_params.get('compress') == 'gzip'
+        response = StreamingHttpResponse(self.stream(request, export_chunks(chat_ids, compress)),
+                                         content_type='application/gzip' if compress else 'application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="{0}{1}"'.format(filename, '.gz' if compress else '')
+        return response
+
+    @staticmethod
+    def stream(request, chunks):
+        # the body is read after the view returned and the middleware reset the replica flag
+        with replica_reads(request):
+            yield from chunks
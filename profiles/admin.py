@@ -4,6 +4,7 @@ from django.contrib.auth.models import User
 
 class MyUserAdmin(admin.ModelAdmin):
     list_display = ['username', 'is_active', 'last_login', 'last_message_time']
+    list_select_related = ['activity']
 
 
 admin.site.unregister(User)
@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class ProfilesConfig(AppConfig):
     name = 'profiles'
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from django.db.models.signals import post_delete, post_save
+        from .authentication import evict_cached_tokens
+
+        post_save.connect(evict_cached_tokens, sender=get_user_model())
+        post_delete.connect(evict_cached_tokens, sender=get_user_model())
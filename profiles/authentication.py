@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils.translation import ugettext as _
+from rest_framework import exceptions
+from rest_framework_jwt import authentication
+
+
+class TokenCache:
+    """
+    Thread-safe LRU mapping of verified tokens to cached users.
+    Entries expire at their own deadline and can be dropped per user.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._user_tokens = {}
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, user_id, value = entry
+            if expires_at <= time.time():
+                self._remove(token)
+                return None
+            self._entries.move_to_end(token)
+            return value
+
+    def set(self, token, user_id, value, expires_at):
+        with self._lock:
+            if token in self._entries:
+                self._remove(token)
+            self._entries[token] = (expires_at, user_id, value)
+            self._user_tokens.setdefault(user_id, set()).add(token)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def evict_user(self, user_id):
+        with self._lock:
+            for token in list(self._user_tokens.get(user_id, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._user_tokens.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, token):
+        _, user_id, _ = self._entries.pop(token)
+        tokens = self._user_tokens[user_id]
+        tokens.discard(token)
+        if not tokens:
+            del self._user_tokens[user_id]
+
+
+token_cache = TokenCache(settings.JWT_AUTH_CACHE_SIZE)
+
+
+class CachedJSONWebTokenAuthentication(authentication.JSONWebTokenAuthentication):
+    """
+    JSONWebTokenAuthentication that remembers verified tokens for
+    JWT_AUTH_CACHE_TTL seconds (never past the token's own expiry), so
+    repeated requests skip signature verification and the user query.
+    The user is rebuilt from cached fields with the password deferred.
+    Cached tokens of a user are dropped whenever the user is saved or
+    deleted in this process; other processes notice within the TTL.
+    """
+
+    def authenticate(self, request):
+        jwt_value = self.get_jwt_value(request)
+        if jwt_value is None:
+            return None
+
+        cached = token_cache.get(jwt_value)
+        if cached is not None:
+            db, names, values = cached
+            return get_user_model().from_db(db, names, values), jwt_value
+
+        # the instance is shared by concurrent requests, so the payload stays local
+        payload = self.decode_payload(jwt_value)
+        user = self.authenticate_credentials(payload)
+
+        names = [field.attname for field in user._meta.concrete_fields
+                 if field.attname != 'password']
+        values = [getattr(user, name) for name in names]
+        expires_at = time.time() + settings.JWT_AUTH_CACHE_TTL
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+        token_cache.set(jwt_value, user.pk, (user._state.db, names, values), expires_at)
+        return user, jwt_value
+
+    @staticmethod
+    def decode_payload(jwt_value):
+        """
+        Verify the token like JSONWebTokenAuthentication.authenticate does.
+        :return: payload of the token
+        """
+        try:
+            return authentication.jwt_decode_handler(jwt_value)
+        except jwt.ExpiredSignature:
+            raise exceptions.AuthenticationFailed(_('Signature has expired.'))
+        except jwt.DecodeError:
+            raise exceptions.AuthenticationFailed(_('Error decoding signature.'))
+        except jwt.InvalidTokenError:
+            raise exceptions.AuthenticationFailed()
+
+
+def evict_cached_tokens(sender, instance, **kwargs):
+    token_cache.evict_user(instance.pk)
@@ -0,0 +1,70 @@
+"""
+User directory search, backed by the indexes of migration 0001.
+
+Prefix search is an ordered range scan over (lower(username), id), or
+(lower(email), id) for queries containing '@'. Substring search matches
+both and walks users in id order, so the trigram index lookup stops as
+soon as a page is filled even when most users match.
+"""
+from django.contrib.auth.admin import User
+from django.db import connection
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+DIRECTORY_VALUES = ('id', 'username', 'email')
+
+# shorter substrings have no trigrams to look up
+MIN_SUBSTRING_LENGTH = 3
+
+SQLITE_SUBSTRING_SEARCH = '''
+    SELECT u.id, u.username, u.email FROM profiles_user_fts f
+    JOIN auth_user u ON u.id = f.rowid
+    WHERE profiles_user_fts MATCH %s AND f.rowid > %s
+    ORDER BY f.rowid
+    LIMIT %s
+'''
+
+
+def prefix_search(query, after, limit):
+    """
+    :param query: prefix of the username, or of the email if it contains '@'
+    :param after: (key, id) of the last user of the previous page or None
+    :return: `.values()` rows with DIRECTORY_VALUES and the lowercased
+    `key` they are ordered by
+    """
+    return list(prefix_queryset(query, after)[:limit])
+
+
+def prefix_queryset(query, after):
+    prefix = query.lower()
+    users = User.objects.annotate(key=Lower('email' if '@' in prefix else 'username'))
+    if prefix:
+        users = users.filter(key__startswith=prefix, key__gte=prefix)
+        if prefix[-1] != chr(0x10ffff):
+            # closes the index range, startswith alone doesn't use it
+            users = users.filter(key__lt=prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    if after is not None:
+        key, pk = after
+        users = users.filter(Q(key__gt=key) | Q(key=key, id__gt=pk), key__gte=key)
+    return users.order_by('key', 'id').values('key', *DIRECTORY_VALUES)
+
+
+def substring_search(query, after, limit):
+    """
+    :param query: at least MIN_SUBSTRING_LENGTH characters found anywhere
+    in the username or email, case insensitive
+    :param after: id of the last user of the previous page or None
+    :return: `.values()` rows with DIRECTORY_VALUES ordered by id
+    """
+    after = after or 0
+    if connection.vendor == 'sqlite':
+        phrase = '"{0}"'.format(query.replace('"', '""'))
+        with connection.cursor() as cursor:
+            cursor.execute(SQLITE_SUBSTRING_SEARCH, [phrase, after, limit])
+            return [dict(zip(DIRECTORY_VALUES, row)) for row in cursor.fetchall()]
+
+    # the trigram GIN indexes on PostgreSQL serve these LIKE filters
+    substring = query.lower()
+    users = User.objects.annotate(username_key=Lower('username'), email_key=Lower('email')) \
+        .filter(Q(username_key__contains=substring) | Q(email_key__contains=substring), id__gt=after)
+    return list(users.order_by('id').values(*DIRECTORY_VALUES)[:limit])
@@ -0,0 +1,72 @@
+from django.db import migrations
+
+# Prefix search walks expression indexes on the lowercased username and
+# email in directory order. Substring search uses a trigram FTS5 table on
+# SQLite, kept in sync with triggers, and trigram GIN indexes on PostgreSQL.
+# Django rebuilds SQLite tables on most AlterField operations, which drops
+# the triggers: recreate them after any migration that changes auth_user.
+SQLITE_TRIGGERS = [
+    "CREATE TRIGGER profiles_user_fts_insert AFTER INSERT ON auth_user BEGIN "
+    "INSERT INTO profiles_user_fts(rowid, username, email) VALUES (new.id, new.username, new.email); END",
+    "CREATE TRIGGER profiles_user_fts_delete AFTER DELETE ON auth_user BEGIN "
+    "INSERT INTO profiles_user_fts(profiles_user_fts, rowid, username, email) "
+    "VALUES ('delete', old.id, old.username, old.email); END",
+    "CREATE TRIGGER profiles_user_fts_update AFTER UPDATE OF username, email ON auth_user BEGIN "
+    "INSERT INTO profiles_user_fts(profiles_user_fts, rowid, username, email) "
+    "VALUES ('delete', old.id, old.username, old.email); "
+    "INSERT INTO profiles_user_fts(rowid, username, email) VALUES (new.id, new.username, new.email); END",
+]
+
+SQLITE_FORWARD = [
+    "CREATE INDEX profiles_user_username_idx ON auth_user (lower(username), id)",
+    "CREATE INDEX profiles_user_email_idx ON auth_user (lower(email), id)",
+    "CREATE VIRTUAL TABLE profiles_user_fts USING fts5("
+    "username, email, content='auth_user', content_rowid='id', tokenize='trigram')",
+] + SQLITE_TRIGGERS + [
+    "INSERT INTO profiles_user_fts(profiles_user_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS profiles_user_fts_update",
+    "DROP TRIGGER IF EXISTS profiles_user_fts_delete",
+    "DROP TRIGGER IF EXISTS profiles_user_fts_insert",
+    "DROP TABLE IF EXISTS profiles_user_fts",
+    "DROP INDEX IF EXISTS profiles_user_email_idx",
+    "DROP INDEX IF EXISTS profiles_user_username_idx",
+]
+
+POSTGRESQL_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX profiles_user_username_idx ON auth_user (lower(username), id)",
+    "CREATE INDEX profiles_user_email_idx ON auth_user (lower(email), id)",
+    "CREATE INDEX profiles_user_username_trgm_idx ON auth_user USING GIN (lower(username) gin_trgm_ops)",
+    "CREATE INDEX profiles_user_email_trgm_idx ON auth_user USING GIN (lower(email) gin_trgm_ops)",
+]
+
+POSTGRESQL_BACKWARD = [
+    "DROP INDEX IF EXISTS profiles_user_email_trgm_idx",
+    "DROP INDEX IF EXISTS profiles_user_username_trgm_idx",
+    "DROP INDEX IF EXISTS profiles_user_email_idx",
+    "DROP INDEX IF EXISTS profiles_user_username_idx",
+]
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0011_update_proxy_permissions'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRESQL_FORWARD}),
+            run_for_vendor({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRESQL_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,96 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .directory import MIN_SUBSTRING_LENGTH, prefix_search, substring_search
+
+
+class DirectoryPagination(pagination.BasePagination):
+    """
+    Keyset pagination of the user directory.
+
+    `search` filters users by username prefix (email prefix if it contains
+    '@'), ordered by name. With `match=contains` it matches a substring
+    of either, ordered by id, and falls back to prefix search for queries
+    too short to have trigrams. `after` continues from a page, `limit`
+    sets the page size.
+    """
+    search_query_param = 'search'
+    match_query_param = 'match'
+    after_query_param = 'after'
+    limit_query_param = 'limit'
+    page_size = 50
+    max_page_size = 200
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """
+        :param queryset: ignored, users are read by the directory searches
+        """
+        self.request = request
+        limit = self.get_limit(request)
+        query = request.query_params.get(self.search_query_param, '').strip()
+        contains = request.query_params.get(self.match_query_param) == 'contains' \
+            and len(query) >= MIN_SUBSTRING_LENGTH
+        after = self.decode_cursor(request.query_params.get(self.after_query_param), contains)
+
+        if contains:
+            rows = substring_search(query, after, limit + 1)
+        else:
+            rows = prefix_search(query, after, limit + 1)
+
+        self.has_next = len(rows) > limit
+        self.page = rows[:limit]
+        self.contains = contains
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if limit <= 0:
+            return self.page_size
+        return min(limit, self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        position = last['id'] if self.contains else [last['key'], last['id']]
+        return replace_query_param(self.request.build_absolute_uri(), self.after_query_param,
+                                   self.encode_cursor(position))
+
+    @staticmethod
+    def encode_cursor(position):
+        raw = json.dumps(position, separators=(',', ':'))
+        return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, encoded, contains):
+        """
+        :return: id for substring search, (key, id) for prefix search
+        """
+        if encoded is None:
+            return None
+        try:
+            position = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if contains and type(position) is int:
+            return position
+        if not contains and isinstance(position, list) and len(position) == 2 \
+                and isinstance(position[0], str) and type(position[1]) is int:
+            return tuple(position)
+        raise NotFound(self.invalid_cursor_message)
@@ -1,8 +1,22 @@
+import time
+from unittest import mock
+
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework_jwt.settings import api_settings
 from django.contrib.auth.admin import User
 
+from .authentication import CachedJSONWebTokenAuthentication, TokenCache, token_cache
+from .directory import prefix_queryset
+
+jwt_payload_handler = api_settings.JWT_PAYLOAD_HANDLER
+jwt_encode_handler = api_settings.JWT_ENCODE_HANDLER
+
 
 class GetUsersTest(APITestCase):
     def setUp(self) -> None:
@@ -85,3 +99,169 @@ class UserRegistrationTest(APITestCase):
         response = self.client.post(url, data=data)
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CachedTokenAuthenticationTest(APITestCase):
+    def setUp(self):
+        token_cache.clear()
+        User.objects.create_user(username='User1', password='testpass1234')
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        jwt_token = response.data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(jwt_token))
+
+    def test_repeated_request_does_not_load_user(self):
+        url = reverse('users')
+        self.client.get(url)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # only the user list itself
+        self.assertEqual(len(queries), 1)
+
+    def test_deactivated_user_is_rejected(self):
+        url = reverse('users')
+        self.client.get(url)
+
+        user = User.objects.get(username='User1')
+        user.is_active = False
+        user.save()
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_password_change_drops_cached_token(self):
+        self.client.get(reverse('users'))
+
+        user = User.objects.get(username='User1')
+        user.set_password('newpass1234')
+        user.save()
+
+        self.assertEqual(len(token_cache), 0)
+
+    def test_concurrent_tokens_keep_their_expiry(self):
+        user = User.objects.get(username='User1')
+        now = int(time.time())
+        short_token = jwt_encode_handler(dict(jwt_payload_handler(user), exp=now + 5))
+        long_token = jwt_encode_handler(dict(jwt_payload_handler(user), exp=now + 3600))
+        auth = CachedJSONWebTokenAuthentication()
+        authenticate_credentials = JSONWebTokenAuthentication.authenticate_credentials
+
+        def interleaved(instance, payload):
+            # another request authenticates with the same instance meanwhile
+            if payload['exp'] == now + 5:
+                auth.authenticate(RequestFactory().get('/', HTTP_AUTHORIZATION='JWT ' + long_token))
+            return authenticate_credentials(instance, payload)
+
+        with mock.patch.object(JSONWebTokenAuthentication, 'authenticate_credentials', interleaved):
+            auth.authenticate(RequestFactory().get('/', HTTP_AUTHORIZATION='JWT ' + short_token))
+
+        self.assertEqual(token_cache._entries[short_token.encode()][0], now + 5)
+
+
+class TokenCacheTest(SimpleTestCase):
+    def test_entry_expires(self):
+        cache = TokenCache(maxsize=10)
+        cache.set('token', 1, 'user', time.time() - 1)
+
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_entry_is_dropped(self):
+        cache = TokenCache(maxsize=2)
+        expires_at = time.time() + 60
+        cache.set('first', 1, 'user1', expires_at)
+        cache.set('second', 2, 'user2', expires_at)
+        cache.get('first')
+        cache.set('third', 3, 'user3', expires_at)
+
+        self.assertEqual(cache.get('first'), 'user1')
+        self.assertIsNone(cache.get('second'))
+        self.assertEqual(cache.get('third'), 'user3')
+
+    def test_evict_user(self):
+        cache = TokenCache(maxsize=10)
+        expires_at = time.time() + 60
+        cache.set('first', 1, 'user1', expires_at)
+        cache.set('second', 1, 'user1', expires_at)
+        cache.set('third', 2, 'user2', expires_at)
+        cache.evict_user(1)
+
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get('third'), 'user2')
+
+
+class UserDirectoryTest(APITestCase):
+    def setUp(self):
+        User.objects.create_user(username='User1', password='testpass1234')
+        for name in ('alice', 'Alfred', 'albert', 'bob', 'Malika'):
+            User.objects.create_user(username=name, email='{0}@{1}.com'.format(name.lower(), 'example'))
+        User.objects.create_user(username='carol', email='carol@mail.org')
+
+        response = self.client.post(reverse('obtain-token'),
+                                    data={'username': 'User1',
+                                          'password': 'testpass1234'},
+                                    headers={'Content-Type': 'application/json'})
+        self.client.credentials(HTTP_AUTHORIZATION='JWT {0}'.format(response.data['token']))
+
+    def usernames(self, params):
+        """
+        :return: usernames of all pages of the search
+        """
+        names = []
+        response = self.client.get(reverse('user-directory'), params)
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            names.extend(user['username'] for user in response.data['results'])
+            if response.data['next'] is None:
+                return names
+            response = self.client.get(response.data['next'])
+
+    def test_prefix_search(self):
+        self.assertEqual(self.usernames({'search': 'AL', 'limit': 2}), ['albert', 'Alfred', 'alice'])
+        self.assertEqual(self.usernames({'search': 'alic'}), ['alice'])
+        self.assertEqual(self.usernames({'search': 'carol@'}), ['carol'])
+        self.assertEqual(self.usernames({'search': 'zz'}), [])
+
+    def test_whole_directory(self):
+        self.assertEqual(self.usernames({'limit': 3}),
+                         ['albert', 'Alfred', 'alice', 'bob', 'carol', 'Malika', 'User1'])
+
+    def test_substring_search(self):
+        self.assertEqual(self.usernames({'search': 'LIK', 'match': 'contains'}), ['Malika'])
+        self.assertEqual(self.usernames({'search': 'example', 'match': 'contains', 'limit': 2}),
+                         ['alice', 'Alfred', 'albert', 'bob', 'Malika'])
+        # too short for trigrams, searched as a prefix
+        self.assertEqual(self.usernames({'search': 'al', 'match': 'contains'}), ['albert', 'Alfred', 'alice'])
+
+    def test_directory_follows_user_changes(self):
+        user = User.objects.get(username='bob')
+        user.email = 'bob@mail.org'
+        user.save()
+        User.objects.filter(username='carol').delete()
+
+        self.assertEqual(self.usernames({'search': 'mail.org', 'match': 'contains'}), ['bob'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('user-directory'), {'after': 'garbage'})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_results(self):
+        response = self.client.get(reverse('user-directory'), {'search': 'carol'})
+
+        self.assertEqual(response.data['results'],
+                         [{'id': User.objects.get(username='carol').id,
+                           'username': 'carol', 'email': 'carol@mail.org'}])
+
+    def test_prefix_search_uses_index(self):
+        for query, index_name in (('al', 'profiles_user_username_idx'), ('al@', 'profiles_user_email_idx')):
+            plan = prefix_queryset(query, ('alb', 10))[:51].explain()
+
+            self.assertIn('USING INDEX {0}'.format(index_name), plan)
+            self.assertNotIn('TEMP B-TREE', plan)
@@ -3,5 +3,6 @@ from . import views
 
 urlpatterns = [
     path('', views.UserListView.as_view({'get': 'list'}), name='users'),
+    path('directory/', views.UserDirectoryView.as_view({'get': 'list'}), name='user-directory'),
     path('register/', views.RegisterUserView.as_view(), name='registration')
 ]
@@ -3,15 +3,48 @@ from rest_framework import viewsets, status, views
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 
-from .serializers import UserSerializer
-from rest_framework_jwt import authentication
+from MessengerAPI.metrics import measure_serialization
+from .authentication import CachedJSONWebTokenAuthentication
+from .pagination import DirectoryPagination
+from .serializers import DirectoryUserSerializer, UserSerializer
 
 
 class UserListView(viewsets.ModelViewSet):
-    authentication_classes = (authentication.JSONWebTokenAuthentication,)
+    authentication_classes = (CachedJSONWebTokenAuthentication,)
     permission_classes = (IsAuthenticated, )
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    replica_actions = ('list',)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        with measure_serialization(request):
+            data = self.get_serializer(queryset if page is None else page, many=True).data
+        return Response(data) if page is None else self.get_paginated_response(data)
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        with measure_serialization(request):
+            data = self.get_serializer(instance).data
+        return Response(data)
+
+
+class UserDirectoryView(viewsets.GenericViewSet):
+    """
+    Paginated user search for picking chat participants, see DirectoryPagination.
+    """
+    authentication_classes = (CachedJSONWebTokenAuthentication,)
+    permission_classes = (IsAuthenticated, )
+    serializer_class = DirectoryUserSerializer
+    pagination_class = DirectoryPagination
+    replica_actions = ('list',)
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(None)
+        with measure_serialization(request):
+            data = self.get_serializer(page, many=True).data
+        return self.get_paginated_response(data)
 
 
 class RegisterUserView(views.APIView):